@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -15,7 +16,6 @@ import torchvision
 from torchvision import transforms, datasets, models
 from torch import Tensor
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -23,7 +23,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, standard_hooks, add_trainer_args, load_weights
+from evaluation import utterance_loss, constant, group_size
 from networks import cnn_f0_generator, dnn_discriminator
 from utils import *
 
@@ -31,107 +33,68 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet.train()
-    Dnet.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.unsqueeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.unsqueeze(0).type(torch.FloatTensor)).to(device)
+# One training step: G update followed by D update
+def train_step(a, b):
+    a = Variable(a.unsqueeze(0).type(torch.FloatTensor)).to(device)
+    b = Variable(b.unsqueeze(0).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(1000, 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(1000, 1).fill_(0.0), requires_grad=False).to(device)
-        
-        # Update G network
-        optimizer_G.zero_grad()
-        Gout = Gnet(a)
-        G_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0)), valid)*2
-        
-        G_loss.backward()
-        optimizer_G.step()
+    # One F0 value per frame, for utterances of any length
+    frames = a.shape[2]
+    valid = Variable(Tensor(frames, 1).fill_(1.0), requires_grad=False).to(device)
+    fake = Variable(Tensor(frames, 1).fill_(0.0), requires_grad=False).to(device)
 
-        # Update D network        
-        optimizer_D.zero_grad()
+    # Update G network
+    optimizer_G.zero_grad()
+    Gout = Gnet(a)
+    G_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0)), valid)*2
 
-        # Measure discriminator's ability to classify real from generated samples
-        b = b.view(1000, 1)
-        real_loss = adversarial_loss(Dnet(b), valid)
-        fake_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0).detach()), fake)
-        D_loss = (real_loss + fake_loss)/2
+    G_loss.backward()
+    optimizer_G.step()
 
-        D_loss.backward()
-        optimizer_D.step()
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), D_loss, G_loss.cpu().data.numpy()))
-    
+    # Update D network        
+    optimizer_D.zero_grad()
 
-# Validation function
-def validating(data_loader):
-    Gnet.eval()
-    Dnet.eval()
-    G_running_loss = 0
-    D_running_loss = 0
+    # Measure discriminator's ability to classify real from generated samples
+    b = b.reshape(frames, 1)
+    real_loss = adversarial_loss(Dnet(b), valid)
+    fake_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0).detach()), fake)
+    D_loss = (real_loss + fake_loss)/2
+
+    D_loss.backward()
+    optimizer_D.step()
+
+    return OrderedDict([('D loss', D_loss), ('G loss', G_loss)])
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.unsqueeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.unsqueeze(0).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(1000, 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(1000, 1).fill_(0.0), requires_grad=False).to(device)
-        
-        Gout = Gnet(a)
-        G_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0)), valid)*2
+# Validation step on a group of stacked utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.unsqueeze(1).to(device)
+    b = b.to(device).reshape(-1, 1)
+    n = lengths[0]
 
-        G_running_loss += G_loss.item()
+    Gout = Gnet(a).reshape(-1, 1)
+    fake_out = Dnet(Gout)
+    G_loss = utterance_loss(adversarial_loss, fake_out, constant(1.0, fake_out), n)*2
 
-        # Measure discriminator's ability to classify real from generated samples
-        b = b.view(1000, 1)
-        real_loss = adversarial_loss(Dnet(b), valid)
-        fake_loss = adversarial_loss(Dnet(Gout.squeeze(0).squeeze(0).detach()), fake)
-        D_loss = (real_loss + fake_loss)/2
-        
-        D_running_loss += D_loss.item()
-    
-    return D_running_loss/(en+1), G_running_loss/(en+1)
 
+    # Measure discriminator's ability to classify real from generated samples
+    real_out = Dnet(b)
+    real_loss = utterance_loss(adversarial_loss, real_out, constant(1.0, real_out), n)
+    fake_loss = utterance_loss(adversarial_loss, fake_out, constant(0.0, fake_out), n)
+    D_loss = (real_loss + fake_loss)/2
 
+    return OrderedDict([('D_loss', D_loss), ('G_loss', G_loss)])
 
+
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-    dl_arr = []
-    gl_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(ep+1)))
-            torch.save(Dnet, join(checkpoint,"dis_g_1_d_1_Ep_{}.pth".format(ep+1)))
-        
-        if (ep+1)%args.validation_interval==0:
-            dl,gl = validating(val_dataloader)
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
+    nets = OrderedDict([('gen_g_1_d_1', Gnet), ('dis_g_1_d_1', Dnet)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D', optimizer_D)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, nets, plots, cache, amp, jit, optimizers),
+                     eval_group=group_size(args.eval_group, device), eval_stack=True)
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -143,7 +106,8 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path = args.test_folder
     dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch))).to(device)
+    load_weights(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch)))
+    jit.compile(Gnet.eval(), dynamic=None)
 
     for i in dirs:
         
@@ -153,10 +117,13 @@ def do_testing():
         a = torch.from_numpy(d['foo'])
         a = Variable(a.type('torch.FloatTensor')).to(device)
         
-        Gout = Gnet(a)
+        with amp.autocast():
+            Gout = Gnet(a).float()
 
         savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
+    jit.save()
+
 
 if __name__ == '__main__':
 
@@ -175,34 +142,22 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/f0/", help="Checkpoint saving path for F0 features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/f0/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../results/mask/mcc/", help="Input whisper mcc features for testing")
+    add_pipeline_args(parser, frame_batching=False)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
 
 
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -221,6 +176,10 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+
     # Initialization 
     if args.dnn_cnn == "dnn":
         Gnet = cnn_f0_generator().to(device)
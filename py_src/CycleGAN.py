@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -16,7 +17,6 @@ from torchvision import transforms, datasets, models
 from torch import Tensor
 import itertools
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -24,7 +24,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, phase_timer, standard_hooks, add_trainer_args, load_weights
+from evaluation import evaluate, segment_mean, utterance_loss, constant, group_size, checkpoint_epochs, sweep
 from networks import dnn_generator, dnn_discriminator
 from utils import *
 
@@ -32,23 +34,19 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet_ws.train()
-    Gnet_sw.train()
-    Dnet_w.train()
-    Dnet_s.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step: both generators, then each discriminator
+def train_step(a, b):
+    with timer('copy'):
+        a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+        b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
         valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
         fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        ###### Generators W2S and S2W ######
-        optimizer_G.zero_grad()
-        
+
+    ###### Generators W2S and S2W ######
+    optimizer_G.zero_grad()
+
+    with timer('G forward'):
         # Identity loss
         # G_W2S(S) should equal S if real S is fed
         same_s = Gnet_ws(b)
@@ -60,211 +58,140 @@ def training(data_loader, n_epochs):
         # GAN loss
         Gout_ws = Gnet_ws(a)
         loss_GAN_W2S = criterion_GAN(Dnet_s(Gout_ws), valid)
-        
+
         Gout_sw = Gnet_sw(b)
         loss_GAN_S2W = criterion_GAN(Dnet_w(Gout_sw), valid)
-        
+
         # Cycle loss
         recovered_W = Gnet_sw(Gout_ws)
         loss_cycle_WSW = criterion_cycle(recovered_W, a)*10.0
-        
+
         recovered_S = Gnet_ws(Gout_sw)
         loss_cycle_SWS = criterion_cycle(recovered_S, b)*10.0
-        
+
         # Total loss
         loss_G =  loss_identity_w + loss_identity_s + loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+    with timer('G backward'):
         loss_G.backward()
-        
+
+    with timer('G step'):
         optimizer_G.step()
 
-        
-        
-#        Gout = Gnet(a)
-#        G_loss = adversarial_loss(Dnet(Gout), valid) + mmse_loss(Gout, b)*10
+
+
+#    Gout = Gnet(a)
+#    G_loss = adversarial_loss(Dnet(Gout), valid) + mmse_loss(Gout, b)*10
 #
-#        G_loss.backward()
-#        optimizer_G.step()
-        
-        
-        ###### Discriminator W ######
-        optimizer_D_w.zero_grad()
+#    G_loss.backward()
+#    optimizer_G.step()
+
 
+    ###### Discriminator W ######
+    optimizer_D_w.zero_grad()
+
+    with timer('D forward'):
         # Real loss
         loss_D_real = criterion_GAN(Dnet_w(a), valid)
-        
+
         # Fake loss
         loss_D_fake = criterion_GAN(Dnet_w(Gout_sw.detach()), fake)
-        
+
         # Total loss
         loss_D_w = (loss_D_real + loss_D_fake)*0.5
+    with timer('D backward'):
         loss_D_w.backward()
-        
+
+    with timer('D step'):
         optimizer_D_w.step()
-        
-        ###################################
-        
-        ###### Discriminator B ######
-        optimizer_D_s.zero_grad()
-        
+
+    ###################################
+
+    ###### Discriminator B ######
+    optimizer_D_s.zero_grad()
+
+    with timer('D forward'):
         # Real loss
         loss_D_real = criterion_GAN(Dnet_s(b), valid)
-        
+
         # Fake loss
         loss_D_fake = criterion_GAN(Dnet_s(Gout_ws.detach()), fake)
-        
+
         # Total loss
         loss_D_s = (loss_D_real + loss_D_fake)*0.5
+    with timer('D backward'):
         loss_D_s.backward()
-        
-        optimizer_D_s.step()
-        ###################################
-        
-        
 
-        # D_loss = 0
+    with timer('D step'):
+        optimizer_D_s.step()
+    ###################################
 
-        #D_running_loss = 0
-        #D_running_loss += D_loss.item()
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D_S loss: %f] [D_W loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), loss_D_s, loss_D_w, loss_G.cpu().data.numpy()))
+    return OrderedDict([('D_S loss', loss_D_s), ('D_W loss', loss_D_w), ('G loss', loss_G)])
     
 
-# Validation function
-def validating(data_loader):
-    Gnet_ws.eval()
-    Gnet_sw.eval()
-    Dnet_s.eval()
-    Dnet_w.eval()
-    Grunning_loss = 0
-    Drunning_loss = 0
-    mcd_values = []
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# Validation step on a group of utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
+    n = lengths[0]
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        ###### Generators W2S and S2W ######
-        
-        # Identity loss
-        # G_W2S(S) should equal S if real S is fed
-        same_s = Gnet_ws(b)
-        loss_identity_s = criterion_identity(same_s, b)*5.0
-        # G_S2W(W) should equal W if real W is fed
-        same_w = Gnet_sw(a)
-        loss_identity_w = criterion_identity(same_w, a)*5.0
-        
-        # GAN loss
-        Gout_ws = Gnet_ws(a)
-        loss_GAN_W2S = criterion_GAN(Dnet_s(Gout_ws), valid)
-        
-        Gout_sw = Gnet_sw(b)
-        loss_GAN_S2W = criterion_GAN(Dnet_w(Gout_sw), valid)
-        
-        # Cycle loss
-        recovered_W = Gnet_sw(Gout_ws)
-        loss_cycle_WSW = criterion_cycle(recovered_W, a)*10.0
-        
-        recovered_S = Gnet_ws(Gout_sw)
-        loss_cycle_SWS = criterion_cycle(recovered_S, b)*10.0
-        
-        # Total loss
-        loss_G =  loss_identity_w + loss_identity_s + loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+    ###### Generators W2S and S2W ######
 
-        
-        
-        ###### Discriminator W ######
-        optimizer_D_w.zero_grad()
-        
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_w(a), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_w(Gout_sw.detach()), fake)
-        
-        # Total loss
-        loss_D_w = (loss_D_real + loss_D_fake)*0.5
+    # Identity loss
+    # G_W2S(S) should equal S if real S is fed
+    same_s = Gnet_ws(b)
+    loss_identity_s = utterance_loss(criterion_identity, same_s, b, n)*5.0
+    # G_S2W(W) should equal W if real W is fed
+    same_w = Gnet_sw(a)
+    loss_identity_w = utterance_loss(criterion_identity, same_w, a, n)*5.0
 
-        
-        ###### Discriminator B ######
-        optimizer_D_s.zero_grad()
-        
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_s(b), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_s(Gout_ws.detach()), fake)
-        
-        # Total loss
-        loss_D_s = (loss_D_real + loss_D_fake)*0.5
- 
-        ###################################
-        loss_D = loss_D_s + loss_D_w	
+    # GAN loss
+    Gout_ws = Gnet_ws(a)
+    fake_s = Dnet_s(Gout_ws)
+    loss_GAN_W2S = utterance_loss(criterion_GAN, fake_s, constant(1.0, fake_s), n)
 
-        Grunning_loss += loss_G.item()
+    Gout_sw = Gnet_sw(b)
+    fake_w = Dnet_w(Gout_sw)
+    loss_GAN_S2W = utterance_loss(criterion_GAN, fake_w, constant(1.0, fake_w), n)
 
-        Drunning_loss += loss_D.item()
+    # Cycle loss
+    recovered_W = Gnet_sw(Gout_ws)
+    loss_cycle_WSW = utterance_loss(criterion_cycle, recovered_W, a, n)*10.0
 
-        # Calculate MCD
-        b_np = b.cpu().data.numpy()
-        Gout_np = Gout_ws.cpu().data.numpy()
-        mcd = np.mean([logSpecDbDist(Gout_np[i][1:], b_np[i][1:]) for i in range(len(b_np))])
-        mcd_values.append(mcd)
-    
-    avg_mcd = np.mean(mcd_values)
-        
-    return Drunning_loss/(en+1),Grunning_loss/(en+1),avg_mcd
-    
+    recovered_S = Gnet_ws(Gout_sw)
+    loss_cycle_SWS = utterance_loss(criterion_cycle, recovered_S, b, n)*10.0
+
+    # Total loss
+    loss_G = loss_identity_w + loss_identity_s + loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+
+
+    ###### Discriminator W ######
+    real_w = Dnet_w(a)
+    loss_D_w = (utterance_loss(criterion_GAN, real_w, constant(1.0, real_w), n) + utterance_loss(criterion_GAN, fake_w, constant(0.0, fake_w), n))*0.5
+
+    ###### Discriminator B ######
+    real_s = Dnet_s(b)
+    loss_D_s = (utterance_loss(criterion_GAN, real_s, constant(1.0, real_s), n) + utterance_loss(criterion_GAN, fake_s, constant(0.0, fake_s), n))*0.5
 
+    ###################################
+    loss_D = loss_D_s + loss_D_w
 
+
+    # Calculate MCD
+    mcd = segment_mean(batch_mcd(Gout_ws[:, 1:], b[:, 1:], 'none'), n)
+
+    return OrderedDict([('D_loss', loss_D), ('G_loss', loss_G), ('MCD', mcd)])
+
+
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-
-    dl_arr = []
-    gl_arr = []
-    mcd_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(ep+1)))
-
-
-        if (ep+1)%args.validation_interval==0:
-            dl,gl,mcd = validating(val_dataloader)
-            
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            mcd_arr.append(mcd)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-                mplot = viz.line(Y=np.array([mcd]), X=np.array([ep]), opts=dict(title='MCD'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-                viz.line(Y=np.array([mcd]), X=np.array([ep]), win=mplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-    savemat(checkpoint+"/"+str('mcd.mat'),  mdict={'foo': mcd_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
-    plt.figure(3)
-    plt.plot(mcd_arr)
-    plt.savefig(checkpoint+'/mcd.png')
+    nets = OrderedDict([('gen_ws', Gnet_ws), ('gen_sw', Gnet_sw), ('dis_w', Dnet_w), ('dis_s', Dnet_s)])
+    saves = OrderedDict([('gen_ws', Gnet_ws)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss'), ('MCD', 'MCD', 'mcd')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D_w', optimizer_D_w), ('D_s', optimizer_D_s)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, saves, plots, cache, amp, jit, optimizers, timer),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -277,20 +204,23 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path=args.test_folder
 
-    dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
+    dirs = read_mcc_folder(test_folder_path)
+    Gnet = jit.compile(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).eval())
 
-    for i in dirs:
+    for i, d in dirs.items():
         
-        # Load the .mcc file
-        d = read_mcc(join(test_folder_path, i))
+        # Frames are converted independently, so long .mcc files are mapped and converted chunk-wise
+        Gout = []
+        frames = jit.chunk_frames(args.chunk_frames)
+        for chunk in mcc_chunks(d, frames):
+            a = torch.from_numpy(jit.pad(chunk, frames)).to(device)
+            with amp.autocast():
+                Gout.append(Gnet(a)[:len(chunk)].float().cpu().data.numpy())
 
-        a = torch.from_numpy(d)
-        a = Variable(a.squeeze(0).type('torch.FloatTensor')).to(device)
-        
-        Gout = Gnet(a)
+        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': np.concatenate(Gout)})
+
+    jit.save()
 
-        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
 
 '''
@@ -298,24 +228,28 @@ Check MCD value on validation data for now! :)
 '''
 
 
-def give_MCD():
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
-    mcd = []
-
-    for en, (a, b) in enumerate(val_dataloader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = b.cpu().data.numpy()[0]
+# MCD of a generator on a group of validation utterances (see evaluation.py)
+def mcd_step(Gnet):
+    def step(a, b, lengths):
+        Gout = Gnet(a.to(device))
+        return OrderedDict([('MCD', segment_mean(batch_mcd(Gout[:, 1:], b.to(device)[:, 1:], 'none'), lengths[0]))])
+    return step
 
-        Gout = Gnet(a).cpu().data.numpy()
+def give_MCD():
+    Gnet = load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch)), clone=True)
+    Gnet.eval()
 
-        ans = 0
-        for k in range(Gout.shape[0]):
-            ans = logSpecDbDist(Gout[k][1:],b[k][1:])
-            mcd.append(ans)
+    # Mean over all frames; the per-utterance values are returned
+    utterances, _ = evaluate(val_dataloader, mcd_step(Gnet), group_size(args.eval_group, device))
+    print(np.average(utterances['MCD'], weights=utterances['frames']))
+    return utterances
 
-    mcd = np.array(mcd)
-    print(np.mean(mcd))
 
+# Ranks the MCD of every saved generator in one pass over the validation set (written to mcd_sweep.csv)
+def sweep_MCD():
+    load = lambda epoch: mcd_step(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(epoch)), clone=True).eval())
+    sweep(val_dataloader, checkpoint_epochs(checkpoint, ['gen_ws']), load, 'MCD', join(checkpoint, 'mcd_sweep.csv'),
+          group_size(args.eval_group, device), models=args.sweep_models)
 
 if __name__ == '__main__':
     
@@ -325,6 +259,8 @@ if __name__ == '__main__':
     parser.add_argument("-tr", "--train", action="store_true", help="Want to train?")
     parser.add_argument("-te", "--test", action="store_true", help="Want to test?")
     parser.add_argument("-m", "--mcd", action="store_true", help="Want MCD value?")
+    parser.add_argument("-sw", "--sweep", action="store_true", help="Rank the MCD of every saved checkpoint in one pass over the validation data?")
+    parser.add_argument("-sm", "--sweep_models", type=int, default=0, help="Checkpoints evaluated together by the sweep (0 for all)")
     parser.add_argument("-ci", "--checkpoint_interval", type=int, default=5, help="Checkpoint interval")
     parser.add_argument("-e", "--epoch", type=int, default=100, help="Number of Epochs")
     parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epochs to test")
@@ -335,32 +271,22 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Checkpoint saving path for MCC features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../dataset/features/US_102/Whisper/mcc/", help="Input whisper mcc features for testing")
+    parser.add_argument("-cs", "--chunk_frames", type=int, default=0, help="Frames per chunk when converting test files (0 converts whole files)")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -381,6 +307,11 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing, phase times of training (-pt)
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+    timer = phase_timer(args.phase_times, device)
+
     # Initialization
     if args.dnn_cnn == "dnn":
         Gnet_ws = dnn_generator(in_g, out_g, 512, 512, 512).to(device)
@@ -399,4 +330,6 @@ if __name__ == '__main__':
     if args.test:
         do_testing()
     if args.mcd:
-        give_MCD()
\ No newline at end of file
+        give_MCD()
+    if args.sweep:
+        sweep_MCD()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -16,7 +17,6 @@ from torchvision import transforms, datasets, models
 from torch import Tensor
 import itertools
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -24,7 +24,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, standard_hooks, add_trainer_args, load_weights
+from evaluation import utterance_loss, constant, group_size
 from networks import dnn_generator, dnn_discriminator
 from utils import *
 
@@ -32,187 +34,127 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet_ws.train()
-    Gnet_sw.train()
-    Dnet_w.train()
-    Dnet_s.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step: both generators, then each discriminator
+def train_step(a, b):
+    a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+    b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        ###### Generators W2S and S2W ######
-        optimizer_G.zero_grad()
-        
-        # GAN loss
-        Gout_ws = Gnet_ws(a)
-        loss_GAN_W2S = criterion_GAN(Dnet_s(Gout_ws), valid)
-        
-        Gout_sw = Gnet_sw(b)
-        loss_GAN_S2W = criterion_GAN(Dnet_w(Gout_sw), valid)
-        
-        # Cycle loss
-        recovered_W = Gnet_sw(Gout_ws)
-        loss_cycle_WSW = criterion_cycle(recovered_W, a)*10.0
-        
-        recovered_S = Gnet_ws(Gout_sw)
-        loss_cycle_SWS = criterion_cycle(recovered_S, b)*10.0
-        
-        # Total loss
-        loss_G = loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
-        loss_G.backward()
-        
-        optimizer_G.step()
+    valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
+    fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
 
-        
-        
-        ###### Discriminator W ######
-        optimizer_D_w.zero_grad()
+    ###### Generators W2S and S2W ######
+    optimizer_G.zero_grad()
 
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_w(a), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_w(Gout_sw.detach()), fake)
-        
-        # Total loss
-        loss_D_w = (loss_D_real + loss_D_fake)*0.5
-        loss_D_w.backward()
-        
-        optimizer_D_w.step()
-        
-        ###################################
-        
-        ###### Discriminator B ######
-        optimizer_D_s.zero_grad()
-        
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_s(b), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_s(Gout_ws.detach()), fake)
-        
-        # Total loss
-        loss_D_s = (loss_D_real + loss_D_fake)*0.5
-        loss_D_s.backward()
-        
-        optimizer_D_s.step()
-        ###################################
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D_S loss: %f] [D_W loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), loss_D_s, loss_D_w, loss_G.cpu().data.numpy()))
-    
+    # GAN loss
+    Gout_ws = Gnet_ws(a)
+    loss_GAN_W2S = criterion_GAN(Dnet_s(Gout_ws), valid)
 
-# Validation function
-def validating(data_loader):
-    Gnet_ws.eval()
-    Gnet_sw.eval()
-    Dnet_s.eval()
-    Dnet_w.eval()
-    Grunning_loss = 0
-    Drunning_loss = 0
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+    Gout_sw = Gnet_sw(b)
+    loss_GAN_S2W = criterion_GAN(Dnet_w(Gout_sw), valid)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        ###### Generators W2S and S2W ######
-        
-        # GAN loss
-        Gout_ws = Gnet_ws(a)
-        loss_GAN_W2S = criterion_GAN(Dnet_s(Gout_ws), valid)
-        
-        Gout_sw = Gnet_sw(b)
-        loss_GAN_S2W = criterion_GAN(Dnet_w(Gout_sw), valid)
-        
-        # Cycle loss
-        recovered_W = Gnet_sw(Gout_ws)
-        loss_cycle_WSW = criterion_cycle(recovered_W, a)*10.0
-        
-        recovered_S = Gnet_ws(Gout_sw)
-        loss_cycle_SWS = criterion_cycle(recovered_S, b)*10.0
-        
-        # Total loss
-        loss_G = loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+    # Cycle loss
+    recovered_W = Gnet_sw(Gout_ws)
+    loss_cycle_WSW = criterion_cycle(recovered_W, a)*10.0
 
-        
-        
-        ###### Discriminator W ######
-        optimizer_D_w.zero_grad()
-        
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_w(a), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_w(Gout_sw.detach()), fake)
-        
-        # Total loss
-        loss_D_w = (loss_D_real + loss_D_fake)*0.5
+    recovered_S = Gnet_ws(Gout_sw)
+    loss_cycle_SWS = criterion_cycle(recovered_S, b)*10.0
 
-        
-        ###### Discriminator B ######
-        optimizer_D_s.zero_grad()
-        
-        # Real loss
-        loss_D_real = criterion_GAN(Dnet_s(b), valid)
-        
-        # Fake loss
-        loss_D_fake = criterion_GAN(Dnet_s(Gout_ws.detach()), fake)
-        
-        # Total loss
-        loss_D_s = (loss_D_real + loss_D_fake)*0.5
- 
-        ###################################
-        loss_D = loss_D_s + loss_D_w	
+    # Total loss
+    loss_G = loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+    loss_G.backward()
 
-        Grunning_loss += loss_G.item()
+    optimizer_G.step()
 
-        Drunning_loss += loss_D.item()
-        
-    return Drunning_loss/(en+1),Grunning_loss/(en+1)
+
+
+    ###### Discriminator W ######
+    optimizer_D_w.zero_grad()
+
+    # Real loss
+    loss_D_real = criterion_GAN(Dnet_w(a), valid)
+
+    # Fake loss
+    loss_D_fake = criterion_GAN(Dnet_w(Gout_sw.detach()), fake)
+
+    # Total loss
+    loss_D_w = (loss_D_real + loss_D_fake)*0.5
+    loss_D_w.backward()
+
+    optimizer_D_w.step()
+
+    ###################################
+
+    ###### Discriminator B ######
+    optimizer_D_s.zero_grad()
+
+    # Real loss
+    loss_D_real = criterion_GAN(Dnet_s(b), valid)
+
+    # Fake loss
+    loss_D_fake = criterion_GAN(Dnet_s(Gout_ws.detach()), fake)
+
+    # Total loss
+    loss_D_s = (loss_D_real + loss_D_fake)*0.5
+    loss_D_s.backward()
+
+    optimizer_D_s.step()
+    ###################################
+
+    return OrderedDict([('D_S loss', loss_D_s), ('D_W loss', loss_D_w), ('G loss', loss_G)])
     
 
+# Validation step on a group of utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
+    n = lengths[0]
+
+    ###### Generators W2S and S2W ######
+
+    # GAN loss
+    Gout_ws = Gnet_ws(a)
+    fake_s = Dnet_s(Gout_ws)
+    loss_GAN_W2S = utterance_loss(criterion_GAN, fake_s, constant(1.0, fake_s), n)
+
+    Gout_sw = Gnet_sw(b)
+    fake_w = Dnet_w(Gout_sw)
+    loss_GAN_S2W = utterance_loss(criterion_GAN, fake_w, constant(1.0, fake_w), n)
+
+    # Cycle loss
+    recovered_W = Gnet_sw(Gout_ws)
+    loss_cycle_WSW = utterance_loss(criterion_cycle, recovered_W, a, n)*10.0
+
+    recovered_S = Gnet_ws(Gout_sw)
+    loss_cycle_SWS = utterance_loss(criterion_cycle, recovered_S, b, n)*10.0
+
+    # Total loss
+    loss_G = loss_GAN_W2S + loss_GAN_S2W + loss_cycle_WSW + loss_cycle_SWS
+
+
+    ###### Discriminator W ######
+    real_w = Dnet_w(a)
+    loss_D_w = (utterance_loss(criterion_GAN, real_w, constant(1.0, real_w), n) + utterance_loss(criterion_GAN, fake_w, constant(0.0, fake_w), n))*0.5
+
+    ###### Discriminator B ######
+    real_s = Dnet_s(b)
+    loss_D_s = (utterance_loss(criterion_GAN, real_s, constant(1.0, real_s), n) + utterance_loss(criterion_GAN, fake_s, constant(0.0, fake_s), n))*0.5
+
+    ###################################
+    loss_D = loss_D_s + loss_D_w
+
+    return OrderedDict([('D_loss', loss_D), ('G_loss', loss_G)])
+
+
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-    dl_arr = []
-    gl_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(ep+1)))
-        
-        if (ep+1)%args.validation_interval==0:
-            dl,gl = validating(val_dataloader)
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
+    nets = OrderedDict([('gen_ws', Gnet_ws), ('gen_sw', Gnet_sw), ('dis_w', Dnet_w), ('dis_s', Dnet_s)])
+    saves = OrderedDict([('gen_ws', Gnet_ws)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D_w', optimizer_D_w), ('D_s', optimizer_D_s)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, saves, plots, cache, amp, jit, optimizers),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -224,7 +166,7 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path = args.test_folder
     dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
+    Gnet = jit.compile(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).eval(), dynamic=None)
 
     for i in dirs:
         
@@ -234,10 +176,13 @@ def do_testing():
         a = torch.from_numpy(d['foo'])
         a = Variable(a.type('torch.FloatTensor')).to(device)
         
-        Gout = Gnet(a)
+        with amp.autocast():
+            Gout = Gnet(a).float()
 
         savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
+    jit.save()
+
 
 if __name__ == '__main__':
 
@@ -256,33 +201,21 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/f0/", help="Checkpoint saving path for F0 features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/f0/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../results/mask/mcc/", help="Input whisper mcc features for testing")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
 
 
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -303,6 +236,10 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+
     # Initialization 
     if args.dnn_cnn == "dnn":
         Gnet_ws = dnn_generator(in_g, 1, 512, 512, 512).to(device)
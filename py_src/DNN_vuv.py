@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -15,7 +16,6 @@ import torchvision
 from torchvision import transforms, datasets, models
 from torch import Tensor
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -23,7 +23,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, standard_hooks, add_trainer_args, load_weights
+from evaluation import utterance_loss, group_size
 from networks import dnn
 from utils import *
 
@@ -31,69 +33,41 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    net.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step
+def train_step(a, b):
+    a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+    b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
-        optimizer.zero_grad()
-        out = net(a)
-        loss = bce_loss(out, b)
-        
-        loss.backward()
-        optimizer.step()
+    optimizer.zero_grad()
+    out = net(a)
+    loss = bce_loss(out, b)
 
-        print ("[Epoch: %d] [Iter: %d/%d] [Loss: %f]" % (n_epochs, en, len(data_loader), loss.cpu().data.numpy()))
-    
+    loss.backward()
+    optimizer.step()
 
-# Validation function
-def validating(data_loader):
-    net.eval()
-    running_loss = 0
+    return OrderedDict([('Loss', loss)])
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
 
-        out = net(a)
-        loss = bce_loss(out, b)
+# Validation step on a group of utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
 
-        running_loss += loss.item()
-        
-    return running_loss/(en+1)
+    out = net(a)
+    loss = utterance_loss(bce_loss, out, b, lengths[0])
 
+    return OrderedDict([('loss', loss)])
 
 
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-    dl_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(net, join(checkpoint,"net_Ep_{}.pth".format(ep+1)))
-        
-        if (ep+1)%args.validation_interval==0:
-            dl = validating(val_dataloader)
-            print("loss: " + str(dl))
-            dl_arr.append(dl)
-
-
-            if ep == 0:
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='DNN'))
-            else:
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('loss.mat'),  mdict={'foo': dl_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/loss.png')
+    nets = OrderedDict([('net', net)])
+    plots = [('loss', 'DNN', 'loss')]
 
+    optimizers = OrderedDict([('net', optimizer)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, nets, plots, cache, amp, jit, optimizers),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -106,7 +80,8 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path = args.test_folder
     dirs = listdir(test_folder_path)
-    net = torch.load(join(checkpoint,"net_Ep_{}.pth".format(args.test_epoch))).to(device)
+    load_weights(net, join(checkpoint,"net_Ep_{}.pth".format(args.test_epoch)))
+    jit.compile(net.eval(), dynamic=None)
 
     for i in dirs:
         
@@ -116,10 +91,13 @@ def do_testing():
         a = torch.from_numpy(d['foo'])
         a = Variable(a.type('torch.FloatTensor')).to(device)
         
-        Gout = net(a)
+        with amp.autocast():
+            Gout = net(a).float()
 
         savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
+    jit.save()
+
 
 if __name__ == '__main__':
 
@@ -138,31 +116,20 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/vuv/", help="Checkpoint saving path for VUV features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/vuv/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../results/mask/mcc/", help="Input whisper mcc features for testing")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-    # Training Data path
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -174,6 +141,10 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+
 
     # Initialization 
     if args.dnn_cnn == "dnn":
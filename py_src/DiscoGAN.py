@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -16,7 +17,6 @@ from torchvision import transforms, datasets, models
 from torch import Tensor
 import itertools
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -24,7 +24,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, phase_timer, standard_hooks, add_trainer_args, load_weights
+from evaluation import evaluate, segment_mean, utterance_loss, constant, group_size, checkpoint_epochs, sweep
 from networks import dnn_generator, dnn_discriminator
 from utils import *
 
@@ -32,166 +34,111 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet_ws.train()
-    Gnet_sw.train()
-    Dnet_w.train()
-    Dnet_s.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step: both generators, then both discriminators
+def train_step(a, b):
+    with timer('copy'):
+        a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+        b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
         valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
         fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        # Update G network
-        optimizer_G.zero_grad()
+
+    # Update G network
+    optimizer_G.zero_grad()
+    with timer('G forward'):
         Gout_s = Gnet_ws(a)
         Gout_w = Gnet_sw(b)
         Gout_rec_w = Gnet_sw(Gout_s)
         Gout_rec_s = Gnet_ws(Gout_w)
-        
+
         # Reconstruction Loss
         G_re_loss_w = mmse_loss(Gout_rec_w, a)
         G_re_loss_s = mmse_loss(Gout_rec_s, b)
-        
+
         G_loss_ws = adversarial_loss(Dnet_s(Gout_s), valid) + mmse_loss(Gout_s, b) + G_re_loss_w
         G_loss_sw = adversarial_loss(Dnet_w(Gout_w), valid) + mmse_loss(Gout_w, a) + G_re_loss_s
-        
+
         G_loss = G_loss_ws + G_loss_sw
-        
+
+    with timer('G backward'):
         G_loss.backward()
+    with timer('G step'):
         optimizer_G.step()
 
 
-        # Update D network
-        optimizer_D.zero_grad()
+    # Update D network
+    optimizer_D.zero_grad()
 
-        # Measure discriminator's ability to classify real from generated samples
+    # Measure discriminator's ability to classify real from generated samples
+    with timer('D forward'):
         real_loss_s = adversarial_loss(Dnet_s(b), valid)
         fake_loss_s = adversarial_loss(Dnet_s(Gout_s.detach()), fake)
         D_loss_s = (real_loss_s + fake_loss_s) / 2
-        
+
         real_loss_w = adversarial_loss(Dnet_w(a), valid)
         fake_loss_w = adversarial_loss(Dnet_w(Gout_w.detach()), fake)
         D_loss_w = (real_loss_w + fake_loss_w) / 2
 
         D_loss = D_loss_w + D_loss_s
 
+    with timer('D backward'):
         D_loss.backward()
+    with timer('D step'):
         optimizer_D.step()
-        
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), D_loss, G_loss.cpu().data.numpy()))
-
-
-# Validation function
-def validating(data_loader):
-    Gnet_ws.eval()
-    Gnet_sw.eval()
-    Dnet_w.eval()
-    Dnet_s.eval()
-    Grunning_loss = 0
-    Drunning_loss = 0
-    mcd_values = []
+
+
+    return OrderedDict([('D loss', D_loss), ('G loss', G_loss)])
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        # optimizer_G.zero_grad()
-        Gout_s = Gnet_ws(a)
-        Gout_w = Gnet_sw(b)
-        Gout_rec_w = Gnet_sw(Gout_s)
-        Gout_rec_s = Gnet_ws(Gout_w)
-        
-        # Reconstruction Loss
-        G_re_loss_w = mmse_loss(Gout_rec_w, a)
-        G_re_loss_s = mmse_loss(Gout_rec_s, b)
-        
-        G_loss_ws = adversarial_loss(Dnet_s(Gout_s), valid) + mmse_loss(Gout_s, b) + G_re_loss_w
-        G_loss_sw = adversarial_loss(Dnet_w(Gout_w), valid) + mmse_loss(Gout_w, a) + G_re_loss_s
-        
-        G_loss = G_loss_ws + G_loss_sw
+# Validation step on a group of utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
+    n = lengths[0]
 
-        Grunning_loss += G_loss.item()
+    Gout_s = Gnet_ws(a)
+    Gout_w = Gnet_sw(b)
+    Gout_rec_w = Gnet_sw(Gout_s)
+    Gout_rec_s = Gnet_ws(Gout_w)
 
-        # Measure discriminator's ability to classify real from generated samples
-        real_loss_s = adversarial_loss(Dnet_s(b), valid)
-        fake_loss_s = adversarial_loss(Dnet_s(Gout_s.detach()), fake)
-        D_loss_s = (real_loss_s + fake_loss_s) / 2
-        
-        real_loss_w = adversarial_loss(Dnet_w(a), valid)
-        fake_loss_w = adversarial_loss(Dnet_w(Gout_w.detach()), fake)
-        D_loss_w = (real_loss_w + fake_loss_w) / 2
+    # Reconstruction Loss
+    G_re_loss_w = utterance_loss(mmse_loss, Gout_rec_w, a, n)
+    G_re_loss_s = utterance_loss(mmse_loss, Gout_rec_s, b, n)
 
-        D_loss = D_loss_w + D_loss_s
-        
-        Drunning_loss += D_loss.item()
+    fake_s = Dnet_s(Gout_s)
+    fake_w = Dnet_w(Gout_w)
+    G_loss_ws = utterance_loss(adversarial_loss, fake_s, constant(1.0, fake_s), n) + utterance_loss(mmse_loss, Gout_s, b, n) + G_re_loss_w
+    G_loss_sw = utterance_loss(adversarial_loss, fake_w, constant(1.0, fake_w), n) + utterance_loss(mmse_loss, Gout_w, a, n) + G_re_loss_s
+
+    G_loss = G_loss_ws + G_loss_sw
 
-        # Calculate MCD
-        b_np = b.cpu().data.numpy()
-        Gout_np = Gout_s.cpu().data.numpy()
-        mcd = np.mean([logSpecDbDist(Gout_np[i][1:], b_np[i][1:]) for i in range(len(b_np))])
-        mcd_values.append(mcd)
-    
-    avg_mcd = np.mean(mcd_values)
-        
-    return Drunning_loss/(en+1),Grunning_loss/(en+1), avg_mcd
 
+    # Measure discriminator's ability to classify real from generated samples
+    real_s = Dnet_s(b)
+    D_loss_s = (utterance_loss(adversarial_loss, real_s, constant(1.0, real_s), n) + utterance_loss(adversarial_loss, fake_s, constant(0.0, fake_s), n)) / 2
 
+    real_w = Dnet_w(a)
+    D_loss_w = (utterance_loss(adversarial_loss, real_w, constant(1.0, real_w), n) + utterance_loss(adversarial_loss, fake_w, constant(0.0, fake_w), n)) / 2
 
+    D_loss = D_loss_w + D_loss_s
+
+
+    # Calculate MCD
+    mcd = segment_mean(batch_mcd(Gout_s[:, 1:], b[:, 1:], 'none'), n)
+
+    return OrderedDict([('D_loss', D_loss), ('G_loss', G_loss), ('MCD', mcd)])
+
+
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-
-    dl_arr = []
-    gl_arr = []
-    mcd_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(ep+1)))
-
-
-        if (ep+1)%args.validation_interval==0:
-            dl,gl,mcd = validating(val_dataloader)
-            
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            mcd_arr.append(mcd)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-                mplot = viz.line(Y=np.array([mcd]), X=np.array([ep]), opts=dict(title='MCD'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-                viz.line(Y=np.array([mcd]), X=np.array([ep]), win=mplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-    savemat(checkpoint+"/"+str('mcd.mat'),  mdict={'foo': mcd_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
-    plt.figure(3)
-    plt.plot(mcd_arr)
-    plt.savefig(checkpoint+'/mcd.png')
+    nets = OrderedDict([('gen_ws', Gnet_ws), ('gen_sw', Gnet_sw), ('dis_w', Dnet_w), ('dis_s', Dnet_s)])
+    saves = OrderedDict([('gen_ws', Gnet_ws)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss'), ('MCD', 'MCD', 'mcd')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D', optimizer_D)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, saves, plots, cache, amp, jit, optimizers, timer),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -204,20 +151,23 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path=args.test_folder
 
-    dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
+    dirs = read_mcc_folder(test_folder_path)
+    Gnet = jit.compile(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).eval())
 
-    for i in dirs:
+    for i, d in dirs.items():
         
-        # Load the .mcc file
-        d = read_mcc(join(test_folder_path, i))
+        # Frames are converted independently, so long .mcc files are mapped and converted chunk-wise
+        Gout = []
+        frames = jit.chunk_frames(args.chunk_frames)
+        for chunk in mcc_chunks(d, frames):
+            a = torch.from_numpy(jit.pad(chunk, frames)).to(device)
+            with amp.autocast():
+                Gout.append(Gnet(a)[:len(chunk)].float().cpu().data.numpy())
 
-        a = torch.from_numpy(d)
-        a = Variable(a.squeeze(0).type('torch.FloatTensor')).to(device)
-        
-        Gout = Gnet(a)
+        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': np.concatenate(Gout)})
+
+    jit.save()
 
-        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
 
 '''
@@ -225,24 +175,28 @@ Check MCD value on validation data for now! :)
 '''
 
 
-def give_MCD():
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
-    mcd = []
+# MCD of a generator on a group of validation utterances (see evaluation.py)
+def mcd_step(Gnet):
+    def step(a, b, lengths):
+        Gout = Gnet(a.to(device))
+        return OrderedDict([('MCD', segment_mean(batch_mcd(Gout[:, 1:], b.to(device)[:, 1:], 'none'), lengths[0]))])
+    return step
 
-    for en, (a, b) in enumerate(val_dataloader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = b.cpu().data.numpy()[0]
-
-        Gout = Gnet(a).cpu().data.numpy()
+def give_MCD():
+    Gnet = load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch)), clone=True)
+    Gnet.eval()
 
-        ans = 0
-        for k in range(Gout.shape[0]):
-            ans = logSpecDbDist(Gout[k][1:],b[k][1:])
-            mcd.append(ans)
+    # Mean over all frames; the per-utterance values are returned
+    utterances, _ = evaluate(val_dataloader, mcd_step(Gnet), group_size(args.eval_group, device))
+    print(np.average(utterances['MCD'], weights=utterances['frames']))
+    return utterances
 
-    mcd = np.array(mcd)
-    print(np.mean(mcd))
 
+# Ranks the MCD of every saved generator in one pass over the validation set (written to mcd_sweep.csv)
+def sweep_MCD():
+    load = lambda epoch: mcd_step(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(epoch)), clone=True).eval())
+    sweep(val_dataloader, checkpoint_epochs(checkpoint, ['gen_ws']), load, 'MCD', join(checkpoint, 'mcd_sweep.csv'),
+          group_size(args.eval_group, device), models=args.sweep_models)
 
 if __name__ == '__main__':
     
@@ -252,6 +206,8 @@ if __name__ == '__main__':
     parser.add_argument("-tr", "--train", action="store_true", help="Want to train?")
     parser.add_argument("-te", "--test", action="store_true", help="Want to test?")
     parser.add_argument("-m", "--mcd", action="store_true", help="Want MCD value?")
+    parser.add_argument("-sw", "--sweep", action="store_true", help="Rank the MCD of every saved checkpoint in one pass over the validation data?")
+    parser.add_argument("-sm", "--sweep_models", type=int, default=0, help="Checkpoints evaluated together by the sweep (0 for all)")
     parser.add_argument("-ci", "--checkpoint_interval", type=int, default=5, help="Checkpoint interval")
     parser.add_argument("-e", "--epoch", type=int, default=100, help="Number of Epochs")
     parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epochs to test")
@@ -262,32 +218,22 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Checkpoint saving path for MCC features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../dataset/features/US_102/Whisper/mcc/", help="Input whisper mcc features for testing")
+    parser.add_argument("-cs", "--chunk_frames", type=int, default=0, help="Frames per chunk when converting test files (0 converts whole files)")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -306,6 +252,11 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing, phase times of training (-pt)
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+    timer = phase_timer(args.phase_times, device)
+
     print("Device: ", device)
 
     # Initialization
@@ -328,4 +279,6 @@ if __name__ == '__main__':
     if args.test:
         do_testing()
     if args.mcd:
-        give_MCD()
\ No newline at end of file
+        give_MCD()
+    if args.sweep:
+        sweep_MCD()
\ No newline at end of file
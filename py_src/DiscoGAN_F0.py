@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -16,7 +17,6 @@ from torchvision import transforms, datasets, models
 from torch import Tensor
 import itertools
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -24,7 +24,9 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, standard_hooks, add_trainer_args, load_weights
+from evaluation import utterance_loss, constant, group_size
 from networks import dnn_generator, dnn_discriminator
 from utils import *
 
@@ -32,144 +34,100 @@ import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet_ws.train()
-    Gnet_sw.train()
-    Dnet_w.train()
-    Dnet_s.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step: both generators, then both discriminators
+def train_step(a, b):
+    a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+    b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        # Update G network
-        optimizer_G.zero_grad()
-        Gout_s = Gnet_ws(a)
-        Gout_w = Gnet_sw(b)
-        Gout_rec_w = Gnet_sw(Gout_s)
-        Gout_rec_s = Gnet_ws(Gout_w)
-        
-        # Reconstruction Loss
-        G_re_loss_w = mmse_loss(Gout_rec_w, a)
-        G_re_loss_s = mmse_loss(Gout_rec_s, b)
-        
-        G_loss_ws = adversarial_loss(Dnet_s(Gout_s), valid) + mmse_loss(Gout_s, b) + G_re_loss_w
-        G_loss_sw = adversarial_loss(Dnet_w(Gout_w), valid) + mmse_loss(Gout_w, a) + G_re_loss_s
-        
-        G_loss = G_loss_ws + G_loss_sw
-        
-        G_loss.backward()
-        optimizer_G.step()
+    valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
+    fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
 
+    # Update G network
+    optimizer_G.zero_grad()
+    Gout_s = Gnet_ws(a)
+    Gout_w = Gnet_sw(b)
+    Gout_rec_w = Gnet_sw(Gout_s)
+    Gout_rec_s = Gnet_ws(Gout_w)
 
-        # Update D network
-        optimizer_D.zero_grad()
+    # Reconstruction Loss
+    G_re_loss_w = mmse_loss(Gout_rec_w, a)
+    G_re_loss_s = mmse_loss(Gout_rec_s, b)
 
-        # Measure discriminator's ability to classify real from generated samples
-        real_loss_s = adversarial_loss(Dnet_s(b), valid)
-        fake_loss_s = adversarial_loss(Dnet_s(Gout_s.detach()), fake)
-        D_loss_s = (real_loss_s + fake_loss_s) / 2
-        
-        real_loss_w = adversarial_loss(Dnet_w(a), valid)
-        fake_loss_w = adversarial_loss(Dnet_w(Gout_w.detach()), fake)
-        D_loss_w = (real_loss_w + fake_loss_w) / 2
+    G_loss_ws = adversarial_loss(Dnet_s(Gout_s), valid) + mmse_loss(Gout_s, b) + G_re_loss_w
+    G_loss_sw = adversarial_loss(Dnet_w(Gout_w), valid) + mmse_loss(Gout_w, a) + G_re_loss_s
 
-        D_loss = D_loss_w + D_loss_s
+    G_loss = G_loss_ws + G_loss_sw
 
-        D_loss.backward()
-        optimizer_D.step()
-        
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), D_loss, G_loss.cpu().data.numpy()))
-    
+    G_loss.backward()
+    optimizer_G.step()
 
-# Validation function
-def validating(data_loader):
-    Gnet_ws.eval()
-    Gnet_sw.eval()
-    Dnet_w.eval()
-    Dnet_s.eval()
-    Grunning_loss = 0
-    Drunning_loss = 0
+
+    # Update D network
+    optimizer_D.zero_grad()
+
+    # Measure discriminator's ability to classify real from generated samples
+    real_loss_s = adversarial_loss(Dnet_s(b), valid)
+    fake_loss_s = adversarial_loss(Dnet_s(Gout_s.detach()), fake)
+    D_loss_s = (real_loss_s + fake_loss_s) / 2
+
+    real_loss_w = adversarial_loss(Dnet_w(a), valid)
+    fake_loss_w = adversarial_loss(Dnet_w(Gout_w.detach()), fake)
+    D_loss_w = (real_loss_w + fake_loss_w) / 2
+
+    D_loss = D_loss_w + D_loss_s
+
+    D_loss.backward()
+    optimizer_D.step()
+
+
+    return OrderedDict([('D loss', D_loss), ('G loss', G_loss)])
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        Gout_s = Gnet_ws(a)
-        Gout_w = Gnet_sw(b)
-        Gout_rec_w = Gnet_sw(Gout_s)
-        Gout_rec_s = Gnet_ws(Gout_w)
-        
-        # Reconstruction Loss
-        G_re_loss_w = mmse_loss(Gout_rec_w, a)
-        G_re_loss_s = mmse_loss(Gout_rec_s, b)
-        
-        G_loss_ws = adversarial_loss(Dnet_s(Gout_s), valid) + mmse_loss(Gout_s, b) + G_re_loss_w
-        G_loss_sw = adversarial_loss(Dnet_w(Gout_w), valid) + mmse_loss(Gout_w, a) + G_re_loss_s
-        
-        G_loss = G_loss_ws + G_loss_sw
+# Validation step on a group of utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
+    n = lengths[0]
 
-        Grunning_loss += G_loss.item()
+    Gout_s = Gnet_ws(a)
+    Gout_w = Gnet_sw(b)
+    Gout_rec_w = Gnet_sw(Gout_s)
+    Gout_rec_s = Gnet_ws(Gout_w)
 
-        # Measure discriminator's ability to classify real from generated samples
-        real_loss_s = adversarial_loss(Dnet_s(b), valid)
-        fake_loss_s = adversarial_loss(Dnet_s(Gout_s.detach()), fake)
-        D_loss_s = (real_loss_s + fake_loss_s) / 2
-        
-        real_loss_w = adversarial_loss(Dnet_w(a), valid)
-        fake_loss_w = adversarial_loss(Dnet_w(Gout_w.detach()), fake)
-        D_loss_w = (real_loss_w + fake_loss_w) / 2
+    # Reconstruction Loss
+    G_re_loss_w = utterance_loss(mmse_loss, Gout_rec_w, a, n)
+    G_re_loss_s = utterance_loss(mmse_loss, Gout_rec_s, b, n)
 
-        D_loss = D_loss_w + D_loss_s
-        
-        Drunning_loss += D_loss.item()
-        
-    return Drunning_loss/(en+1),Grunning_loss/(en+1)
+    fake_s = Dnet_s(Gout_s)
+    fake_w = Dnet_w(Gout_w)
+    G_loss_ws = utterance_loss(adversarial_loss, fake_s, constant(1.0, fake_s), n) + utterance_loss(mmse_loss, Gout_s, b, n) + G_re_loss_w
+    G_loss_sw = utterance_loss(adversarial_loss, fake_w, constant(1.0, fake_w), n) + utterance_loss(mmse_loss, Gout_w, a, n) + G_re_loss_s
+
+    G_loss = G_loss_ws + G_loss_sw
+
+
+    # Measure discriminator's ability to classify real from generated samples
+    real_s = Dnet_s(b)
+    D_loss_s = (utterance_loss(adversarial_loss, real_s, constant(1.0, real_s), n) + utterance_loss(adversarial_loss, fake_s, constant(0.0, fake_s), n)) / 2
+
+    real_w = Dnet_w(a)
+    D_loss_w = (utterance_loss(adversarial_loss, real_w, constant(1.0, real_w), n) + utterance_loss(adversarial_loss, fake_w, constant(0.0, fake_w), n)) / 2
 
+    D_loss = D_loss_w + D_loss_s
 
+    return OrderedDict([('D_loss', D_loss), ('G_loss', G_loss)])
 
+
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-    dl_arr = []
-    gl_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(ep+1)))
-        
-        if (ep+1)%args.validation_interval==0:
-            dl,gl = validating(val_dataloader)
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
+    nets = OrderedDict([('gen_ws', Gnet_ws), ('gen_sw', Gnet_sw), ('dis_w', Dnet_w), ('dis_s', Dnet_s)])
+    saves = OrderedDict([('gen_ws', Gnet_ws)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D', optimizer_D)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, saves, plots, cache, amp, jit, optimizers),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -181,7 +139,7 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path = args.test_folder
     dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).to(device)
+    Gnet = jit.compile(load_weights(Gnet_ws, join(checkpoint,"gen_ws_Ep_{}.pth".format(args.test_epoch))).eval(), dynamic=None)
 
     for i in dirs:
         
@@ -191,10 +149,13 @@ def do_testing():
         a = torch.from_numpy(d['foo'])
         a = Variable(a.type('torch.FloatTensor')).to(device)
         
-        Gout = Gnet(a)
+        with amp.autocast():
+            Gout = Gnet(a).float()
 
         savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
+    jit.save()
+
 
 if __name__ == '__main__':
 
@@ -213,33 +174,21 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/f0/", help="Checkpoint saving path for F0 features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/f0/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../results/mask/mcc/", help="Input whisper mcc features for testing")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
 
 
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -258,6 +207,10 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+
     # Initialization 
     if args.dnn_cnn == "dnn":
         Gnet_ws = dnn_generator(ip_g, 1, 512, 512, 512).to(device)
@@ -1,6 +1,7 @@
 import numpy as np
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -15,7 +16,6 @@ import torchvision
 from torchvision import transforms, datasets, models
 from torch import Tensor
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -23,133 +23,87 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
-from networks import inception_generator, inception_discriminator
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, standard_hooks, add_trainer_args, load_weights
+from evaluation import evaluate, segment_mean, utterance_loss, constant, group_size, checkpoint_epochs, sweep
+from networks import inception_generator, inception_discriminator, pooled_inception_discriminator, frame_mask, direct_convs
 from utils import *
 
 import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet.train()
-    Dnet.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.unsqueeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.unsqueeze(0).type(torch.FloatTensor)).to(device)
+# The pooled discriminator (-pd) only looks at the real frames of length-bucketed batches (-bf)
+def discriminate(x, lengths):
+    if lengths is None:
+        return Dnet(x)
+    return Dnet(x, lengths)
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        optimizer_G.zero_grad()
 
-        Gout = Gnet(a)
-        G_loss = adversarial_loss(Dnet(Gout), valid)*5
-        
-        G_loss.backward()
-        optimizer_G.step()
-                
-        optimizer_D.zero_grad()
-
-        # Measure discriminator's ability to classify real from generated samples
-        real_loss = adversarial_loss(Dnet(b), valid)
-        fake_loss = adversarial_loss(Dnet(Gout.detach()), fake)
-        D_loss = (real_loss + fake_loss)/2
-
-        D_loss.backward()
-        optimizer_D.step()
-
-        print ("[Epoch: %d] [Iter: %d/%d] [D loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), D_loss, G_loss.cpu().data.numpy()))
-
-# Validation function
-def validating(data_loader):
-    Gnet.eval()
-    Dnet.eval()
-    G_running_loss = 0
-    D_running_loss = 0
-    mcd_values = []
+# One training step: G update followed by D update. Batches are one .mat file, or with -bf several utterances
+# zero-padded to the longest one, whose frames are given by lengths
+def train_step(a, b, lengths=None):
+    a = Variable(a.unsqueeze(1).type(torch.FloatTensor)).to(device)
+    b = Variable(b.unsqueeze(1).type(torch.FloatTensor)).to(device)
+
+    valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
+    fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.unsqueeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.unsqueeze(0).type(torch.FloatTensor)).to(device)
+    optimizer_G.zero_grad()
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        Gout = Gnet(a)
-        G_loss = adversarial_loss(Dnet(Gout), valid)
+    Gout = Gnet(a)
+    if lengths is not None:
+        # Generated frames in the padding are zeroed like those of the real batch
+        Gout = Gout * frame_mask(lengths, Gout)
+    G_loss = adversarial_loss(discriminate(Gout, lengths), valid)*5
+    
+    G_loss.backward()
+    optimizer_G.step()
+            
+    optimizer_D.zero_grad()
 
-        G_running_loss += G_loss.item()
+    # Measure discriminator's ability to classify real from generated samples
+    real_loss = adversarial_loss(discriminate(b, lengths), valid)
+    fake_loss = adversarial_loss(discriminate(Gout.detach(), lengths), fake)
+    D_loss = (real_loss + fake_loss)/2
 
-        # Measure discriminator's ability to classify real from generated samples
-        real_loss = adversarial_loss(Dnet(b), valid)
-        fake_loss = adversarial_loss(Dnet(Gout.detach()), fake)
-        D_loss = (real_loss + fake_loss)/2
-        
-        D_running_loss += D_loss.item()
-
-        #     # Calculate MCD
-        b_np = b.cpu().data.numpy()
-        b_np = b_np.squeeze(0)[0]
-        Gout_np = Gout.cpu().data.numpy()
-        Gout_np = Gout_np.squeeze(0).squeeze(0)
-        mcd = np.mean([logSpecDbDist(Gout_np[i][1:], b_np[i][1:]) for i in range(len(b_np))])
-        mcd_values.append(mcd)
-    
-    avg_mcd = np.mean(mcd_values)
-    
-    return D_running_loss/(en+1), G_running_loss/(en+1), avg_mcd
+    D_loss.backward()
+    optimizer_D.step()
 
+    return OrderedDict([('D loss', D_loss), ('G loss', G_loss)])
 
+# Validation step on a group of stacked utterances (see evaluation.py)
+def val_step(a, b, lengths):
+    a = a.unsqueeze(1).to(device)
+    b = b.unsqueeze(1).to(device)
+    n = [1]*len(a)
 
-def do_training():
-    epoch = args.epoch
+    Gout = Gnet(a)
+    fake_out = Dnet(Gout)
+    G_loss = utterance_loss(adversarial_loss, fake_out, constant(1.0, fake_out), n)
 
-    dl_arr = []
-    gl_arr = []
-    mcd_arr = []
-    for ep in range(epoch):
+    # Measure discriminator's ability to classify real from generated samples
+    real_out = Dnet(b)
+    real_loss = utterance_loss(adversarial_loss, real_out, constant(1.0, real_out), n)
+    fake_loss = utterance_loss(adversarial_loss, fake_out, constant(0.0, fake_out), n)
+    D_loss = (real_loss + fake_loss)/2
 
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(ep+1)))
-            torch.save(Dnet, join(checkpoint,"dis_g_1_d_1_Ep_{}.pth".format(ep+1)))
+    # Calculate MCD
+    mcd = segment_mean(batch_mcd(Gout[..., 1:], b[..., 1:], 'none').flatten(), lengths[1])
+    
+    return OrderedDict([('D_loss', D_loss), ('G_loss', G_loss), ('MCD', mcd)])
 
 
-        if (ep+1)%args.validation_interval==0:
-            dl,gl,mcd = validating(val_dataloader)
-            
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            mcd_arr.append(mcd)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-                mplplot = viz.line(Y=np.array([mcd]), X=np.array([ep]), opts=dict(title='MCD'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-                viz.line(Y=np.array([mcd]), X=np.array([ep]), win=mplplot, update='append')
-            
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-    savemat(checkpoint+"/"+str('mcd.mat'),  mdict={'foo': mcd_arr})
 
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
-    plt.figure(3)
-    plt.plot(mcd_arr)
-    plt.savefig(checkpoint+'/mcd.png')
+# Training loop, checkpoints and plots are run by trainer.py
+def do_training():
+    nets = OrderedDict([('gen_g_1_d_1', Gnet), ('dis_g_1_d_1', Dnet)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss'), ('MCD', 'MCD', 'mcd')]
 
+    optimizers = OrderedDict([('G', optimizer_G), ('D', optimizer_D)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, nets, plots, cache, amp, jit, optimizers),
+                     eval_group=group_size(args.eval_group, device), eval_stack=True)
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -162,65 +116,66 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path=args.test_folder
 
-    dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch))).to(device)
+    dirs = read_mcc_folder(test_folder_path)
+    load_weights(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch)))
+    net = jit.compile(direct_convs(Gnet).eval(), dynamic=None)
 
-    for i in dirs:
-        
-        # Load the .mcc file
-        d = read_mcc(join(test_folder_path, i))
+    for i, d in dirs.items():
 
         a = torch.from_numpy(d)
         a = Variable(a.unsqueeze(0).unsqueeze(0).type('torch.FloatTensor')).to(device)
         
-        Gout = Gnet(a)
+        with amp.autocast():
+            Gout = net(a).float()
 
         Gout = Gout.squeeze(0).squeeze(0)
 
         savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
 
+    jit.save()
+
+
 
 '''
 Check MCD value on validation data for now! :)
 '''
 
 
-def give_MCD():
-    Gnet = torch.load(join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch))).to(device)
-    mcd = []
-
-    for en, (a, b) in enumerate(val_dataloader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        # print("Shape of a (input to generator):", a.shape)  # Expected: (1000, 40)
-        
-        b = b.cpu().data.numpy()[0]
-        # print("Shape of b (ground truth):", b.shape)  # Expected: (1000, 40)
-
-        # Get output from generator
-        Gout = Gnet(a.unsqueeze(0).unsqueeze(0)).cpu().data.numpy()
-        # print("Shape of Gout (raw output from generator):", Gout.shape)  # Expected: (1, 1, 1000, 40)
+# MCD of a generator on a group of stacked validation utterances (see evaluation.py);
+# they form one batch of (1, frames, 40) images
+def mcd_step(Gnet):
+    def step(a, b, lengths):
+        Gout = Gnet(a.unsqueeze(1).to(device)).squeeze(1)
+        return OrderedDict([('MCD', segment_mean(batch_mcd(Gout[..., 1:], b.to(device)[..., 1:], 'none').flatten(), lengths[0]))])
+    return step
 
-        # Reshape Gout to (1000, 40)
-        Gout = Gout.squeeze(0).squeeze(0)
-        # print("Shape of Gout (reshaped):", Gout.shape)  # Expected: (1000, 40)
+def give_MCD():
+    load_weights(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(args.test_epoch)))
 
-        # Calculate MCD
-        for k in range(Gout.shape[0]):
-            ans = logSpecDbDist(Gout[k][1:], b[k][1:])
-            mcd.append(ans)
+    # Mean over all frames; the per-utterance values are returned
+    utterances, _ = evaluate(val_dataloader, mcd_step(direct_convs(Gnet).eval()), group_size(args.eval_group, device), stack=True)
+    print("Mean MCD:", np.average(utterances['MCD'], weights=utterances['frames']))
+    return utterances
 
-    mcd = np.array(mcd)
-    print("Mean MCD:", np.mean(mcd))
 
+# Ranks the MCD of every saved generator in one pass over the validation set (written to mcd_sweep.csv)
+def sweep_MCD():
+    load = lambda epoch: mcd_step(direct_convs(load_weights(Gnet, join(checkpoint,"gen_g_1_d_1_Ep_{}.pth".format(epoch)))).eval())
+    sweep(val_dataloader, checkpoint_epochs(checkpoint, ['gen_g_1_d_1']), load, 'MCD', join(checkpoint, 'mcd_sweep.csv'),
+          group_size(args.eval_group, device), stack=True, models=args.sweep_models)
 
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description="Training methodology for Whisper-to-Normal Speech Conversion")
     parser.add_argument("-np", "--nonparallel", type=bool, default=False, help="Parallel training or non-parallel?")
     parser.add_argument("-dc", "--dnn_cnn", type=str, default='inception', help="DNN or CNN architecture for generator and discriminator?")
+    parser.add_argument("-fi", "--fused_inception", action="store_true", help="Inception blocks with one merged 1x1 projection (same weights and checkpoints)?")
+    parser.add_argument("-pd", "--pooled_discriminator", action="store_true", help="Discriminator with a global pooling head for any number of frames (own checkpoints)?")
     parser.add_argument("-tr", "--train", action="store_true", help="Want to train?")
     parser.add_argument("-te", "--test", action="store_true", help="Want to test?")
     parser.add_argument("-m", "--mcd", action="store_true", help="Want MCD value?")
+    parser.add_argument("-sw", "--sweep", action="store_true", help="Rank the MCD of every saved checkpoint in one pass over the validation data?")
+    parser.add_argument("-sm", "--sweep_models", type=int, default=0, help="Checkpoints evaluated together by the sweep (0 for all)")
     parser.add_argument("-ci", "--checkpoint_interval", type=int, default=5, help="Checkpoint interval")
     parser.add_argument("-e", "--epoch", type=int, default=100, help="Number of Epochs")
     parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epochs to test")
@@ -231,32 +186,23 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Checkpoint saving path for MCC features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../dataset/features/US_102/Whisper/mcc/", help="Input whisper mcc features for testing")
+    add_pipeline_args(parser, frame_batching=False, length_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
+    if args.bucket_frames > 0 and not args.pooled_discriminator:
+        parser.error("-bf needs the pooled discriminator (-pd): the 1000x40 one only takes 1000 frames")
 
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=mainfolder)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, mainfolder)
 
 
     # Loss Functions
@@ -270,10 +216,15 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache, dynamic=None if args.pooled_discriminator else False)
+
     # Initialization
     if args.dnn_cnn == "inception":
-        Gnet = inception_generator().to(device)
-        Dnet = inception_discriminator().to(device)
+        Gnet = inception_generator(args.fused_inception).to(device)
+        discriminator = pooled_inception_discriminator if args.pooled_discriminator else inception_discriminator
+        Dnet = discriminator(args.fused_inception).to(device)
 
 
     # Initialize the optimizers
@@ -286,3 +237,5 @@ if __name__ == '__main__':
         do_testing()
     if args.mcd:
         give_MCD()
+    if args.sweep:
+        sweep_MCD()
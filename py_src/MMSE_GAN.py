@@ -1,6 +1,8 @@
 import numpy as np
+import contextlib
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -15,7 +17,6 @@ import torchvision
 from torchvision import transforms, datasets, models
 from torch import Tensor
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -23,167 +24,133 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import parallel_dataloader, non_parallel_dataloader
-from networks import dnn_generator, dnn_discriminator
+from pipeline import add_pipeline_args, make_loaders
+from trainer import trainer, precision, compiler, phase_timer, standard_hooks, add_trainer_args, load_weights
+from evaluation import evaluate, segment_mean, utterance_loss, constant, group_size, checkpoint_epochs, sweep
+from networks import dnn_generator, dnn_discriminator, quantized_linear
 from utils import *
 
 import argparse
 
-# Training Function
-def training(data_loader, n_epochs):
-    Gnet.train()
-    Dnet.train()
-    
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+# One training step: G update followed by D update
+def train_step(a, b):
+    with timer('copy'):
+        a = Variable(a.view(-1, a.shape[-1]).type(torch.FloatTensor)).to(device)
+        b = Variable(b.view(-1, b.shape[-1]).type(torch.FloatTensor)).to(device)
 
         valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
         fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        # Update G network
-        optimizer_G.zero_grad()
+    
+    # Update G network
+    optimizer_G.zero_grad()
+    with timer('G forward'):
         Gout = Gnet(a)
-        
+    
         G_loss = adversarial_loss(Dnet(Gout), valid) + mmse_loss(Gout, b)
-        
+    
+    with timer('G backward'):
         G_loss.backward()
+    with timer('G step'):
         optimizer_G.step()
 
 
-        # Update D network
-        optimizer_D.zero_grad()
+    # Update D network
+    optimizer_D.zero_grad()
 
-        # Measure discriminator's ability to classify real from generated samples
+    # Measure discriminator's ability to classify real from generated samples
+    with timer('D forward'):
         real_loss = adversarial_loss(Dnet(b), valid)
         fake_loss = adversarial_loss(Dnet(Gout.detach()), fake)
         D_loss = (real_loss + fake_loss) / 2
-        
+    
+    with timer('D backward'):
         D_loss.backward()
+    with timer('D step'):
         optimizer_D.step()
-        
-        
-        print ("[Epoch: %d] [Iter: %d/%d] [D loss: %f] [G loss: %f]" % (n_epochs, en, len(data_loader), D_loss, G_loss.cpu().data.numpy()))
- 
-# Validation function that also calculates MCD
-def validating(data_loader):
-    Gnet.eval()
-    Dnet.eval()
-    Grunning_loss = 0
-    Drunning_loss = 0
-    mcd_values = []
     
-    for en, (a, b) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).to(device)
+    return OrderedDict([('D loss', D_loss), ('G loss', G_loss)])
+ 
+# Validation step on a group of utterances (see evaluation.py), also calculates MCD
+def val_step(a, b, lengths):
+    a = a.to(device)
+    b = b.to(device)
+    n = lengths[0]
 
-        valid = Variable(torch.Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).to(device)
-        fake = Variable(torch.Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).to(device)
-        
-        Gout = Gnet(a)
-        G_loss = adversarial_loss(Dnet(Gout), valid) + mmse_loss(Gout, b)
-        Grunning_loss += G_loss.item()
+    Gout = Gnet(a)
+    fake_out = Dnet(Gout)
+    G_loss = utterance_loss(adversarial_loss, fake_out, constant(1.0, fake_out), n) + utterance_loss(mmse_loss, Gout, b, n)
 
-        real_loss = adversarial_loss(Dnet(b), valid)
-        fake_loss = adversarial_loss(Dnet(Gout.detach()), fake)
-        D_loss = (real_loss + fake_loss) / 2
-        Drunning_loss += D_loss.item()
-        
-        # Calculate MCD
-        b_np = b.cpu().data.numpy()
-        Gout_np = Gout.cpu().data.numpy()
-        mcd = np.mean([logSpecDbDist(Gout_np[i][1:], b_np[i][1:]) for i in range(len(b_np))])
-        mcd_values.append(mcd)
-    
-    avg_mcd = np.mean(mcd_values)
-    # Update Visdom for MCD
-    # viz.line(Y=np.array([avg_mcd]), X=np.array([epoch]), win='mcd_plot', update='append' if epoch > 0 else 'replace', opts=dict(title='MCD by Epoch'))
-    return Drunning_loss/(en+1), Grunning_loss/(en+1), avg_mcd
+    real_out = Dnet(b)
+    real_loss = utterance_loss(adversarial_loss, real_out, constant(1.0, real_out), n)
+    fake_loss = utterance_loss(adversarial_loss, fake_out, constant(0.0, fake_out), n)
+    D_loss = (real_loss + fake_loss) / 2
+
+    # Calculate MCD
+    mcd = segment_mean(batch_mcd(Gout[:, 1:], b[:, 1:], 'none'), n)
+
+    return OrderedDict([('D_loss', D_loss), ('G_loss', G_loss), ('MCD', mcd)])
 
-# Training function updated to include MCD and maintain existing functionality
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-
-    dl_arr = []
-    gl_arr = []
-    mcd_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(Gnet, join(checkpoint,"gen_Ep_{}.pth".format(ep+1)))
-            torch.save(Dnet, join(checkpoint,"dis_Ep_{}.pth".format(ep+1)))
-
-
-        if (ep+1)%args.validation_interval==0:
-            dl,gl,mcd = validating(val_dataloader)
-            
-            print("D_loss: " + str(dl) + " G_loss: " + str(gl))
-            
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            mcd_arr.append(mcd)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Generator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-                mplot = viz.line(Y=np.array([mcd]), X=np.array([ep]), opts=dict(title='MCD'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-                viz.line(Y=np.array([mcd]), X=np.array([ep]), win=mplot, update='append')
-    
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('generator_loss.mat'),  mdict={'foo': gl_arr})
-    savemat(checkpoint+"/"+str('mcd.mat'),  mdict={'foo': mcd_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/generator_loss.png')
-    plt.figure(3)
-    plt.plot(mcd_arr)
-    plt.savefig(checkpoint+'/mcd.png')
+    nets = OrderedDict([('gen', Gnet), ('dis', Dnet)])
+    plots = [('D_loss', 'Discriminator', 'discriminator_loss'), ('G_loss', 'Generator', 'generator_loss'), ('MCD', 'MCD', 'mcd')]
+
+    optimizers = OrderedDict([('G', optimizer_G), ('D', optimizer_D)])
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, nets, plots, cache, amp, jit, optimizers, timer),
+                     eval_group=group_size(args.eval_group, device))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 def do_testing():
     print("Testing")
     save_folder = args.save_folder
     test_folder_path=args.test_folder
 
-    dirs = listdir(test_folder_path)
-    Gnet = torch.load(join(checkpoint,"gen_Ep_{}.pth".format(args.test_epoch))).to(device)
+    dirs = read_mcc_folder(test_folder_path)
+    if args.quantized:
+        # int8 Linear layers exported by export_quantized.py run on the CPU, without autocast or compilation
+        net = load_weights(quantized_linear(Gnet), join(checkpoint,"gen_int8_Ep_{}.pth".format(args.test_epoch)))
+        run_device, autocast = 'cpu', contextlib.nullcontext
+    else:
+        net = jit.compile(load_weights(Gnet, join(checkpoint,"gen_Ep_{}.pth".format(args.test_epoch))).eval())
+        run_device, autocast = device, amp.autocast
 
-    for i in dirs:
+    for i, d in dirs.items():
         
-        # Load the .mcc file
-        d = read_mcc(join(test_folder_path, i))
+        # Frames are converted independently, so long .mcc files are mapped and converted chunk-wise
+        Gout = []
+        frames = jit.chunk_frames(args.chunk_frames)
+        for chunk in mcc_chunks(d, frames):
+            a = torch.from_numpy(jit.pad(chunk, frames)).to(run_device)
+            with autocast():
+                Gout.append(net(a)[:len(chunk)].float().cpu().data.numpy())
 
-        a = torch.from_numpy(d)
-        a = Variable(a.squeeze(0).type('torch.FloatTensor')).to(device)
-        
-        Gout = Gnet(a)
+        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': np.concatenate(Gout)})
 
-        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
+    jit.save()
 
-def give_MCD():
-    Gnet = torch.load(join(checkpoint,"gen_Ep_{}.pth".format(args.test_epoch))).to(device)
-    mcd = []
 
-    for en, (a, b) in enumerate(val_dataloader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = b.cpu().data.numpy()[0]
+# MCD of a generator on a group of validation utterances (see evaluation.py)
+def mcd_step(Gnet):
+    def step(a, b, lengths):
+        Gout = Gnet(a.to(device))
+        return OrderedDict([('MCD', segment_mean(batch_mcd(Gout[:, 1:], b.to(device)[:, 1:], 'none'), lengths[0]))])
+    return step
 
-        Gout = Gnet(a).cpu().data.numpy()
+def give_MCD():
+    load_weights(Gnet, join(checkpoint,"gen_Ep_{}.pth".format(args.test_epoch)))
+    Gnet.eval()
 
-        ans = 0
-        for k in range(Gout.shape[0]):
-            ans = logSpecDbDist(Gout[k][1:],b[k][1:])
-            mcd.append(ans)
+    # Mean over all frames; the per-utterance values are returned
+    utterances, _ = evaluate(val_dataloader, mcd_step(Gnet), group_size(args.eval_group, device))
+    print(np.average(utterances['MCD'], weights=utterances['frames']))
+    return utterances
 
-    mcd = np.array(mcd)
-    print(np.mean(mcd))
+
+# Ranks the MCD of every saved generator in one pass over the validation set (written to mcd_sweep.csv)
+def sweep_MCD():
+    load = lambda epoch: mcd_step(load_weights(Gnet, join(checkpoint,"gen_Ep_{}.pth".format(epoch)), clone=True).eval())
+    sweep(val_dataloader, checkpoint_epochs(checkpoint, ['gen']), load, 'MCD', join(checkpoint, 'mcd_sweep.csv'),
+          group_size(args.eval_group, device), models=args.sweep_models)
 
 if __name__ == '__main__':
     
@@ -193,6 +160,8 @@ if __name__ == '__main__':
     parser.add_argument("-tr", "--train", action="store_true", help="Want to train?")
     parser.add_argument("-te", "--test", action="store_true", help="Want to test?")
     parser.add_argument("-m", "--mcd", action="store_true", help="Want MCD value?")
+    parser.add_argument("-sw", "--sweep", action="store_true", help="Rank the MCD of every saved checkpoint in one pass over the validation data?")
+    parser.add_argument("-sm", "--sweep_models", type=int, default=0, help="Checkpoints evaluated together by the sweep (0 for all)")
     parser.add_argument("-ci", "--checkpoint_interval", type=int, default=5, help="Checkpoint interval")
     parser.add_argument("-e", "--epoch", type=int, default=100, help="Number of Epochs")
     parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epochs to test")
@@ -203,32 +172,23 @@ if __name__ == '__main__':
     parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Checkpoint saving path for MCC features")
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Saving folder for converted MCC features")
     parser.add_argument("-tf", "--test_folder", type=str, default="../dataset/features/US_102/Whisper/mcc/", help="Input whisper mcc features for testing")
+    parser.add_argument("-qi", "--quantized", action="store_true", help="Test with the int8 generator exported by export_quantized.py?")
+    parser.add_argument("-cs", "--chunk_frames", type=int, default=0, help="Frames per chunk when converting test files (0 converts whole files)")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder = args.mainfolder
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
-    if args.nonparallel:
-        custom_dataloader = non_parallel_dataloader
-    else:
-        custom_dataloader = parallel_dataloader
-
-    traindata = custom_dataloader(folder_path=mainfolder)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder_path=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_loaders(args, mainfolder, validation)
 
 
     # Loss Functions
@@ -247,6 +207,11 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing, phase times of training (-pt)
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+    timer = phase_timer(args.phase_times, device)
+
     # Initialization
     if args.dnn_cnn == "dnn":
         Gnet = dnn_generator(ip_g, op_g, 512, 512, 512).to(device)
@@ -263,3 +228,5 @@ if __name__ == '__main__':
         do_testing()
     if args.mcd:
         give_MCD()
+    if args.sweep:
+        sweep_MCD()
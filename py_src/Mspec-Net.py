@@ -1,6 +1,8 @@
 import numpy as np
+import contextlib
 from os import listdir, makedirs, getcwd, remove
 from os.path import isfile, join, abspath, exists, isdir, expanduser
+from collections import OrderedDict
 
 import torch
 from torch.autograd import Variable
@@ -16,7 +18,6 @@ from torchvision import transforms, datasets, models
 from torch import Tensor
 import itertools
 
-import visdom
 import math
 import matplotlib.pyplot as plt 
 import scipy
@@ -24,219 +25,160 @@ from scipy import io as sio
 from scipy.io import savemat
 from scipy.io import loadmat
 
-from dataloaders import mspec_net_speech_data
-from networks import dnn_encoder, dnn_decoder, dnn_discriminator
+from pipeline import add_pipeline_args, make_mspec_loaders
+from trainer import trainer, precision, compiler, phase_timer, standard_hooks, add_trainer_args, load_weights
+from evaluation import evaluate, segment_mean, utterance_loss, group_size, checkpoint_epochs, sweep
+from networks import dnn_encoder, dnn_decoder, dnn_discriminator, dnn_multi_domain, quantized_linear
 from utils import *
 
 import argparse
 
 
 
-# Training Function
-def training(data_loader, n_epochs):
-    enc_nam.train()
-    enc_whp.train()
-    enc_sph.train()
+''' a - NAM | b - WHISPER-NAM | c - WHISPER-SPEECH | d - SPEECH, Here, WHISPER-NAM represents Whisper speech corresponding to NAM speech and 
+WHISPER-SPEECH represents Whisper speech  corresponding to Normal Speech. Domains of the encoders/decoders: 0 - NAM | 1 - WHISPER | 2 - SPEECH '''
 
-    dec_nam.train()
-    dec_whp.train()
-    dec_sph.train()
+# Latent codes: name -> (input, encoder domain)
+encodings = OrderedDict([('enc_n', ('a', 0)), ('enc_w_n', ('b', 1)), ('enc_w_s', ('c', 1)), ('enc_s', ('d', 2))])
 
-    Dnet_whp.train()
+# Decodings: name -> (latent code, decoder domain)
+decodings = OrderedDict([('a01', ('enc_n', 0)), ('a02', ('enc_w_n', 0)),
+                         ('bn_01', ('enc_w_n', 1)), ('bn_02', ('enc_n', 1)),
+                         ('bs_01', ('enc_w_s', 1)), ('bs_02', ('enc_s', 1)),
+                         ('c01', ('enc_s', 2)), ('c02', ('enc_w_s', 2))])
 
-    for en, (a, b, c, d) in enumerate(data_loader):
+# Auto-encoder loss terms: name -> (default weight, (output, target) pairs averaged with adversarial_loss)
+reconstruction_terms = OrderedDict([('nam', (10, [('a01', 'a'), ('a02', 'a')])),
+                                    ('whp_nam', (10, [('bn_01', 'b'), ('bn_02', 'b')])),
+                                    ('whp_sph', (1, [('bs_01', 'b'), ('bs_02', 'b')])),
+                                    ('sph', (1, [('c01', 'c'), ('c02', 'c')])),
+                                    ('latent', (1, [('enc_n', 'enc_w_n'), ('enc_w_s', 'enc_s')]))])
 
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).cuda()
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).cuda()
-        c = Variable(c.squeeze(0).type(torch.FloatTensor)).cuda()
-        d = Variable(d.squeeze(0).type(torch.FloatTensor)).cuda()
+# Discriminators: name -> (decodings judged real, decodings judged fake)
+discriminator_terms = OrderedDict([('nam', (['a01'], ['a02'])),
+                                   ('whp', (['bn_01', 'bs_01'], ['bn_02', 'bs_02'])),
+                                   ('sph', (['c01'], ['c02']))])
 
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).cuda()
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).cuda()
 
-        ''' a - NAM | b - WHISPER-NAM | c - WHISPER-SPEECH | d - SPEECH, Here, WHISPER-NAM represents Whisper speech corresponding to NAM speech and 
-        WHISPER-SPEECH represents Whisper speech  corresponding to Normal Speech'''
+# Encodes a, b, c, d and decodes only what the enabled loss terms read, in one batched pass each
+def forward(a, b, c, d):
+    x = dict(a=a, b=b, c=c, d=d)
+    x.update(zip(encodings, enc_all([x[i] for i, _ in encodings.values()], [k for _, k in encodings.values()])))
 
-        ############# Generator ##############
+    names = [name for name in decodings if name in needed]
+    x.update(zip(names, dec_all([x[decodings[name][0]] for name in names], [decodings[name][1] for name in names])))
+    return x
 
-        optimizer_enc.zero_grad()
-        optimizer_dec.zero_grad()
 
-        enc_n = enc_nam(a)
-        enc_w_n = enc_whp(b)
-        enc_w_s = enc_whp(c)
-        enc_s = enc_sph(d)
+# Batch mean of a loss, or one value per utterance when evaluating groups of utterances (see evaluation.py)
+def term(criterion, x, y, lengths=None):
+    if lengths is None:
+        return criterion(x, y)
+    return utterance_loss(criterion, x, y, lengths)
 
-        a01 = dec_nam(enc_n)
-        a02 = dec_nam(enc_w_n)
 
-        bn_01 = dec_whp(enc_w_n)
-        bn_02 = dec_whp(enc_n)
+def reconstruction_loss(x, lengths=None):
+    return sum(weights[name] * sum(term(adversarial_loss, x[o], x[t], lengths) for o, t in reconstruction_terms[name][1]) / 2
+               for name in weights)
 
-        bs_01 = dec_whp(enc_w_s)
-        bs_02 = dec_whp(enc_s)
 
-        c01 = dec_sph(enc_s)
-        c02 = dec_sph(enc_w_s)
+# Outputs of every enabled discriminator on the detached real and fake decodings.
+# They feed both its own loss and the fooling term of the auto-encoder loss, so each input is judged once.
+def judge(x):
+    return OrderedDict((name, ([discriminators[name](x[o].detach()) for o in real], [discriminators[name](x[o].detach()) for o in fake]))
+                       for name, (real, fake) in discriminator_terms.items() if name in discriminators)
 
-        # Losses for nam-whp
-        loss1 = (adversarial_loss(a01,a) + adversarial_loss(a02,a))/2
-        loss2 = (adversarial_loss(bn_01,b) + adversarial_loss(bn_02,b))/2
 
-        # Losses for whp-sph
-        loss3 = (adversarial_loss(bs_01,b) + adversarial_loss(bs_02,b))/2
-        loss4 = (adversarial_loss(c01,c) + adversarial_loss(c02,c))/2
+def discriminator_loss(real, fake, lengths=None):
+    valid = torch.ones_like(real[0])
+    return (sum(term(bce, y, valid, lengths) for y in real)/len(real) + sum(term(bce, y, 1 - valid, lengths) for y in fake)/len(fake))/2
 
-        loss5 = (adversarial_loss(enc_n, enc_w_n) + adversarial_loss(enc_w_s, enc_s))/2
 
-        fake_w = (bce(Dnet_whp(bn_02.detach()), valid) + bce(Dnet_whp(bs_02.detach()), valid))/2
+# How well the fakes pass as real. The decodings are detached, so like before this term is reported as part of
+# the auto-encoder loss without sending gradients to the generators.
+def fooling_loss(fake, lengths=None):
+    return (sum(term(bce, y, torch.ones_like(y), lengths) for y in fake)/len(fake)).detach()
 
-        autoencoder_loss = (loss1*10 + loss2*10 + loss3 + loss4 + loss5) + fake_w
 
-        autoencoder_loss.backward(retain_graph=True)
+# (1, frames, dims) .mat batches and (frames, dims) frame batches, also of a single frame, as (frames, dims)
+def to_device(*batch):
+    return [Variable(x.view(-1, x.shape[-1]).type(torch.FloatTensor)).cuda() for x in batch]
 
-        optimizer_enc.step()
-        optimizer_dec.step()
-
-        ############# Discriminator ###############
-
-        optimizer_D_w.zero_grad()
-
-        loss_D_real_n = bce(Dnet_nam(a01), valid) 
-        loss_D_fake_n = bce(Dnet_nam(a02), fake) 
-
-        loss_D_real_w = (bce(Dnet_whp(bn_01.detach()), valid) + bce(Dnet_whp(bs_01.detach()), valid))/2
-        loss_D_fake_w = (bce(Dnet_whp(bn_02.detach()), fake) + bce(Dnet_whp(bs_02.detach()), fake))/2
-
-        loss_D_real_s = bce(Dnet_sph(c01.detach()), valid)
-        loss_D_fake_s = bce(Dnet_sph(c02.detach()), fake)
-
-        Dnet_whp_loss = (loss_D_real_w + loss_D_fake_w)/2
-        Dnet_whp_loss.backward()
-        optimizer_D_w.step()
-
-        print ("[Epoch: %d] [Iter:%d/%d] [Autoen: %f] [Dis_wph: %f]"% (n_epochs, en, len(data_loader), autoencoder_loss.cpu().data.numpy(), Dnet_whp_loss.cpu().data.numpy()))
-    
-
-# Validation function
-def validating(data_loader):
-    Drunning_loss_nam = 0
-    Drunning_loss_whp = 0
-    Drunning_loss_sph = 0
-    Autoerunning_loss = 0
-    Frunning_loss = 0
-
-    enc_nam.eval()
-    enc_whp.eval()
-    enc_sph.eval()
-
-    dec_nam.eval()
-    dec_whp.eval()
-    dec_sph.eval()
-
-    for en, (a, b, c,d) in enumerate(data_loader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).cuda()
-        b = Variable(b.squeeze(0).type(torch.FloatTensor)).cuda()
-        c = Variable(c.squeeze(0).type(torch.FloatTensor)).cuda()
-        d = Variable(d.squeeze(0).type(torch.FloatTensor)).cuda()
-
-        valid = Variable(Tensor(a.shape[0], 1).fill_(1.0), requires_grad=False).cuda()
-        fake = Variable(Tensor(a.shape[0], 1).fill_(0.0), requires_grad=False).cuda()
-
-        ''' a - NAM | b - WHISPER-NAM | c - WHISPER-SPEECH | d - SPEECH '''
-
-        ###### Generator #########
-
-        enc_n = enc_nam(a)
-        enc_w_n = enc_whp(b)
-        enc_w_s = enc_whp(c)
-        enc_s = enc_sph(d)
-
-        a01 = dec_nam(enc_n)
-        a02 = dec_nam(enc_w_n)
-
-        bn_01 = dec_whp(enc_w_n)
-        bn_02 = dec_whp(enc_n)
 
-        bs_01 = dec_whp(enc_w_s)
-        bs_02 = dec_whp(enc_s)
+# One training step: all auto-encoders, then every enabled discriminator
+def train_step(a, b, c, d):
 
-        c01 = dec_sph(enc_s)
-        c02 = dec_sph(enc_w_s)
+    ############# Generator ##############
 
-       # Losses for nam-whp
-        loss1 = (adversarial_loss(a01,a) + adversarial_loss(a02,a))/2
-        loss2 = (adversarial_loss(bn_01,b) + adversarial_loss(bn_02,b))/2
+    optimizer_enc.zero_grad()
+    optimizer_dec.zero_grad()
 
-        # Losses for whp-sph
-        loss3 = (adversarial_loss(bs_01,b) + adversarial_loss(bs_02,b))/2
-        loss4 = (adversarial_loss(c01,c) + adversarial_loss(c02,c))/2
+    with timer('copy'):
+        batch = to_device(a, b, c, d)
 
-        loss5 = (adversarial_loss(enc_n, enc_w_n) + adversarial_loss(enc_w_s, enc_s))/2
+    with timer('G forward'):
+        x = forward(*batch)
+    with timer('D forward'):
+        judged = judge(x)
 
-        fake_w = (bce(Dnet_whp(bn_02.detach()), valid) + bce(Dnet_whp(bs_02.detach()), valid))/2
+    with timer('G forward'):
+        autoencoder_loss = reconstruction_loss(x) + sum(fooling_loss(fake) for _, fake in judged.values())
 
-        autoencoder_loss = (loss1*10 + loss2*10 + loss3 + loss4 + loss5)+ fake_w
+    # Nothing reads the auto-encoder graph afterwards, so it is freed by this backward
+    with timer('G backward'):
+        autoencoder_loss.backward()
 
-        ############# Discriminator ##############
+    with timer('G step'):
+        optimizer_enc.step()
+        optimizer_dec.step()
 
-        loss_D_real_w = (bce(Dnet_whp(bn_01.detach()), valid) + bce(Dnet_whp(bs_01.detach()), valid))/2
-        loss_D_fake_w = (bce(Dnet_whp(bn_02.detach()), fake) + bce(Dnet_whp(bs_02.detach()), fake))/2
+    ############# Discriminator ###############
 
-        Dnet_whp_loss = (loss_D_real_w + loss_D_fake_w)/2
+    losses = OrderedDict([('Autoen', autoencoder_loss)])
+    for name, (real, fake) in judged.items():
+        optimizers_D[name].zero_grad()
+        with timer('D forward'):
+            loss = discriminator_loss(real, fake)
+        with timer('D backward'):
+            loss.backward()
+        with timer('D step'):
+            optimizers_D[name].step()
+        losses['Dis_' + name] = loss
 
-        #################################################################
+    return losses
+    
 
-        Autoerunning_loss += autoencoder_loss.item()
+# Validation step on a group of utterance pairs (see evaluation.py); both folders hold utterances of equal length
+def val_step(a, b, c, d, lengths):
+    # The loss terms compare decodings of one pair with the other frame by frame (whp_sph: bs_01 against b)
+    assert lengths[0] == lengths[2], "Mspec-Net validation needs the utterances of both pairs to have equal lengths"
+    n = lengths[0]
+    x = forward(a.cuda(), b.cuda(), c.cuda(), d.cuda())
+    judged = judge(x)
 
-        Drunning_loss_whp += Dnet_whp_loss.item()
+    autoencoder_loss = reconstruction_loss(x, n) + sum(fooling_loss(fake, n) for _, fake in judged.values())
 
-    return Autoerunning_loss/(en+1), Drunning_loss_whp/(en+1) 
+    metrics = OrderedDict([('AE_loss', autoencoder_loss)])
+    for name, (real, fake) in judged.items():
+        metrics['D_{}_loss'.format(name)] = discriminator_loss(real, fake, n)
+    return metrics
 
 
+# Training loop, checkpoints and plots are run by trainer.py
 def do_training():
-    epoch = args.epoch
-
-    dl_arr = []
-    gl_arr = []
-    for ep in range(epoch):
-
-        training(train_dataloader, ep+1)
-        if (ep+1)%args.checkpoint_interval==0:
-            torch.save(enc_nam, join(checkpoint,"enc_nam_Ep_{}.pth".format(ep+1)))
-            torch.save(enc_whp, join(checkpoint,"enc_whp_Ep_{}.pth".format(ep+1)))
-            torch.save(enc_sph, join(checkpoint,"enc_sph_Ep_{}.pth".format(ep+1)))
-            torch.save(dec_nam, join(checkpoint,"dec_nam_Ep_{}.pth".format(ep+1)))
-            torch.save(dec_whp, join(checkpoint,"dec_whp_Ep_{}.pth".format(ep+1)))
-            torch.save(dec_sph, join(checkpoint,"dec_sph_Ep_{}.pth".format(ep+1)))
-
-
-        if (ep+1)%args.validation_interval==0:
-            dl,gl = validating(val_dataloader)
-            
-            print("AE_loss: " + str(dl) + " D_loss: " + str(gl))
-            
-            dl_arr.append(dl)
-            gl_arr.append(gl)
-            
-            if ep == 0:
-                gplot = viz.line(Y=np.array([gl]), X=np.array([ep]), opts=dict(title='Discriminator'))
-                dplot = viz.line(Y=np.array([dl]), X=np.array([ep]), opts=dict(title='Auto-Encoders'))
-            else:
-                viz.line(Y=np.array([gl]), X=np.array([ep]), win=gplot, update='append')
-                viz.line(Y=np.array([dl]), X=np.array([ep]), win=dplot, update='append')
-
-            
-    savemat(checkpoint+"/"+str('autoencoders_loss.mat'),  mdict={'foo': dl_arr})
-    savemat(checkpoint+"/"+str('discriminator_loss.mat'),  mdict={'foo': gl_arr})
-
-    plt.figure(1)
-    plt.plot(dl_arr)
-    plt.savefig(checkpoint+'/autoencoders_loss.png')
-    plt.figure(2)
-    plt.plot(gl_arr)
-    plt.savefig(checkpoint+'/discriminator_loss.png')
+    saves = OrderedDict([('enc_nam', enc_nam), ('enc_whp', enc_whp), ('enc_sph', enc_sph),
+                         ('dec_nam', dec_nam), ('dec_whp', dec_whp), ('dec_sph', dec_sph)])
+    nets = OrderedDict([('enc', enc_all), ('dec', dec_all)])
+    plots = [('AE_loss', 'Auto-Encoders', 'autoencoders_loss')]
+    optimizers = OrderedDict([('enc', optimizer_enc), ('dec', optimizer_dec)])
+    for name, Dnet in discriminators.items():
+        nets['dis_' + name] = Dnet
+        optimizers['dis_' + name] = optimizers_D[name]
+        plots.append(('D_{}_loss'.format(name), 'Discriminator ' + name, 'discriminator_{}_loss'.format(name)))
 
+    engine = trainer(nets, train_step, val_step, standard_hooks(args, checkpoint, saves, plots, cache, amp, jit, optimizers, timer),
+                     eval_group=group_size(args.eval_group, 'cuda'))
+    engine.fit(train_dataloader, val_dataloader, args.epoch, args.validation_interval)
 
 
 '''
@@ -249,31 +191,43 @@ def do_testing():
     save_folder = args.save_folder
     test_folder_path=args.test_folder
 
-    dirs = listdir(test_folder_path)
+    dirs = read_mcc_folder(test_folder_path)
 
 
+    # int8 Linear layers exported by export_quantized.py (-qi) run on the CPU, without autocast or compilation
+    def load(net, prefix):
+        if args.quantized:
+            return load_weights(quantized_linear(net), join(checkpoint, "{}_int8_Ep_{}.pth".format(prefix, args.test_epoch)))
+        return jit.compile(load_weights(net, join(checkpoint, "{}_Ep_{}.pth".format(prefix, args.test_epoch))).eval())
+
     if args.test_type == "whsp2spch":
-        enc = torch.load(join(checkpoint,"enc_whp_Ep_{}.pth".format(args.test_epoch))).to(device)
-        dec = torch.load(join(checkpoint,"dec_sph_Ep_{}.pth".format(args.test_epoch))).to(device)
+        enc = load(enc_whp, "enc_whp")
+        dec = load(dec_sph, "dec_sph")
 
     if args.test_type == "nam2spch":
-        enc = torch.load(join(checkpoint,"enc_nam_Ep_{}.pth".format(args.test_epoch))).to(device)
-        dec = torch.load(join(checkpoint,"dec_sph_Ep_{}.pth".format(args.test_epoch))).to(device)
+        enc = load(enc_nam, "enc_nam")
+        dec = load(dec_sph, "dec_sph")
 
     if args.test_type == "nam2whsp":
-        enc = torch.load(join(checkpoint,"enc_nam_Ep_{}.pth".format(args.test_epoch))).to(device)
-        dec = torch.load(join(checkpoint,"dec_whp_Ep_{}.pth".format(args.test_epoch))).to(device)
+        enc = load(enc_nam, "enc_nam")
+        dec = load(dec_whp, "dec_whp")
 
-    for i in dirs:
-        
-        # Load the .mcc file
-        d = read_mcc(join(test_folder_path, i))
+    run_device, autocast = ('cpu', contextlib.nullcontext) if args.quantized else (device, amp.autocast)
 
-        a = torch.from_numpy(d)
-        a = Variable(a.squeeze(0).type('torch.FloatTensor')).to(device)
+    for i, d in dirs.items():
         
-        Gout = dec(enc(a))
-        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': Gout.cpu().data.numpy()})
+        # Frames are converted independently, so long .mcc files are mapped and converted chunk-wise
+        Gout = []
+        frames = jit.chunk_frames(args.chunk_frames)
+        for chunk in mcc_chunks(d, frames):
+            a = torch.from_numpy(jit.pad(chunk, frames)).to(run_device)
+            with autocast():
+                Gout.append(dec(enc(a))[:len(chunk)].float().cpu().data.numpy())
+
+        savemat(join(save_folder,'{}.mat'.format(i[:-4])),  mdict={'foo': np.concatenate(Gout)})
+
+    jit.save()
+
 
 
 '''
@@ -281,44 +235,45 @@ Check MCD value on validation data for now! :)
 '''
 
 
-def give_MCD():
-    
-    enc1 = torch.load(join(checkpoint,"enc_whp_Ep_{}.pth".format(args.test_epoch))).to(device)
-    dec1 = torch.load(join(checkpoint,"dec_sph_Ep_{}.pth".format(args.test_epoch))).to(device)
+# Field of the target of every MCD, whose frames weight it (the two pairs of an item may differ in length)
+mcd_fields = OrderedDict([('NAM2WHSP', 1), ('WHSP2SPCH', 3)])
 
-    enc2 = torch.load(join(checkpoint,"enc_nam_Ep_{}.pth".format(args.test_epoch))).to(device)
-    dec2 = torch.load(join(checkpoint,"dec_sph_Ep_{}.pth".format(args.test_epoch))).to(device)
 
-    enc3 = torch.load(join(checkpoint,"enc_nam_Ep_{}.pth".format(args.test_epoch))).to(device)
-    dec3 = torch.load(join(checkpoint,"dec_whp_Ep_{}.pth".format(args.test_epoch))).to(device)
+# MCD of the whisper-to-speech and NAM-to-whisper conversions of the checkpoints of one epoch
+# on a group of validation utterance pairs (a - NAM | b - WHISPER-NAM | c - WHISPER-SPEECH | d - SPEECH)
+def mcd_step(epoch):
+    enc1 = load_weights(enc_whp, join(checkpoint,"enc_whp_Ep_{}.pth".format(epoch)), clone=True).eval()
+    dec1 = load_weights(dec_sph, join(checkpoint,"dec_sph_Ep_{}.pth".format(epoch)), clone=True).eval()
 
+    enc3 = load_weights(enc_nam, join(checkpoint,"enc_nam_Ep_{}.pth".format(epoch)), clone=True).eval()
+    dec3 = load_weights(dec_whp, join(checkpoint,"dec_whp_Ep_{}.pth".format(epoch)), clone=True).eval()
 
-    mcd_whsp2spch = []
-    mcd_nam2whsp = []
+    def step(a, b, c, d, lengths):
+        Gout1 = dec3(enc3(a.to(device)))
+        Gout2 = dec1(enc1(c.to(device)))
 
-    print("As of now MCD calculation relies upon the available parallel data. Hence, here, we calculat MCD for whsp2spch and nam2whsp conversions.")
-
-    for en, (a, b, c, d) in enumerate(val_dataloader):
-        a = Variable(a.squeeze(0).type(torch.FloatTensor)).to(device)
-        b = b.cpu().data.numpy()[0]
+        return OrderedDict([('NAM2WHSP', segment_mean(batch_mcd(Gout1[:, 1:], b.to(device)[:, 1:], 'none'), lengths[mcd_fields['NAM2WHSP']])),
+                            ('WHSP2SPCH', segment_mean(batch_mcd(Gout2[:, 1:], d.to(device)[:, 1:], 'none'), lengths[mcd_fields['WHSP2SPCH']]))])
+    return step
 
-        c = Variable(c.squeeze(0).type(torch.FloatTensor)).to(device)
-        d = d.cpu().data.numpy()[0]
 
-        Gout1 = dec3(enc3(a)).cpu().data.numpy()
-        Gout2 = dec1(enc1(c)).cpu().data.numpy()
+def give_MCD():
+    print("As of now MCD calculation relies upon the available parallel data. Hence, here, we calculat MCD for whsp2spch and nam2whsp conversions.")
 
-        ans = 0
-        for k in range(Gout1.shape[0]):
-            ans = logSpecDbDist(Gout1[k][1:],b[k][1:])
-            mcd_nam2whsp.append(ans)
-            ans = logSpecDbDist(Gout2[k][1:],b[k][1:])
-            mcd_whsp2spch.append(ans)
+    # Means over all frames of the targets of each conversion; the per-utterance values are returned
+    utterances, _ = evaluate(val_dataloader, mcd_step(args.test_epoch), group_size(args.eval_group, 'cuda'))
+    mcd_nam2whsp = np.average(utterances['NAM2WHSP'], weights=utterances['field_frames'][:, mcd_fields['NAM2WHSP']])
+    mcd_whsp2spch = np.average(utterances['WHSP2SPCH'], weights=utterances['field_frames'][:, mcd_fields['WHSP2SPCH']])
+    print("MCD Scores: WHSP2SPCH={}\tNAM2WHSP={}".format(mcd_whsp2spch, mcd_nam2whsp))
+    return utterances
 
-    mcd_whsp2spch = np.array(mcd_whsp2spch)
-    mcd_nam2whsp = np.array(mcd_nam2whsp)
-    print("MCD Scores: WHSP2SPCH={}\tNAM2WHSP={}".format(np.mean(mcd_whsp2spch), np.mean(mcd_nam2whsp)))
 
+# Ranks every saved epoch by the MCD of the conversion of -tt in one pass over the validation set (written to mcd_sweep.csv)
+def sweep_MCD():
+    key = 'NAM2WHSP' if args.test_type == 'nam2whsp' else 'WHSP2SPCH'
+    epochs = checkpoint_epochs(checkpoint, ['enc_whp', 'dec_sph', 'enc_nam', 'dec_whp'])
+    sweep(val_dataloader, epochs, mcd_step, key, join(checkpoint, 'mcd_sweep.csv'), group_size(args.eval_group, 'cuda'),
+          models=args.sweep_models, fields=mcd_fields)
 
 if __name__ == '__main__':
     
@@ -329,6 +284,8 @@ if __name__ == '__main__':
     parser.add_argument("-tr", "--train", action="store_true", help="Want to train?")
     parser.add_argument("-te", "--test", action="store_true", help="Want to test?")
     parser.add_argument("-m", "--mcd", action="store_true", help="Want MCD value?")
+    parser.add_argument("-sw", "--sweep", action="store_true", help="Rank the MCD of every saved checkpoint in one pass over the validation data?")
+    parser.add_argument("-sm", "--sweep_models", type=int, default=0, help="Checkpoints evaluated together by the sweep (0 for all)")
     parser.add_argument("-ci", "--checkpoint_interval", type=int, default=5, help="Checkpoint interval")
     parser.add_argument("-e", "--epoch", type=int, default=100, help="Number of Epochs")
     parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epochs to test")
@@ -341,13 +298,17 @@ if __name__ == '__main__':
     parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Saving folder for converted MCC features")
     parser.add_argument("-tt", "--test_type", type=str, default="whsp2spch", help="Provide the type of conversation to be tested out.")
     parser.add_argument("-tf", "--test_folder", type=str, default="../dataset/features/MSpeC-Net/Whisper/mcc/", help="Input whisper mcc features for testing")
+    parser.add_argument("-ds", "--discriminators", type=str, default="whp", help="Comma separated discriminators to train, out of nam,whp,sph (empty for none)")
+    parser.add_argument("-rw", "--reconstruction_weights", type=str, default="10,10,1,1,1", help="Weights of the nam,whp_nam,whp_sph,sph,latent auto-encoder losses (0 skips a term)")
+    parser.add_argument("-qi", "--quantized", action="store_true", help="Test with the int8 encoder/decoder exported by export_quantized.py?")
+    parser.add_argument("-cs", "--chunk_frames", type=int, default=0, help="Frames per chunk when converting test files (0 converts whole files)")
+    add_pipeline_args(parser, frame_batching=True)
+    add_trainer_args(parser)
 
     args = parser.parse_args()
 
 
     
-    # Connect with Visdom for the loss visualization
-    viz = visdom.Visdom()
 
     # Path where you want to store your results        
     mainfolder1 = args.mainfolder1
@@ -355,19 +316,11 @@ if __name__ == '__main__':
     checkpoint = args.checkpoint_folder
     validation = args.validation_folder
 
-    # Training Data path
     if args.nonparallel:
         print("Currently, MSpeC-Net does not support non-parallel training")
-    
-    custom_dataloader = mspec_net_speech_data
 
-    traindata = custom_dataloader(folder1=mainfolder1, folder2=mainfolder2)
-    train_dataloader = DataLoader(dataset=traindata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
-
-
-    # Path for validation data
-    valdata = custom_dataloader(folder1=validation, folder2=validation)
-    val_dataloader = DataLoader(dataset=valdata, batch_size=1, shuffle=True, num_workers=0)  # For windows keep num_workers = 0
+    # Training and validation data (loading flags are defined in pipeline.py)
+    train_dataloader, val_dataloader, cache = make_mspec_loaders(args, mainfolder1, mainfolder2, validation)
 
 
     # Loss Functions
@@ -394,6 +347,11 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
+    # Mixed precision and graph compilation of training and testing, phase times of training (-pt)
+    amp = precision(args.autocast, device)
+    jit = compiler(args.compile, args.compile_cache)
+    timer = phase_timer(args.phase_times, device)
+
     # Initialization
     if args.dnn_cnn == "cnn":
         print("Currently, MSpeC-Net only supports DNN based architectures.")
@@ -406,10 +364,17 @@ if __name__ == '__main__':
     dec_whp = dnn_decoder(in_dec, out_dec, 512, 512, 512).cuda()
     dec_sph = dnn_decoder(in_dec, out_dec, 512, 512, 512).cuda()
 
-    Dnet_nam = dnn_discriminator(in_d, out_d, 512, 512, 512).cuda()
-    Dnet_whp = dnn_discriminator(in_d, out_d, 512, 512, 512).cuda()
-    Dnet_sph = dnn_discriminator(in_d, out_d, 512, 512, 512).cuda()
+    # Batched views of the per-domain encoders/decoders used by the training and validation steps
+    enc_all = dnn_multi_domain([enc_nam, enc_whp, enc_sph])
+    dec_all = dnn_multi_domain([dec_nam, dec_whp, dec_sph])
+
+    # Only the enabled loss terms are computed: the discriminators of -ds, and the reconstruction terms of non-zero weight
+    weights = OrderedDict((name, w) for name, w in zip(reconstruction_terms, map(float, args.reconstruction_weights.split(','))) if w != 0)
+    discriminators = OrderedDict((name, dnn_discriminator(in_d, out_d, 512, 512, 512).cuda()) for name in args.discriminators.split(',') if name)
 
+    needed = set(o for name in weights for pair in reconstruction_terms[name][1] for o in pair)
+    for name in discriminators:
+        needed.update(discriminator_terms[name][0] + discriminator_terms[name][1])
 
 
     # Initialize the optimizers
@@ -418,11 +383,13 @@ if __name__ == '__main__':
     optimizer_enc = torch.optim.Adam(params1, lr=args.learning_rate, betas=(0.5, 0.999))
     optimizer_dec = torch.optim.Adam(params2, lr=args.learning_rate, betas=(0.5, 0.999))
 
-    optimizer_D_w = torch.optim.Adam(Dnet_whp.parameters(), lr=args.learning_rate, betas=(0.5, 0.999))
+    optimizers_D = OrderedDict((name, torch.optim.Adam(Dnet.parameters(), lr=args.learning_rate, betas=(0.5, 0.999))) for name, Dnet in discriminators.items())
 
     if args.train:
         do_training()
     if args.test:
         do_testing()
     if args.mcd:
-        give_MCD()
\ No newline at end of file
+        give_MCD()
+    if args.sweep:
+        sweep_MCD()
\ No newline at end of file
@@ -0,0 +1,145 @@
+import numpy as np
+from os import listdir
+from os.path import join
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+from dataloaders import load_batch
+from networks import dnn_generator, cnn_generator, inception_generator
+from utils import batch_mcd
+
+import argparse
+
+'''
+Compares float32 against bfloat16 autocast (-ac bf16 of the training scripts) for the three MCC generators.
+Both precisions start from the same weights and take the same MSE training steps on the same batches;
+the table reports training step time, inference time, the MCD reached after the steps and the MCD
+between the bf16 and fp32 outputs of identical weights (the error added by the lower precision alone).
+'''
+
+
+# Generators with the input/output layout of their training scripts: (frames, 40) -> (frames, 40)
+def make_generators():
+    return [('dnn_generator', lambda: dnn_generator(40, 40, 512, 512, 512), False),
+            ('cnn_generator', cnn_generator, True),
+            ('inception_generator', inception_generator, True)]
+
+
+def forward(net, a, image):
+    if image:
+        return net(a.unsqueeze(0).unsqueeze(0)).squeeze(0).squeeze(0)
+    return net(a)
+
+
+# Real (Feat, Clean_cent) batches of a folder, or synthetic learnable pairs of the same shape
+def load_data(folder, n_batches, frames, seed):
+    if folder is not None:
+        files = sorted(listdir(folder))[:n_batches]
+        return [tuple(torch.from_numpy(x) for x in load_batch(join(folder, f))) for f in files]
+
+    rng = np.random.RandomState(seed)
+    data = []
+    for _ in range(n_batches):
+        b = rng.randn(frames, 40).astype(np.float32)
+        a = 0.8*b + 0.3*rng.randn(frames, 40).astype(np.float32)
+        data.append((torch.from_numpy(a), torch.from_numpy(b)))
+    return data
+
+
+def autocast(dtype):
+    return torch.autocast('cpu', dtype=dtype, enabled=dtype is not None)
+
+
+def train(net, image, data, dtype, steps, warmup, lr):
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
+    mse = nn.MSELoss()
+    net.train()
+
+    times = []
+    for s in range(warmup + steps):
+        a, b = data[s % len(data)]
+        start = time.perf_counter()
+
+        optimizer.zero_grad()
+        with autocast(dtype):
+            loss = mse(forward(net, a, image), b)
+        loss.backward()
+        optimizer.step()
+
+        if s >= warmup:
+            times.append(time.perf_counter() - start)
+    return np.mean(times)*1000
+
+
+def infer(net, image, data, dtype, warmup):
+    net.eval()
+    outputs = []
+    times = []
+    with torch.no_grad():
+        for s in range(warmup):
+            with autocast(dtype):
+                forward(net, data[0][0], image)
+        for a, _ in data:
+            start = time.perf_counter()
+            with autocast(dtype):
+                out = forward(net, a, image).float()
+            times.append(time.perf_counter() - start)
+            outputs.append(out.numpy())
+    return np.mean(times)*1000, outputs
+
+
+def mcd(outputs, data):
+    return np.mean([batch_mcd(o[:, 1:], b.numpy()[:, 1:], 'mean') for o, (_, b) in zip(outputs, data)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="float32 vs bfloat16 autocast benchmark of the MCC generators")
+    parser.add_argument("-mf", "--mainfolder", type=str, default=None, help="Folder of .mat batches (synthetic 1000x40 data if not given)")
+    parser.add_argument("-nb", "--n_batches", type=int, default=4, help="Batches used for training and evaluation")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames per synthetic batch")
+    parser.add_argument("-n", "--steps", type=int, default=20, help="Timed training steps per precision")
+    parser.add_argument("-w", "--warmup", type=int, default=3, help="Untimed warm-up steps")
+    parser.add_argument("-lr", "--learning_rate", type=float, default=0.0001, help="Learning rate")
+    parser.add_argument("-th", "--threads", type=int, default=0, help="torch threads (0 keeps the default)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the weights and synthetic data")
+    parser.add_argument("-g", "--generators", type=str, default="dnn_generator,cnn_generator,inception_generator", help="Comma separated generators to run")
+
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    data = load_data(args.mainfolder, args.n_batches, args.frames, args.seed)
+    selected = args.generators.split(',')
+
+    print("CPU capability: {}, threads: {}".format(torch.backends.cpu.get_cpu_capability(), torch.get_num_threads()))
+    header = "{:<20} {:>11} {:>11} {:>8} {:>11} {:>11} {:>9} {:>9} {:>10}".format(
+        "network", "fp32 step", "bf16 step", "speedup", "fp32 infer", "bf16 infer", "fp32 MCD", "bf16 MCD", "bf16 drift")
+    print(header)
+    print("-"*len(header))
+
+    for name, make, image in make_generators():
+        if name not in selected:
+            continue
+
+        torch.manual_seed(args.seed)
+        net32 = make()
+        net16 = copy.deepcopy(net32)
+
+        # Error of the lower precision alone: same weights, different arithmetic
+        _, out32 = infer(net32, image, data, None, 0)
+        _, out16 = infer(net16, image, data, torch.bfloat16, 0)
+        drift = np.mean([batch_mcd(x[:, 1:], y[:, 1:], 'mean') for x, y in zip(out16, out32)])
+
+        step32 = train(net32, image, data, None, args.steps, args.warmup, args.learning_rate)
+        step16 = train(net16, image, data, torch.bfloat16, args.steps, args.warmup, args.learning_rate)
+
+        infer32, out32 = infer(net32, image, data, None, args.warmup)
+        infer16, out16 = infer(net16, image, data, torch.bfloat16, args.warmup)
+
+        print("{:<20} {:>9.2f}ms {:>9.2f}ms {:>7.2f}x {:>9.2f}ms {:>9.2f}ms {:>9.3f} {:>9.3f} {:>10.4f}".format(
+            name, step32, step16, step32/step16, infer32, infer16, mcd(out32, data), mcd(out16, data), drift))
@@ -0,0 +1,89 @@
+import numpy as np
+import time
+
+import torch
+import torch.nn as nn
+
+from networks import cnn_discriminator, inception_discriminator, pooled_cnn_discriminator, pooled_inception_discriminator
+
+import argparse
+
+'''
+Discriminator training throughput per real frame: the 1000x40 networks, which need every utterance cut into
+1000 frame pieces with the last one zero-padded, against the pooled discriminators run on whole utterances of
+their natural length. Utterance lengths are drawn uniformly from -ln on synthetic data; every step is one
+forward+backward with the real label, and only the frames of the utterances count as real.
+'''
+
+
+# (name, 1000 frame discriminator, pooled discriminator)
+def make_pairs():
+    return [('cnn_discriminator', cnn_discriminator, pooled_cnn_discriminator),
+            ('inception_discriminator', inception_discriminator, pooled_inception_discriminator)]
+
+
+# Pieces of frames each, the last one zero-padded: the 1000 frame batches of the training folders
+def chop(x, frames):
+    pieces = list(x.split(frames, 2))
+    pieces[-1] = nn.functional.pad(pieces[-1], (0, 0, 0, frames - pieces[-1].shape[2]))
+    return pieces
+
+
+def step(net, criterion, x):
+    out = net(x)
+    criterion(out, torch.ones_like(out)).backward()
+    net.zero_grad(set_to_none=True)
+
+
+# Seconds of one pass over the inputs, after warmup untimed steps on the first of them
+def timed(net, criterion, inputs, warmup):
+    for _ in range(warmup):
+        step(net, criterion, inputs[0])
+
+    start = time.perf_counter()
+    for x in inputs:
+        step(net, criterion, x)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Discriminator throughput per real frame: 1000 frame pieces against natural lengths")
+    parser.add_argument("-nu", "--utterances", type=int, default=20, help="Synthetic utterances")
+    parser.add_argument("-ln", "--lengths", type=str, default="200,1500", help="Shortest and longest utterance in frames")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames of the pieces of the 1000x40 networks")
+    parser.add_argument("-w", "--warmup", type=int, default=2, help="Untimed warm-up steps per pass")
+    parser.add_argument("-th", "--threads", type=int, default=0, help="torch threads (0 keeps the default)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the weights, lengths and synthetic data")
+
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(args.seed)
+    shortest, longest = [int(n) for n in args.lengths.split(',')]
+    lengths = np.random.RandomState(args.seed).randint(shortest, longest + 1, args.utterances)
+    utterances = [torch.randn(1, 1, n, 40) for n in lengths]
+    pieces = [piece for x in utterances for piece in chop(x, args.frames)]
+    real = int(lengths.sum())
+
+    criterion = nn.BCELoss()
+    print("CPU capability: {}, threads: {}, {} utterances of {}-{} frames ({} real frames)".format(
+        torch.backends.cpu.get_cpu_capability(), torch.get_num_threads(), args.utterances, shortest, longest, real))
+
+    header = "{:<24} {:<8} {:>7} {:>10} {:>8} {:>9} {:>12} {:>8}".format(
+        "network", "input", "steps", "frames", "padding", "time", "real fr/s", "speedup")
+    print(header)
+    print("-"*len(header))
+
+    for name, make, make_pooled in make_pairs():
+        rows = [('pieces', make().train(), pieces), ('natural', make_pooled().train(), utterances)]
+
+        base = None
+        for mode, net, inputs in rows:
+            seconds = timed(net, criterion, inputs, args.warmup)
+            frames = sum(x.shape[2] for x in inputs)
+            base = base or seconds
+            print("{:<24} {:<8} {:>7} {:>10} {:>7.1f}% {:>8.2f}s {:>12.0f} {:>7.2f}x".format(
+                name, mode, len(inputs), frames, 100*(frames - real)/frames, seconds, real/seconds, base/seconds))
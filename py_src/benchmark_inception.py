@@ -0,0 +1,129 @@
+import numpy as np
+import copy
+
+import torch
+
+from networks import inception, inv_inception, fused_inception, fused_inv_inception
+from networks import inception_generator, inception_f0_generator, inception_discriminator, direct_convs
+from benchmark_networks import forward, train, latencies
+
+import argparse
+
+'''
+Inception blocks with one merged 1x1 projection (fused_inception, -fi of the Inception scripts) against the original
+blocks: every block of the inception networks at the input shape it sees, then the whole networks.
+The fused model is loaded from the state_dict of the original one, and the table reports the largest difference of
+the outputs and of the gradients next to the median forward and forward+backward latencies.
+A second table checks the inference graphs of direct_convs(), where the stride 1 ConvTranspose2d layers of
+inv_inception are rewritten as Conv2d, against the original forward pass.
+'''
+
+
+# (name, original constructor, fused constructor, input shape) of the blocks at the 1000x40 input
+def make_blocks(frames):
+    return [('generator inception 1', lambda: inception(1, 32, 50, 64, 16, 32, 16), lambda: fused_inception(1, 32, 50, 64, 16, 32, 16), (1, 1, frames, 40)),
+            ('generator inception 2', lambda: inception(144, 64, 64, 128, 32, 64, 32), lambda: fused_inception(144, 64, 64, 128, 32, 64, 32), (1, 144, frames, 40)),
+            ('generator inv_inception 1', lambda: inv_inception(288, 64, 64, 128, 32, 64, 32), lambda: fused_inv_inception(288, 64, 64, 128, 32, 64, 32), (1, 288, frames, 40)),
+            ('generator inv_inception 2', lambda: inv_inception(288, 32, 128, 64, 64, 32, 16), lambda: fused_inv_inception(288, 32, 128, 64, 64, 32, 16), (1, 288, frames, 40)),
+            ('discriminator inception 1', lambda: inception(32, 32, 50, 64, 16, 32, 16), lambda: fused_inception(32, 32, 50, 64, 16, 32, 16), (1, 32, frames//2, 20)),
+            ('discriminator inception 2', lambda: inception(144, 64, 64, 128, 32, 64, 32), lambda: fused_inception(144, 64, 64, 128, 32, 64, 32), (1, 144, (frames//2 - 25)//5 + 1, 19)),
+            ('discriminator inception 3', lambda: inception(288, 128, 128, 256, 32, 64, 48), lambda: fused_inception(288, 128, 128, 256, 32, 64, 48), (1, 288, (frames//2 - 25)//10 + 1, 10))]
+
+
+def make_networks(frames):
+    return [('inception_generator', inception_generator, lambda: inception_generator(True), (1, 1, frames, 40)),
+            ('inception_f0_generator', inception_f0_generator, lambda: inception_f0_generator(True), (1, 1, frames, 40)),
+            ('inception_discriminator', inception_discriminator, lambda: inception_discriminator(True), (1, 1, frames, 40))]
+
+
+# (name, model with ConvTranspose2d layers, input shape) converted by direct_convs() for the second table
+def make_transposed(frames):
+    return [('generator inv_inception 1', lambda: inv_inception(288, 64, 64, 128, 32, 64, 32), (1, 288, frames, 40)),
+            ('generator inv_inception 2', lambda: inv_inception(288, 32, 128, 64, 64, 32, 16), (1, 288, frames, 40)),
+            ('inception_generator', inception_generator, (1, 1, frames, 40)),
+            ('fused inception_generator', lambda: inception_generator(True), (1, 1, frames, 40))]
+
+
+# Largest differences of the outputs and of the parameter gradients of two models with the same weights
+def differences(net, other, x):
+    outputs = []
+    for model in [net, other]:
+        model.eval()
+        out = model(x)
+        out.float().sum().backward()
+        outputs.append(out.detach())
+
+    grads = max((p.grad - q.grad).abs().max().item() for p, q in zip(net.parameters(), other.parameters()))
+    net.zero_grad(set_to_none=True)
+    other.zero_grad(set_to_none=True)
+    return (outputs[0] - outputs[1]).abs().max().item(), grads
+
+
+def median(step, net, x, args):
+    return np.median(latencies(step, net, x, args.warmup, args.repeats))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Original against fused inception blocks: equivalence and latency")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames of the synthetic input")
+    parser.add_argument("-n", "--repeats", type=int, default=10, help="Timed calls per pass")
+    parser.add_argument("-w", "--warmup", type=int, default=2, help="Untimed warm-up calls per pass")
+    parser.add_argument("-th", "--threads", type=int, default=0, help="torch threads (0 keeps the default)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the weights and synthetic data")
+    parser.add_argument("-nb", "--no_blocks", action="store_true", help="Only time the whole networks?")
+    parser.add_argument("-t", "--tables", type=str, default="fused,direct", help="Comma separated tables: fused blocks, direct convolutions")
+
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    tables = args.tables.split(',')
+    print("CPU capability: {}, threads: {}".format(torch.backends.cpu.get_cpu_capability(), torch.get_num_threads()))
+
+    if 'fused' in tables:
+        header = "{:<26} {:>9} {:>9} {:>11} {:>11} {:>8} {:>11} {:>11} {:>8}".format(
+            "model", "out diff", "grad diff", "fwd", "fused fwd", "speedup", "f+b", "fused f+b", "speedup")
+        print(header)
+        print("-"*len(header))
+
+        models = ([] if args.no_blocks else make_blocks(args.frames)) + make_networks(args.frames)
+        for name, make, make_fused, shape in models:
+            torch.manual_seed(args.seed)
+            net = make()
+            fused = make_fused()
+            fused.load_state_dict(copy.deepcopy(net.state_dict()))
+            x = torch.randn(*shape)
+
+            out_diff, grad_diff = differences(net, fused, x)
+
+            times = []
+            for step, train_mode in [(forward, False), (train, True)]:
+                for model in [net, fused]:
+                    model.train(train_mode)
+                    times.append(median(step, model, x, args))
+
+            print("{:<26} {:>9.1e} {:>9.1e} {:>9.2f}ms {:>9.2f}ms {:>7.2f}x {:>9.2f}ms {:>9.2f}ms {:>7.2f}x".format(
+                name, out_diff, grad_diff, times[0], times[1], times[0]/times[1], times[2], times[3], times[2]/times[3]))
+        print()
+
+    if 'direct' in tables:
+        header = "{:<26} {:>9} {:>9} {:>14} {:>11} {:>8}".format("model", "out diff", "rel diff", "transposed fwd", "direct fwd", "speedup")
+        print(header)
+        print("-"*len(header))
+
+        models = make_transposed(args.frames)[2 if args.no_blocks else 0:]
+        for name, make, shape in models:
+            torch.manual_seed(args.seed)
+            net = make().eval()
+            direct = direct_convs(net)
+            x = torch.randn(*shape)
+
+            with torch.no_grad():
+                out, out_direct = net(x), direct(x)
+            diff = (out - out_direct).abs().max().item()
+            times = [median(forward, model, x, args) for model in [net, direct]]
+
+            print("{:<26} {:>9.1e} {:>9.1e} {:>12.2f}ms {:>9.2f}ms {:>7.2f}x".format(
+                name, diff, diff / out.abs().max().item(), times[0], times[1], times[0]/times[1]))
@@ -0,0 +1,230 @@
+import numpy as np
+from os import makedirs
+from os.path import dirname, exists
+import sys
+import json
+import time
+import resource
+import multiprocessing
+
+import torch
+
+from networks import dnn_generator, dnn_discriminator, dnn_encoder, dnn_decoder, dnn
+from networks import cnn_generator, cnn_f0_generator, cnn_discriminator
+from networks import inception_generator, inception_f0_generator, inception_discriminator
+from numpy_runtime import peak_rss_mb
+
+import argparse
+
+'''
+Micro-benchmark of every network of networks.py at the shapes of the training scripts (1000 frames of 40 MCCs,
+the 512 wide latent of Mspec-Net for dnn_decoder) on synthetic data.
+For every network and thread count it reports the latency percentiles and frames/sec of the forward pass
+(eval mode, no grad) and of forward+backward (train mode), and once per network the peak memory of forward+backward.
+With -sb the results become the baseline; otherwise they are compared against the baseline, which exits with
+status 1 when a median latency got slower by more than the tolerance.
+'''
+
+
+# (name, constructor, input shape) with the layer sizes the training scripts use
+def make_networks(frames):
+    return [('dnn_generator', lambda: dnn_generator(40, 40, 512, 512, 512), (frames, 40)),
+            ('dnn_discriminator', lambda: dnn_discriminator(40, 1, 512, 512, 512), (frames, 40)),
+            ('dnn_encoder', lambda: dnn_encoder(40, 512, 512, 512, 512), (frames, 40)),
+            ('dnn_decoder', lambda: dnn_decoder(512, 40, 512, 512, 512), (frames, 512)),
+            ('dnn', lambda: dnn(40, 1, 128, 256, 512, 512, 256, 128, 64, 32), (frames, 40)),
+            ('cnn_generator', cnn_generator, (1, 1, frames, 40)),
+            ('cnn_f0_generator', cnn_f0_generator, (1, 1, frames, 40)),
+            ('cnn_discriminator', cnn_discriminator, (1, 1, frames, 40)),
+            ('inception_generator', inception_generator, (1, 1, frames, 40)),
+            ('inception_f0_generator', inception_f0_generator, (1, 1, frames, 40)),
+            ('inception_discriminator', inception_discriminator, (1, 1, frames, 40))]
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def forward(net, x):
+    with torch.no_grad():
+        net(x)
+
+
+def train(net, x):
+    net(x).float().sum().backward()
+    net.zero_grad(set_to_none=True)
+
+
+# Latencies in ms of warmup untimed and repeats timed calls of step(net, x)
+def latencies(step, net, x, warmup, repeats):
+    device = x.device
+    for _ in range(warmup):
+        step(net, x)
+    sync(device)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        step(net, x)
+        sync(device)
+        times.append((time.perf_counter() - start)*1000)
+    return np.array(times)
+
+
+def summary(times, frames):
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return dict(p50=float(p50), p90=float(p90), p99=float(p99), mean=float(np.mean(times)), fps=float(frames/p50*1000))
+
+
+def resident_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+# Lowers the peak resident set (VmHWM) of Linux to the current one, so that the peak left by importing torch is not counted
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+# Runs in a spawned process (fork hangs once OpenMP threads exist); constructors are looked up by name, lambdas do not pickle.
+# The peak is VmHWM (peak_rss_mb), as the ru_maxrss of a spawned process starts from the peak of its parent.
+def cpu_peak(name, frames, seed):
+    make, shape = [(m, s) for n, m, s in make_networks(frames) if n == name][0]
+    torch.manual_seed(seed)
+    reset_peak_rss()
+    before = resident_mb()
+    net = make()
+    train(net, torch.randn(*shape))
+    return peak_rss_mb() - before
+
+
+# Peak memory in MB of building the network and one forward+backward. On CPU it is the growth of the peak
+# resident set of a fresh process; on CUDA the peak of the caching allocator.
+def peak_memory(name, make, shape, device, args):
+    if device.type == 'cuda':
+        torch.manual_seed(args.seed)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        net = make().to(device)
+        train(net, torch.randn(*shape, device=device))
+        return (torch.cuda.max_memory_allocated(device) - before) / 2**20
+
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(cpu_peak, (name, args.frames, args.seed))
+
+
+def run(networks, threads, device, args):
+    results = {}
+    for name, make, shape in networks:
+        peak = peak_memory(name, make, shape, device, args)
+        for n in threads:
+            torch.set_num_threads(n)
+            torch.manual_seed(args.seed)
+            net = make().to(device)
+            x = torch.randn(*shape, device=device)
+
+            net.eval()
+            fwd = summary(latencies(forward, net, x, args.warmup, args.repeats), args.frames)
+            net.train()
+            fwd_bwd = summary(latencies(train, net, x, args.warmup, args.repeats), args.frames)
+
+            results['{}/{}'.format(name, n)] = dict(network=name, threads=n, forward=fwd, train=fwd_bwd, peak_mb=peak)
+            print_row(results['{}/{}'.format(name, n)], results.get('{}/{}'.format(name, threads[0])))
+    return results
+
+
+def print_header():
+    header = "{:<24} {:>3} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}".format(
+        "network", "thr", "fwd p50", "fwd p90", "fwd p99", "fwd fr/s", "f+b p50", "f+b p90", "f+b p99", "f+b fr/s", "scaling", "peak MB")
+    print(header)
+    print("-"*len(header))
+
+
+# scaling: forward+backward frames/sec relative to the first thread count
+def print_row(r, first):
+    fwd, fwd_bwd = r['forward'], r['train']
+    print("{:<24} {:>3} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>9.0f} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>9.0f} {:>7.2f}x {:>8.1f}".format(
+        r['network'], r['threads'], fwd['p50'], fwd['p90'], fwd['p99'], fwd['fps'],
+        fwd_bwd['p50'], fwd_bwd['p90'], fwd_bwd['p99'], fwd_bwd['fps'], fwd_bwd['fps']/first['train']['fps'], r['peak_mb']))
+
+
+def environment(device):
+    return dict(torch=torch.__version__, device=str(device), cpu_capability=torch.backends.cpu.get_cpu_capability())
+
+
+# Median latencies against the baseline; returns the (network/threads, pass, ratio) slower than the tolerance
+def compare(results, baseline, tolerance, env):
+    if baseline['environment'] != env:
+        print("Baseline environment {} differs from {}".format(baseline['environment'], env))
+
+    header = "{:<28} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}".format("network/threads", "fwd base", "fwd now", "ratio", "f+b base", "f+b now", "ratio")
+    print(header)
+    print("-"*len(header))
+
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline['results']:
+            continue
+        b = baseline['results'][key]
+        row = [key]
+        for mode in ['forward', 'train']:
+            ratio = r[mode]['p50'] / b[mode]['p50']
+            row += [b[mode]['p50'], r[mode]['p50'], ratio]
+            if ratio > 1 + tolerance/100:
+                regressions.append((key, mode, ratio))
+        print("{:<28} {:>10.2f}ms {:>10.2f}ms {:>7.2f}x {:>10.2f}ms {:>10.2f}ms {:>7.2f}x".format(*row))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Latency, throughput, memory and thread scaling of the networks of networks.py")
+    parser.add_argument("-nt", "--networks", type=str, default="all", help="Comma separated networks to run (all for every network)")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames of the synthetic input")
+    parser.add_argument("-n", "--repeats", type=int, default=30, help="Timed calls per pass")
+    parser.add_argument("-w", "--warmup", type=int, default=5, help="Untimed warm-up calls per pass")
+    parser.add_argument("-th", "--threads", type=str, default="", help="Comma separated torch thread counts (default 1 and all cores)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the weights and synthetic data")
+    parser.add_argument("-bl", "--baseline", type=str, default="../results/benchmarks/networks_baseline.json", help="Baseline file compared against")
+    parser.add_argument("-sb", "--save_baseline", action="store_true", help="Save the results as the new baseline instead of comparing?")
+    parser.add_argument("-tl", "--tolerance", type=float, default=10, help="Median latency increase in percent reported as a regression")
+
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    environment_now = environment(device)
+
+    cores = torch.get_num_threads()
+    threads = [int(t) for t in args.threads.split(',')] if args.threads else sorted(set([1, cores]))
+
+    networks = make_networks(args.frames)
+    if args.networks != "all":
+        selected = args.networks.split(',')
+        networks = [n for n in networks if n[0] in selected]
+
+    print("Device: {}, CPU capability: {}, torch {}".format(device, environment_now['cpu_capability'], torch.__version__))
+    print_header()
+    results = run(networks, threads, device, args)
+
+    if args.save_baseline:
+        if dirname(args.baseline):
+            makedirs(dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(environment=environment_now, frames=args.frames, results=results), f, indent=1)
+        print("Baseline saved to " + args.baseline)
+
+    elif exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.tolerance, environment_now)
+        for key, mode, ratio in regressions:
+            print("REGRESSION {} {}: median latency {:.2f}x the baseline".format(key, 'forward' if mode == 'forward' else 'forward+backward', ratio))
+        if regressions:
+            sys.exit(1)
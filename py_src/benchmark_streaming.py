@@ -0,0 +1,123 @@
+import numpy as np
+import tempfile
+import time
+from os.path import join
+
+import torch
+
+from streaming import stream_converter, torch_convert
+from export_numpy import make_models, load_models, export
+from numpy_runtime import converter
+
+import argparse
+
+'''
+Latency of streaming conversion (streaming.py) on synthetic frame streams: blocks of -bs frames arrive every
+-bs x -hp ms, and every block is timed from its arrival to its emission, for every latency budget (0 converts
+each block on arrival). The stream runs on a virtual clock: arrivals are scheduled, while every conversion is
+run for real and advances the clock by its measured time, so a stream of minutes takes the compute time only and
+a converter slower than real time shows as a growing backlog. Reports p50/p99/max per block, the blocks over
+budget, frames per call and the real-time factor (compute time / stream duration).
+'''
+
+
+class virtual_clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# convert that advances the clock by the time it took, which is also added up in spent
+def timed(convert, clock, spent):
+    def step(x):
+        start = time.perf_counter()
+        out = convert(x)
+        spent.append(time.perf_counter() - start)
+        clock.now += spent[-1]
+        return out
+    return step
+
+
+# Block latencies in ms, frames per call and compute seconds of one stream of blocks arriving every period seconds
+def simulate(convert, blocks, period, budget_ms, max_frames):
+    clock, spent = virtual_clock(), []
+    stream = stream_converter(timed(convert, clock, spent), budget_ms, max_frames, clock)
+    # The stream starts after the calibration calls
+    clock.now = 0.0
+    del spent[:]
+
+    arrivals = [k*period for k in range(len(blocks))]
+    latencies, calls = [], []
+
+    def emit(out):
+        if out:
+            calls.append(sum(len(block) for block in out))
+        for _ in out:
+            latencies.append((clock.now - arrivals[len(latencies)])*1000)
+
+    for arrival, block in zip(arrivals, blocks):
+        # Pending frames reach their deadline before the next block arrives
+        while stream.pending and stream.deadline() < arrival:
+            clock.now = max(clock.now, stream.deadline())
+            emit(stream.poll())
+        clock.now = max(clock.now, arrival)
+        emit(stream.push(block))
+
+    while stream.pending:
+        clock.now = max(clock.now, stream.deadline())
+        emit(stream.poll())
+
+    return np.array(latencies), calls, sum(spent)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Block latency of streaming conversion on synthetic frame streams")
+    parser.add_argument("-md", "--model", type=str, default="mmse", help="mmse (dnn_generator) or whsp2spch (enc_whp -> dec_sph)")
+    parser.add_argument("-cf", "--checkpoint_folder", type=str, default="", help="Folder of the checkpoints (empty for random weights)")
+    parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epoch of the checkpoints")
+    parser.add_argument("-rt", "--runtime", type=str, default="torch", help="torch, or numpy for the runtime of export_numpy.py")
+    parser.add_argument("-bl", "--budgets", type=str, default="0,10,20,50,100", help="Comma separated latency budgets in ms")
+    parser.add_argument("-bs", "--block_frames", type=str, default="1,4", help="Comma separated frames per pushed block")
+    parser.add_argument("-hp", "--hop", type=float, default=5, help="Frame shift of the stream in ms")
+    parser.add_argument("-fr", "--frames", type=int, default=4000, help="Frames per stream")
+    parser.add_argument("-mx", "--max_frames", type=int, default=1000, help="Largest micro-batch")
+    parser.add_argument("-th", "--threads", type=int, default=0, help="torch threads (0 keeps the default)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the weights and synthetic data")
+
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(args.seed)
+    if args.checkpoint_folder:
+        nets = load_models(args.model, args.checkpoint_folder, args.test_epoch)
+    else:
+        nets = [net.eval() for _, net in make_models(args.model)]
+
+    convert = torch_convert(torch.nn.Sequential(*nets))
+    if args.runtime == 'numpy':
+        with tempfile.TemporaryDirectory() as folder:
+            export(nets, join(folder, 'weights.npz'))
+            convert = converter(join(folder, 'weights.npz'))
+
+    frames = np.random.RandomState(args.seed).randn(args.frames, 40).astype(np.float32)
+    print("{} on {}, CPU capability: {}, threads: {}, {} frames every {} ms".format(
+        args.model, args.runtime, torch.backends.cpu.get_cpu_capability(), torch.get_num_threads(), args.frames, args.hop))
+
+    header = "{:>6} {:>7} {:>9} {:>9} {:>9} {:>8} {:>10} {:>6}".format("block", "budget", "p50", "p99", "max", "over", "fr/call", "RTF")
+    print(header)
+    print("-"*len(header))
+
+    for block_frames in [int(n) for n in args.block_frames.split(',')]:
+        blocks = [frames[start:start + block_frames] for start in range(0, args.frames, block_frames)]
+        for budget in [float(b) for b in args.budgets.split(',')]:
+            latencies, calls, compute = simulate(convert, blocks, block_frames*args.hop/1000, budget, args.max_frames)
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print("{:>6} {:>5.0f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.1f}% {:>10.1f} {:>6.3f}".format(
+                block_frames, budget, p50, p99, latencies.max(), 100*np.mean(latencies > max(budget, 0)), np.mean(calls),
+                compute/(args.frames*args.hop/1000)))
@@ -1,45 +1,129 @@
 import numpy as np
-from os import listdir
+from os import listdir, makedirs
 from os.path import join
+from collections import OrderedDict
+from threading import Lock
+from multiprocessing.managers import BaseManager
 
-from torch.utils.data import Dataset, DataLoader
+import torch
+from torch.utils.data import Dataset, Sampler
+
+from scipy.io import loadmat, whosmat
+
+
+# Byte-bounded LRU cache of decoded .mat batches, keyed by file path
+class batch_cache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = sum(v.nbytes for v in value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+            while self.nbytes + size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= sum(v.nbytes for v in old)
+                self.evictions += 1
+            self.entries[key] = value
+            self.nbytes += size
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.entries), bytes=self.nbytes)
+
+
+class cache_manager(BaseManager):
+    pass
+
+cache_manager.register('batch_cache', batch_cache)
+
+
+# Same cache hosted in a manager process, so that DataLoader worker processes share one copy and one set of counters
+def shared_batch_cache(max_bytes):
+    manager = cache_manager()
+    manager.start()
+    return manager.batch_cache(max_bytes)
+
+
+# Reads the given variables of one .mat batch, going through the cache when one is given.
+def load_batch(path, keys=('Feat', 'Clean_cent'), cache=None):
+    if cache is not None:
+        d = cache.get(path)
+        if d is not None:
+            return d
+
+    # Converted to float32 once here, which is what the networks consume
+    d = loadmat(path, variable_names=keys)
+    d = tuple(np.asarray(d[key], dtype=np.float32) for key in keys)
+
+    if cache is not None:
+        cache.put(path, d)
+    return d
 
-from scipy.io import loadmat
 
 # Class to load the parallel MCC features from .mat files into system
 class parallel_dataloader(Dataset):
     
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, cache=None):
         self.path = folder_path
         self.files = listdir(self.path)
+        self.cache = cache
 
         self.length = len(self.files)
         
     def __getitem__(self, index):
-        d1 = loadmat(join(self.path, self.files[int(index)]))
+        d1 = load_batch(join(self.path, self.files[int(index)]), cache=self.cache)
 
-        return  np.array(d1['Feat']), np.array(d1['Clean_cent'])
+        return  d1[0], d1[1]
     
     def __len__(self):
         return self.length
 
 
-# Class to load the non-parallel MCC features from .mat files into system
+# Class to load the non-parallel MCC features from .mat files into system.
+# The 'Clean_cent' targets of all files are pre-indexed once, so every item costs a single read.
+# index is either a file index (random target) or a (source, target) pair from pair_sampler.
 class non_parallel_dataloader(Dataset):
     
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, cache=None):
         self.path = folder_path
         self.files = listdir(self.path)
+        self.cache = cache
 
         self.length = len(self.files)
+        self.targets = [load_batch(join(self.path, f), keys=('Clean_cent',))[0] for f in self.files]
         
     def __getitem__(self, index):
-        d1 = loadmat(join(self.path, self.files[int(index)]))
-        
-        ind = np.random.randint(0, self.length)
-        d2 = loadmat(join(self.path, self.files[int(ind)]))
+        if isinstance(index, tuple):
+            index, ind = index
+        else:
+            ind = np.random.randint(0, self.length)
+
+        d1 = load_batch(join(self.path, self.files[int(index)]), cache=self.cache)
         
-        return  np.array(d1['Feat']), np.array(d2['Clean_cent'])
+        return  d1[0], self.targets[int(ind)]
     
     def __len__(self):
         return self.length
@@ -47,24 +131,368 @@ class non_parallel_dataloader(Dataset):
 
 class mspec_net_speech_data(Dataset):
 
-    def __init__(self, folder1, folder2, train=True):
+    def __init__(self, folder1, folder2, train=True, cache=None):
 
         self.path1 = folder1
         self.path2 = folder2
         self.train = train
+        self.cache = cache
 
         self.files1 = listdir(self.path1)                               # NAM-Whisper
         self.files2 = listdir(self.path2)                               # Whisper-Speech
 
     def __getitem__(self, index):
 
-        a = np.random.randint(len(self.files1))
-        b = np.random.randint(len(self.files2))
+        if isinstance(index, tuple):
+            a, b = index
+        else:
+            a = index
+            b = np.random.randint(len(self.files2))
        
-        d1 = loadmat(join(self.path1, self.files1[int(a)]))             # NAM-Whisper
-        d2 = loadmat(join(self.path2, self.files2[int(b)]))             # Whisper-Speech
+        d1 = load_batch(join(self.path1, self.files1[int(a)]), cache=self.cache)     # NAM-Whisper
+        d2 = load_batch(join(self.path2, self.files2[int(b)]), cache=self.cache)     # Whisper-Speech
 
-        return np.array(d1['Feat']), np.array(d1['Clean_cent']),  np.array(d2['Feat']), np.array(d2['Clean_cent'])
+        return d1 + d2
 
     def __len__(self):
-        return len(self.files1)
\ No newline at end of file
+        return len(self.files1)
+
+    # Sampler pairing every NAM-Whisper file with a Whisper-Speech file once per epoch
+    def pairs(self, seed=0, shuffle=True):
+        return pair_sampler(len(self.files1), len(self.files2), seed, shuffle)
+
+
+# Sampler that pre-decides the non-parallel (source, target) pairs of every epoch.
+# Sources and targets are both permutations, so each file is used once per epoch on each side,
+# and the pairing only depends on (seed, epoch). Without shuffle the epoch stays put, so validation
+# pairs every source with the same target every time.
+class pair_sampler(Sampler):
+
+    def __init__(self, n_src, n_tgt, seed=0, shuffle=True):
+        self.n_src = n_src
+        self.n_tgt = n_tgt
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+
+        if self.shuffle:
+            self.epoch += 1
+            src = rng.permutation(self.n_src)
+        else:
+            src = np.arange(self.n_src)
+        tgt = np.resize(rng.permutation(self.n_tgt), self.n_src)
+
+        for i, j in zip(src, tgt):
+            yield int(i), int(j)
+
+    def __len__(self):
+        return self.n_src
+
+
+# Packs every .mat batch of a folder into one contiguous float32 file plus an offset index.
+# All 'Feat' blocks are written first (in file order), followed by all 'Clean_cent' blocks.
+def pack_batches(folder_path, packed_path, keys=('Feat', 'Clean_cent')):
+    files = sorted(listdir(folder_path))
+
+    # First pass only reads the headers to size the output file
+    shapes = np.zeros((len(keys), len(files), 2), dtype=np.int64)
+    for f, name in enumerate(files):
+        info = dict((v[0], v[1]) for v in whosmat(join(folder_path, name)))
+        for k, key in enumerate(keys):
+            shapes[k, f] = info[key]
+
+    sizes = shapes[:, :, 0] * shapes[:, :, 1]
+    offsets = np.cumsum(np.concatenate([[0], sizes.ravel()]))[:-1].reshape(sizes.shape)
+
+    makedirs(packed_path, exist_ok=True)
+    data = np.memmap(join(packed_path, 'features.bin'), dtype=np.float32, mode='w+', shape=(int(sizes.sum()),))
+
+    for f, name in enumerate(files):
+        d = loadmat(join(folder_path, name), variable_names=keys)
+        for k, key in enumerate(keys):
+            data[offsets[k, f]:offsets[k, f] + sizes[k, f]] = np.asarray(d[key], dtype=np.float32).ravel()
+
+    data.flush()
+    del data
+
+    np.savez(join(packed_path, 'index.npz'), files=np.array(files), keys=np.array(keys), offsets=offsets, shapes=shapes)
+
+
+# Class to serve the parallel MCC features from a folder packed with pack_batches()
+class packed_dataloader(Dataset):
+
+    # cache is accepted for a uniform signature only; memmapped pages are already cached by the OS
+    def __init__(self, folder_path, cache=None):
+        self.path = folder_path
+        index = np.load(join(self.path, 'index.npz'))
+        self.files = list(index['files'])
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+
+        self.length = len(self.files)
+        self.data = None
+
+    # The memmap is opened lazily so that every DataLoader worker maps the file itself
+    def block(self, key, index):
+        if self.data is None:
+            self.data = np.memmap(join(self.path, 'features.bin'), dtype=np.float32, mode='c')
+
+        start = self.offsets[key, index]
+        rows, cols = self.shapes[key, index]
+        return self.data[start:start + rows*cols].reshape(rows, cols)
+
+    # Rows of every file for one key as a single (frames, dims) view, used by frame_pool_dataloader
+    def region(self, key):
+        self.block(key, 0)
+
+        rows = self.shapes[key, :, 0].sum()
+        cols = self.shapes[key, 0, 1]
+        assert (self.shapes[key, :, 1] == cols).all()
+
+        start = self.offsets[key, 0]
+        return self.data[start:start + rows*cols].reshape(rows, cols)
+
+    def __getitem__(self, index):
+        return self.block(0, int(index)), self.block(1, int(index))
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+
+# Class to serve the non-parallel MCC features from a packed folder
+class packed_non_parallel_dataloader(packed_dataloader):
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            index, ind = index
+        else:
+            ind = np.random.randint(0, self.length)
+
+        return self.block(0, int(index)), self.block(1, int(ind))
+
+
+class packed_mspec_net_speech_data(Dataset):
+
+    def __init__(self, folder1, folder2, train=True, cache=None):
+
+        self.data1 = packed_dataloader(folder1)                        # NAM-Whisper
+        self.data2 = packed_dataloader(folder2)                        # Whisper-Speech
+        self.train = train
+
+    def __getitem__(self, index):
+
+        if isinstance(index, tuple):
+            a, b = index
+        else:
+            a = index
+            b = np.random.randint(len(self.data2))
+
+        return self.data1[a] + self.data2[b]
+
+    def __len__(self):
+        return len(self.data1)
+
+    def pairs(self, seed=0, shuffle=True):
+        return pair_sampler(len(self.data1), len(self.data2), seed, shuffle)
+
+
+# Pools the frames of all batch files into one index so that frame-independent (DNN) models
+# can be trained on mini-batches reshuffled across files. Indexed by arrays from frame_batch_sampler,
+# or by (frames, targets) pairs of arrays when the sampler draws the non-parallel targets.
+class frame_pool_dataloader(Dataset):
+
+    def __init__(self, folder_path, packed=False, nonparallel=False):
+        self.nonparallel = nonparallel
+
+        if packed:
+            self.store = packed_dataloader(folder_path)
+            assert (self.store.shapes[0, :, 0] == self.store.shapes[1, :, 0]).all()
+            self.feat = None
+            self.target = None
+            self.length = int(self.store.shapes[0, :, 0].sum())
+        else:
+            self.store = None
+            data = parallel_dataloader(folder_path)
+            items = [data[i] for i in range(len(data))]
+            self.feat = np.concatenate([np.asarray(x[0], dtype=np.float32) for x in items])
+            self.target = np.concatenate([np.asarray(x[1], dtype=np.float32) for x in items])
+            self.length = len(self.feat)
+
+    def __getitem__(self, index):
+        if self.feat is None:
+            self.feat = self.store.region(0)
+            self.target = self.store.region(1)
+
+        if isinstance(index, tuple):
+            index, ind = index
+        elif self.nonparallel:
+            ind = np.sort(np.random.randint(0, self.length, len(index)))
+        else:
+            ind = index
+
+        return np.asarray(self.feat[index]), np.asarray(self.target[ind])
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.store is not None:
+            state['feat'] = None
+            state['target'] = None
+        return state
+
+
+class mspec_frame_pool(Dataset):
+
+    def __init__(self, folder1, folder2, packed=False):
+
+        self.pool1 = frame_pool_dataloader(folder1, packed)             # NAM-Whisper
+        self.pool2 = frame_pool_dataloader(folder2, packed)             # Whisper-Speech
+
+    def __getitem__(self, index):
+
+        if isinstance(index, tuple):
+            index, ind = index
+        else:
+            ind = np.sort(np.random.randint(0, len(self.pool2), len(index)))
+
+        return self.pool1[index] + self.pool2[ind]
+
+    def __len__(self):
+        return len(self.pool1)
+
+
+# Sampler yielding shuffled batches of frame indices; use it with DataLoader(batch_size=None).
+# With n_targets, every batch comes with random target frames for the non-parallel pools, as a (frames, targets)
+# pair. Like pair_sampler, the batches only depend on (seed, epoch).
+class frame_batch_sampler(Sampler):
+
+    def __init__(self, n_frames, batch_size, shuffle=True, drop_last=False, seed=0, n_targets=0):
+        self.n_frames = n_frames
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.n_targets = n_targets
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+
+        if self.shuffle:
+            self.epoch += 1
+            order = rng.permutation(self.n_frames)
+        else:
+            order = np.arange(self.n_frames)
+
+        for start in range(0, len(self)*self.batch_size, self.batch_size):
+            # Sorting inside a batch does not change the step but keeps memmap reads local
+            batch = np.sort(order[start:start + self.batch_size])
+            if self.n_targets > 0:
+                yield batch, np.sort(rng.randint(0, self.n_targets, len(batch)))
+            else:
+                yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_frames // self.batch_size
+        return (self.n_frames + self.batch_size - 1) // self.batch_size
+
+
+# Frames of every utterance of a parallel_dataloader or packed_dataloader, read from the .mat headers (or the
+# packed index) without loading the features
+def utterance_lengths(dataset):
+    if isinstance(dataset, packed_dataloader):
+        return dataset.shapes[0, :, 0].copy()
+
+    lengths = []
+    for name in dataset.files:
+        info = dict((v[0], v[1]) for v in whosmat(join(dataset.path, name)))
+        lengths.append(info['Feat'][0])
+    return np.array(lengths)
+
+
+# Batch sampler grouping utterances of similar length: utterances are sorted by length (ties in random order) and
+# cut into batches of at most max_frames padded frames (longest utterance x utterances, at least one utterance),
+# whose order is shuffled every epoch. Use it with DataLoader(batch_sampler=..., collate_fn=pad_collate).
+class length_bucket_sampler(Sampler):
+
+    def __init__(self, lengths, max_frames, seed=0, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.max_frames = max_frames
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        # Ties only reorder utterances of equal length, so every epoch has as many batches
+        self.n_batches = len(self.batches())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, rng=None):
+        ties = rng.rand(len(self.lengths)) if rng is not None else np.arange(len(self.lengths))
+        order = np.lexsort((ties, self.lengths))
+
+        batches, batch = [], []
+        for i in order:
+            if batch and self.lengths[i]*(len(batch) + 1) > self.max_frames:
+                batches.append(batch)
+                batch = []
+            batch.append(int(i))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        if self.shuffle:
+            self.epoch += 1
+
+        batches = self.batches(rng if self.shuffle else None)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return self.n_batches
+
+
+# Zero-pads the (frames, dims) fields of the utterances of a batch to the longest one:
+# returns the (utterances, frames, dims) fields followed by the (utterances,) lengths
+def pad_collate(batch):
+    lengths = [len(item[0]) for item in batch]
+    frames = max(lengths)
+
+    fields = []
+    for k in range(len(batch[0])):
+        field = np.zeros((len(batch), frames) + np.shape(batch[0][k])[1:], dtype=np.float32)
+        for n, item in enumerate(batch):
+            field[n, :len(item[k])] = item[k]
+        fields.append(torch.from_numpy(field))
+    return fields + [torch.tensor(lengths)]
+
+
+# Frames computed per epoch, which the FLOPs of the convolutional networks scale with: length buckets against
+# cutting every utterance into zero-padded pieces of frames (the 1000 frame batches of the 2D networks)
+def padding_report(lengths, batches, frames=1000):
+    lengths = np.asarray(lengths)
+    real = int(lengths.sum())
+    bucketed = int(sum(lengths[b].max()*len(b) for b in batches))
+    pieces = int(np.ceil(lengths / frames).sum()) * frames
+    return OrderedDict([('utterances', len(lengths)), ('batches', len(batches)), ('real', real), ('bucketed', bucketed),
+                        ('pieces', pieces), ('saved', 1 - bucketed/pieces)])
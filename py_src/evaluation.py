@@ -0,0 +1,158 @@
+'''
+Shared evaluation engine of the scripts in py_src, used for validation and for the MCD of give_MCD().
+
+Evaluation runs under torch.inference_mode and feeds several utterances (one loader item each) per forward pass.
+A script supplies
+    eval_step(*fields, lengths) -> OrderedDict of named metrics with one value per utterance of the group
+where every field holds the utterances of the group concatenated along the frames (or stacked along a new first
+axis with stack=True, for the networks that see a whole utterance as one image) and lengths[k] lists the frames
+of every utterance of field k. Per-frame values are reduced to per-utterance ones with segment_mean().
+sweep() ranks every saved checkpoint of a model in one pass over the validation set.
+'''
+import re
+import contextlib
+from os import listdir
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+
+
+# Groups consecutive loader items (one utterance each) by up to size; stacked groups only hold equal shapes
+def groups(data_loader, size, stack=False):
+    group = []
+    for batch in data_loader:
+        batch = [x.squeeze(0) for x in batch]
+        if group and (len(group) == size or (stack and [x.shape for x in batch] != [x.shape for x in group[0]])):
+            yield group
+            group = []
+        group.append(batch)
+
+    if group:
+        yield group
+
+
+def collate(group, stack=False):
+    fields = list(zip(*group))
+    lengths = [[len(x) for x in field] for field in fields]
+    if stack:
+        return [torch.stack(field) for field in fields], lengths
+    return [torch.cat(field) for field in fields], lengths
+
+
+# Mean of per-frame values (frames, ...) over the frames of every utterance -> (utterances,)
+def segment_mean(values, lengths):
+    values = values.float().reshape(len(values), -1).mean(1)
+    return torch.stack([v.mean() for v in values.split(lengths)])
+
+
+criteria = {}
+
+# Per-utterance value of a loss module (MSELoss, L1Loss, BCELoss, ...) that reduces with its default 'mean'
+def utterance_loss(criterion, x, y, lengths):
+    key = type(criterion)
+    if key not in criteria:
+        criteria[key] = key(reduction='none')
+    return segment_mean(criteria[key](x, y), lengths)
+
+
+constants = {}
+
+# Constant target tensor shaped like x (real/fake labels): a view of one buffer per value, dtype and device, which
+# only grows when a larger group comes, instead of a new tensor every batch or one kept for every shape
+def constant(value, x):
+    key = (value, x.dtype, x.device)
+    if key not in constants or constants[key].numel() < x.numel():
+        with torch.inference_mode():
+            constants[key] = torch.full((x.numel(),), value, dtype=x.dtype, device=x.device)
+    return constants[key][:x.numel()].view(x.shape)
+
+
+# Utterances per forward pass: grouping amortises kernel launches on a GPU, while on a CPU it only adds activation
+# memory (validation measured ~15% slower with groups of 8), so -1 picks 8 on CUDA and 1 elsewhere
+def group_size(requested, device):
+    if requested > 0:
+        return requested
+    return 8 if torch.device(device).type == 'cuda' else 1
+
+
+def to_numpy(value):
+    if torch.is_tensor(value):
+        return value.detach().float().cpu().numpy()
+    return np.asarray(value)
+
+
+# Runs eval_step over the loader and returns (per-utterance metrics, their averages).
+# The per-utterance OrderedDict also holds the 'frames' of every utterance, in loader order, and the
+# 'field_frames' (utterances, fields) of every field, for metrics on fields of another length than the first.
+def evaluate(data_loader, eval_step, group=1, stack=False, context=contextlib.nullcontext):
+    return evaluate_many(data_loader, OrderedDict([(None, eval_step)]), group, stack, context)[None]
+
+
+# Same for several models in one pass: eval_steps maps a name to an eval_step, every group of utterances is
+# collated once and fed to all of them. Returns name -> (per-utterance metrics, averages).
+def evaluate_many(data_loader, eval_steps, group=1, stack=False, context=contextlib.nullcontext):
+    values = OrderedDict((name, OrderedDict()) for name in eval_steps)
+    frames = []
+
+    with torch.inference_mode():
+        for items in groups(data_loader, group, stack):
+            fields, lengths = collate(items, stack)
+            for name, eval_step in eval_steps.items():
+                with context():
+                    metrics = eval_step(*fields, lengths=lengths)
+
+                for key, value in metrics.items():
+                    values[name].setdefault(key, []).append(np.atleast_1d(to_numpy(value)))
+            frames.extend(zip(*lengths))
+
+    results = OrderedDict()
+    for name in eval_steps:
+        utterances = OrderedDict((key, np.concatenate(v)) for key, v in values[name].items())
+        aggregate = OrderedDict((key, np.mean(v)) for key, v in utterances.items())
+        utterances['field_frames'] = np.array(frames, dtype=int).reshape(len(frames), -1)
+        utterances['frames'] = utterances['field_frames'][:, 0]
+        results[name] = (utterances, aggregate)
+    return results
+
+
+# Epochs of the checkpoints <prefix>_Ep_<epoch>.pth in folder that exist for every prefix, ascending
+def checkpoint_epochs(folder, prefixes):
+    epochs = None
+    for prefix in prefixes:
+        pattern = re.compile(re.escape(prefix) + r'_Ep_(\d+)\.pth$')
+        found = set(int(m.group(1)) for m in map(pattern.match, listdir(folder)) if m)
+        epochs = found if epochs is None else epochs & found
+    return sorted(epochs)
+
+
+# Evaluates the checkpoint of every epoch on the validation set and writes a table ranked by key (ascending) to path.
+# The validation batches are read once and kept in memory; load_step(epoch) loads one checkpoint and returns its
+# eval_step, and models checkpoints (0 for all) are evaluated together on every group of utterances.
+# Metrics are averaged over all frames, like give_MCD(): those of the first field, or of the field given by fields.
+def sweep(data_loader, epochs, load_step, key, path, group=1, stack=False, models=0, fields=None):
+    fields = fields or {}
+    data = list(data_loader)
+    size = models if models > 0 else max(len(epochs), 1)
+
+    rows = []
+    for start in range(0, len(epochs), size):
+        steps = OrderedDict((epoch, load_step(epoch)) for epoch in epochs[start:start + size])
+        for epoch, (utterances, _) in evaluate_many(data, steps, group, stack).items():
+            rows.append((epoch, OrderedDict((k, np.average(v, weights=utterances['field_frames'][:, fields.get(k, 0)]))
+                                            for k, v in utterances.items() if k not in ('frames', 'field_frames'))))
+        del steps
+
+    rows.sort(key=lambda row: row[1][key])
+    keys = list(rows[0][1]) if rows else [key]
+
+    lines = ["rank,epoch," + ",".join(keys)]
+    lines += ["{},{},".format(n+1, epoch) + ",".join("{:.4f}".format(metrics[k]) for k in keys) for n, (epoch, metrics) in enumerate(rows)]
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+    print("{:>4} {:>6} ".format("rank", "epoch") + " ".join("{:>10}".format(k) for k in keys))
+    for n, (epoch, metrics) in enumerate(rows):
+        print("{:>4} {:>6} ".format(n+1, epoch) + " ".join("{:>10.4f}".format(metrics[k]) for k in keys))
+    return rows
@@ -0,0 +1,142 @@
+import numpy as np
+import sys
+import time
+import importlib
+import subprocess
+from os import makedirs
+from os.path import join, dirname, abspath
+
+import torch
+
+from trainer import load_weights
+from networks import dnn_generator, dnn_encoder, dnn_decoder, dnn
+from export_quantized import make_models as converter_models
+from numpy_runtime import converter, peak_rss_mb
+
+import argparse
+
+'''
+Exports a frame-wise converter for numpy_runtime.py: the dnn_generator of MMSE_GAN.py, the encoder/decoder pair of
+one Mspec-Net conversion or the dnn V/UV classifier of DNN_vuv.py, as one .npz of float32 Linear layers with the
+BatchNorm layers folded into them and the PReLU slopes kept. The NumPy outputs are checked against torch, and the
+report compares a NumPy-only converter process with one that imports the training script modules and loads the
+torch checkpoints: start-up time until the weights are ready, peak resident set and latency.
+'''
+
+
+# (prefix, network) of -md in the order the frames go through them
+def make_models(model):
+    if model == 'vuv':
+        return [('net', dnn(40, 1, 128, 256, 512, 512, 256, 128, 64, 32))]
+    return converter_models(model)
+
+
+def load_models(model, folder, epoch):
+    return [load_weights(net, join(folder, "{}_Ep_{}.pth".format(prefix, epoch))).eval() for prefix, net in make_models(model)]
+
+
+# (W (in, out), b, activation, PReLU slope) of the Linear layers of a network in eval mode. Every BatchNorm of dnn
+# follows a Linear layer and is folded into it: W*scale and (b - mean)*scale + beta, with scale = gamma/sqrt(var + eps)
+def dense_layers(net):
+    if isinstance(net, dnn):
+        layers = []
+        for k in range(1, 9):
+            fc, bn, prelu = getattr(net, 'fc%d' % k), getattr(net, 'bn%d' % k), getattr(net, 'prelu%d' % k)
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            layers.append((fc.weight * scale[:, None], (fc.bias - bn.running_mean) * scale + bn.bias, 'prelu', prelu.weight))
+        layers.append((net.out.weight, net.out.bias, 'sigmoid', None))
+    else:
+        # F.leaky_relu of dnn_encoder is a PReLU with the fixed slope 0.01
+        activation, slope = {dnn_generator: ('relu', None), dnn_decoder: ('relu', None), dnn_encoder: ('prelu', torch.tensor([0.01]))}[type(net)]
+        layers = [(fc.weight, fc.bias, activation, slope) for fc in [net.fc1, net.fc2, net.fc3]]
+        layers.append((net.out.weight, net.out.bias, 'linear', None))
+
+    with torch.no_grad():
+        return [(W.t().float().cpu().numpy(), b.float().cpu().numpy(), a, None if s is None else s.float().cpu().numpy()) for W, b, a, s in layers]
+
+
+def export(nets, path):
+    arrays = {}
+    layers = [layer for net in nets for layer in dense_layers(net)]
+    for k, (W, b, activation, slope) in enumerate(layers):
+        arrays['W%d' % k] = W
+        arrays['b%d' % k] = b
+        if slope is not None:
+            arrays['slope%d' % k] = slope
+    np.savez(path, activations=np.array([layer[2] for layer in layers]), **arrays)
+
+
+# Child process of the start-up report: what a converter script does before its first frame, i.e. import the
+# modules of the training scripts (torch, torchvision, matplotlib, scipy, ...) and load the float32 checkpoints
+def torch_converter(model, folder, epoch):
+    importlib.import_module('MMSE_GAN')
+    load_models(model, folder, epoch)
+    print("peak RSS {:.1f} MB".format(peak_rss_mb()))
+
+
+# Median wall time in ms and peak RSS in MB (printed last by the child) of repeats runs of a command
+def process_stats(command, repeats):
+    times, rss = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = subprocess.run(command, capture_output=True, text=True, check=True, cwd=dirname(abspath(__file__))).stdout
+        times.append((time.perf_counter() - start)*1000)
+        rss.append(float(out.split()[-2]))
+    return np.median(times), np.median(rss)
+
+
+def median_ms(call, x, warmup, repeats):
+    for _ in range(warmup):
+        call(x)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call(x)
+        times.append((time.perf_counter() - start)*1000)
+    return np.median(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Export dnn_generator, a Mspec-Net encoder/decoder pair or the V/UV dnn for numpy_runtime.py")
+    parser.add_argument("-md", "--model", type=str, default="mmse", help="mmse (gen), the Mspec-Net conversion whsp2spch, nam2spch or nam2whsp, or vuv (net)")
+    parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Folder of the float32 checkpoints")
+    parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epoch of the checkpoints to export")
+    parser.add_argument("-o", "--output_file", type=str, default="", help="Weights file (default <model>_Ep_<epoch>.npz in the checkpoint folder)")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames of the equivalence check and of the latency report")
+    parser.add_argument("-n", "--repeats", type=int, default=30, help="Timed calls per runtime")
+    parser.add_argument("-w", "--warmup", type=int, default=5, help="Untimed warm-up calls per runtime")
+    parser.add_argument("-pn", "--processes", type=int, default=3, help="Converter processes started per runtime for the start-up report (0 skips it)")
+
+    args = parser.parse_args()
+
+    path = args.output_file or join(args.checkpoint_folder, "{}_Ep_{}.npz".format(args.model, args.test_epoch))
+    if dirname(path):
+        makedirs(dirname(path), exist_ok=True)
+
+    nets = load_models(args.model, args.checkpoint_folder, args.test_epoch)
+    export(nets, path)
+    print("Exported " + path)
+
+    net = torch.nn.Sequential(*nets).cpu()
+    runtime = converter(path)
+    x = torch.randn(args.frames, 40)
+    with torch.no_grad():
+        reference = net(x).numpy()
+    print("Largest difference to torch on {} frames: {:.2e}".format(args.frames, np.abs(runtime(x.numpy()) - reference).max()))
+
+    header = "{:<8} {:>11} {:>10} {:>10}".format("runtime", "start-up", "peak RSS", "latency")
+    print(header)
+    print("-"*len(header))
+
+    rows = [('torch', [sys.executable, '-c', 'import export_numpy; export_numpy.torch_converter({!r}, {!r}, {})'.format(
+                 args.model, abspath(args.checkpoint_folder), args.test_epoch)], lambda a: net(a), x),
+            ('numpy', [sys.executable, 'numpy_runtime.py', '-wf', abspath(path), '-st'], runtime, x.numpy())]
+    for name, command, call, inputs in rows:
+        with torch.no_grad():
+            latency = median_ms(call, inputs, args.warmup, args.repeats)
+        if args.processes > 0:
+            start_up, rss = process_stats(command, args.processes)
+            print("{:<8} {:>9.0f}ms {:>7.1f}MB {:>8.2f}ms".format(name, start_up, rss, latency))
+        else:
+            print("{:<8} {:>11} {:>10} {:>8.2f}ms".format(name, "-", "-", latency))
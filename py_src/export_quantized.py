@@ -0,0 +1,100 @@
+import numpy as np
+from os import makedirs
+from os.path import join, getsize
+from collections import OrderedDict
+
+import torch
+from torch.utils.data import DataLoader
+
+from dataloaders import parallel_dataloader
+from trainer import load_weights
+from evaluation import evaluate_many, segment_mean
+from networks import dnn_generator, dnn_encoder, dnn_decoder, quantized_linear
+from benchmark_networks import forward, latencies, summary
+from utils import batch_mcd
+
+import argparse
+
+'''
+Exports the dynamically quantized (int8 Linear) inference models of the frame-wise converters: the dnn_generator
+of MMSE_GAN.py (gen_Ep_N.pth) or the encoder/decoder pair of one Mspec-Net conversion (-tt). The int8 state_dicts
+are written as <prefix>_int8_Ep_N.pth, which do_testing() of both scripts loads with -qi.
+The report compares float32 and int8 on CPU: MCD on a validation folder of parallel .mat batches (whisper 'Feat'
+against the 'Clean_cent' target of the conversion) and latency/throughput of converting -fr frames.
+'''
+
+
+# Checkpoint prefixes and sizes of every model: (prefix, network) in the order the frames go through them
+def make_models(model):
+    if model == 'mmse':
+        return [('gen', dnn_generator(40, 40, 512, 512, 512))]
+
+    encoder, decoder = {'whsp2spch': ('enc_whp', 'dec_sph'), 'nam2spch': ('enc_nam', 'dec_sph'), 'nam2whsp': ('enc_nam', 'dec_whp')}[model]
+    return [(encoder, dnn_encoder(40, 512, 512, 512, 512)), (decoder, dnn_decoder(512, 40, 512, 512, 512))]
+
+
+def mcd_step(net):
+    def step(a, b, lengths):
+        Gout = net(a)
+        return OrderedDict([('MCD', segment_mean(batch_mcd(Gout[:, 1:], b[:, 1:], 'none'), lengths[0]))])
+    return step
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Dynamic int8 export of dnn_generator or a Mspec-Net encoder/decoder pair")
+    parser.add_argument("-md", "--model", type=str, default="mmse", help="mmse (gen) or the Mspec-Net conversion whsp2spch, nam2spch or nam2whsp")
+    parser.add_argument("-cf", "--checkpoint_folder", type=str, default="../results/checkpoints/mcc/", help="Folder of the float32 checkpoints")
+    parser.add_argument("-et", "--test_epoch", type=int, default=100, help="Epoch of the checkpoints to export")
+    parser.add_argument("-o", "--output_folder", type=str, default="", help="Folder of the int8 checkpoints (default the checkpoint folder)")
+    parser.add_argument("-vf", "--validation_folder", type=str, default="../dataset/features/US_102/batches/mcc/", help="Parallel .mat batches of the MCD report (empty skips it)")
+    parser.add_argument("-fr", "--frames", type=int, default=1000, help="Frames per call of the latency report")
+    parser.add_argument("-n", "--repeats", type=int, default=30, help="Timed calls per model")
+    parser.add_argument("-w", "--warmup", type=int, default=5, help="Untimed warm-up calls per model")
+    parser.add_argument("-th", "--threads", type=int, default=0, help="torch threads (0 keeps the default)")
+
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    output = args.output_folder or args.checkpoint_folder
+    makedirs(output, exist_ok=True)
+
+    models = make_models(args.model)
+    floats, int8s = [], []
+    sizes = OrderedDict([('float32', 0), ('int8', 0)])
+    for prefix, net in models:
+        path = join(args.checkpoint_folder, "{}_Ep_{}.pth".format(prefix, args.test_epoch))
+        net = load_weights(net, path).eval()
+        sizes['float32'] += getsize(path)
+
+        quantized = quantized_linear(net)
+        path = join(output, "{}_int8_Ep_{}.pth".format(prefix, args.test_epoch))
+        torch.save(quantized.state_dict(), path)
+        sizes['int8'] += getsize(path)
+        print("Exported " + path)
+
+        floats.append(net)
+        int8s.append(quantized)
+
+    nets = OrderedDict([('float32', torch.nn.Sequential(*floats)), ('int8', torch.nn.Sequential(*int8s))])
+
+    if args.validation_folder:
+        loader = DataLoader(parallel_dataloader(args.validation_folder), shuffle=False)
+        results = evaluate_many(loader, OrderedDict((name, mcd_step(net)) for name, net in nets.items()))
+        mcd = OrderedDict((name, np.average(u['MCD'], weights=u['frames'])) for name, (u, _) in results.items())
+        print("MCD on {}: float32 {:.4f}, int8 {:.4f} (delta {:+.4f})".format(args.validation_folder, mcd['float32'], mcd['int8'], mcd['int8'] - mcd['float32']))
+
+    x = torch.randn(args.frames, 40)
+    print("CPU capability: {}, threads: {}".format(torch.backends.cpu.get_cpu_capability(), torch.get_num_threads()))
+    header = "{:<8} {:>9} {:>9} {:>9} {:>10} {:>8} {:>9}".format("model", "p50", "p90", "p99", "frames/s", "speedup", "file MB")
+    print(header)
+    print("-"*len(header))
+
+    base = None
+    for name, net in nets.items():
+        r = summary(latencies(forward, net, x, args.warmup, args.repeats), args.frames)
+        base = base or r['p50']
+        print("{:<8} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>10.0f} {:>7.2f}x {:>9.2f}".format(
+            name, r['p50'], r['p90'], r['p99'], r['fps'], base/r['p50'], sizes[name]/2**20))
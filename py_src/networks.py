@@ -1,6 +1,9 @@
 '''
 Here, the generators and discriminators are pre-defined as per the configuration used in research paper.
 '''
+import copy
+import warnings
+import itertools
 import numpy as np
 
 import torch
@@ -103,6 +106,47 @@ class dnn_decoder(nn.Module):
 
 
 
+# Evaluates several identical-shape dnn_encoder (or dnn_decoder) modules on a list of inputs in one pass.
+# forward(inputs, domains) applies the module domains[k] to the (frames, in) tensor inputs[k] and returns the outputs
+# in the same order. Consecutive inputs of the same domain are concatenated, so every layer costs one matmul per
+# run of domains instead of one per input (the Mspec-Net decoders see 8 inputs in 3 runs).
+# The per-domain modules keep owning their parameters, so optimizers and checkpoints are unchanged.
+class dnn_multi_domain(nn.Module):
+    def __init__(self, modules):
+        super(dnn_multi_domain, self).__init__()
+        self.domains = nn.ModuleList(modules)
+        self.p = modules[0].dropout.p
+
+        if isinstance(modules[0], dnn_encoder):
+            self.activation = F.leaky_relu
+        else:
+            self.activation = F.relu
+
+    def layer(self, name, parts, runs, hidden=True, dropout=False):
+        out = []
+        for x, d in zip(parts, runs):
+            x = F.linear(x, getattr(self.domains[d], name).weight, getattr(self.domains[d], name).bias)
+            if hidden:
+                x = self.activation(x)
+            if dropout:
+                x = F.dropout(x, self.p, self.training)
+            out.append(x)
+        return out
+
+    def forward(self, inputs, domains):
+        runs = []
+        parts = []
+        for d, group in itertools.groupby(zip(domains, inputs), key=lambda item: item[0]):
+            runs.append(d)
+            parts.append(torch.cat([x for _, x in group]))
+
+        parts = self.layer('fc1', parts, runs, dropout=True)
+        parts = self.layer('fc2', parts, runs, dropout=True)
+        parts = self.layer('fc3', parts, runs)
+        parts = self.layer('out', parts, runs, hidden=False)
+        return list(torch.cat(parts).split([len(x) for x in inputs]))
+
+
 class dnn(nn.Module):
     
     def weight_init(self):
@@ -394,11 +438,81 @@ class inv_inception(nn.Module):
         return h
 
 
+# Weight and bias of one convolution computing all the given 1x1 convolutions of the same input
+# (Conv2d, or stride 1 ConvTranspose2d whose weight is the transposed one)
+def merged_1x1(convs):
+    weights = [c.weight.transpose(0, 1) if isinstance(c, nn.ConvTranspose2d) else c.weight for c in convs]
+    return torch.cat(weights), torch.cat([c.bias for c in convs])
+
+
+# The one, three and five branches of an inception block all start with a 1x1 projection of the same input:
+# here they run as one convolution (x is read once, one kernel launch) whose output is split between the branches
+def fused_forward(block, x):
+    heads = [block.one[0], block.three[0], block.five[0]]
+    weight, bias = merged_1x1(heads)
+    h1, h2, h3 = F.relu(F.conv2d(x, weight, bias)).split([c.out_channels for c in heads], 1)
+    return torch.cat([h1, block.three[2:](h2), block.five[2:](h3), block.maxp(x)], 1)
+
+
+# Same parameters (and state_dict) as inception and inv_inception, only the forward pass differs
+class fused_inception(inception):
+
+    def forward(self, x):
+        return fused_forward(self, x)
+
+
+class fused_inv_inception(inv_inception):
+
+    def forward(self, x):
+        return fused_forward(self, x)
+
+
+def blocks(fused):
+    return (fused_inception, fused_inv_inception) if fused else (inception, inv_inception)
+
+
+# Conv2d computing the same as a stride 1 ConvTranspose2d: the kernel is flipped and its input/output channels
+# swapped, and the padding becomes kernel-1-padding. CPU kernels of direct convolutions are faster.
+def direct_conv(layer):
+    if layer.stride != (1, 1) or layer.dilation != (1, 1) or layer.groups != 1 or layer.output_padding != (0, 0):
+        raise ValueError("Only stride 1 ConvTranspose2d without dilation, groups or output padding has a direct equivalent")
+
+    padding = tuple(k - 1 - p for k, p in zip(layer.kernel_size, layer.padding))
+    conv = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, padding=padding, bias=layer.bias is not None)
+    with torch.no_grad():
+        conv.weight.copy_(layer.weight.flip(2, 3).transpose(0, 1))
+        if layer.bias is not None:
+            conv.bias.copy_(layer.bias)
+    return conv.to(layer.weight)
+
+
+# Inference copy of a trained network (inception_generator) with every ConvTranspose2d replaced by direct_conv().
+# The weights of the copy are laid out differently: checkpoints keep being saved from and loaded into the original.
+def direct_convs(net):
+    net = copy.deepcopy(net)
+    for module in list(net.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.ConvTranspose2d):
+                setattr(module, name, direct_conv(child))
+    return net
+
+
+# Inference copy of a frame-wise network (dnn_generator, dnn_encoder, dnn_decoder) with dynamically quantized Linear
+# layers: int8 weights, activations quantized per batch on the fly. CPU only. Exported int8 checkpoints are loaded
+# with load_weights(quantized_linear(net), path) into a copy made from a network of the same sizes.
+def quantized_linear(net):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # torch.ao.quantization is deprecated in favour of torchao, which we do not depend on
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(net).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
 class inception_generator(nn.Module):
     
     
-    def __init__(self):
+    # fused uses the blocks with merged 1x1 projections; the weights are the same
+    def __init__(self, fused=False):
         super(inception_generator, self).__init__()
+        inception, inv_inception = blocks(fused)
         
         lower_layers = []
         self.lower_layers = nn.Sequential(*lower_layers)
@@ -424,8 +538,9 @@ class inception_generator(nn.Module):
 class inception_f0_generator(nn.Module):
     
     
-    def __init__(self):
+    def __init__(self, fused=False):
         super(inception_f0_generator, self).__init__()
+        inception, _ = blocks(fused)
         
         lower_layers = []
         self.lower_layers = nn.Sequential(*lower_layers)
@@ -455,8 +570,9 @@ class inception_f0_generator(nn.Module):
 
 class inception_discriminator(nn.Module):
     
-    def __init__(self):
+    def __init__(self, fused=False):
         super(inception_discriminator, self).__init__()
+        inception, _ = blocks(fused)
         
         lower_layers = []
         lower_layers += [nn.Conv2d(1, 32, 7, 2, 3)] # Out: 500x20x32
@@ -495,4 +611,78 @@ class inception_discriminator(nn.Module):
         h1 = self.lower_layers(x)
         h2 = self.inception_layers(h1)
         h2 = h2.view(h2.size(0), -1)
-        return self.final_layers(h2)
\ No newline at end of file
+        return self.final_layers(h2)
+
+
+# (N, 1, frames, 1) mask of the real frames of a zero-padded batch x (N, C, frames, F), lengths (N,) in frames
+def frame_mask(lengths, x):
+    lengths = torch.as_tensor(lengths, device=x.device)
+    return (torch.arange(x.shape[2], device=x.device) < lengths[:, None]).to(x.dtype)[:, None, :, None]
+
+
+# Mean of the feature maps (N, C, T', F') of a discriminator over frequency and over the time steps of the real frames
+# of every utterance: lengths (N,) counts input frames out of frames, and covers T'*length/frames steps (at least one)
+def masked_mean(h, lengths=None, frames=None):
+    if lengths is None:
+        return h.mean((2, 3))
+
+    steps = torch.as_tensor(lengths, device=h.device).mul(h.shape[2]).div(frames).ceil().clamp(1, h.shape[2])
+    mask = (torch.arange(h.shape[2], device=h.device) < steps[:, None]).to(h.dtype)
+    return (h.mean(3) * mask[:, None]).sum(2) / steps[:, None].to(h.dtype)
+
+
+# Discriminators for any number of frames: the flattening Linear head of the 1000x40 networks is replaced by global
+# average pooling of the last feature maps. forward(x, lengths) takes padded batches (N, 1, frames, 40) with the real
+# frames of every utterance in lengths and pools over those only; one output per utterance as before.
+class pooled_cnn_discriminator(cnn_discriminator):
+
+    def __init__(self):
+        super(pooled_cnn_discriminator, self).__init__()
+
+        final_layers = []
+        final_layers += [nn.Linear(256, 1028)]
+        final_layers += [nn.ReLU(True)]
+        final_layers += [nn.Dropout(0.5)]
+        final_layers += [nn.Linear(1028, 1)]
+        final_layers += [nn.Sigmoid()]
+
+        nn.init.xavier_uniform_(final_layers[0].weight)
+        nn.init.xavier_uniform_(final_layers[3].weight)
+
+        self.final_layers = nn.Sequential(*final_layers)
+
+    def forward(self, x, lengths=None):
+        h1 = self.lower_layers(x)
+        return self.final_layers(masked_mean(h1, lengths, x.shape[2]))
+
+
+class pooled_inception_discriminator(inception_discriminator):
+
+    # Shortest input the (25, 2) average pooling after the first stride 2 convolution accepts
+    min_frames = 50
+
+    def __init__(self, fused=False):
+        super(pooled_inception_discriminator, self).__init__(fused)
+        self.inception_layers[-1] = nn.Identity() # The last average pooling only fitted the 1000 frame head
+
+        final_layers = []
+        final_layers += [nn.Linear(496, 1028)]
+        final_layers += [nn.ReLU(True)]
+        final_layers += [nn.Dropout(0.5)]
+        final_layers += [nn.Linear(1028, 1)]
+        final_layers += [nn.Sigmoid()]
+
+        nn.init.xavier_uniform_(final_layers[0].weight)
+        nn.init.xavier_uniform_(final_layers[3].weight)
+
+        self.final_layers = nn.Sequential(*final_layers)
+
+    def forward(self, x, lengths=None):
+        if x.shape[2] < self.min_frames:
+            if lengths is None:
+                lengths = [x.shape[2]]*len(x)
+            x = F.pad(x, (0, 0, 0, self.min_frames - x.shape[2]))
+
+        h1 = self.lower_layers(x)
+        h2 = self.inception_layers(h1)
+        return self.final_layers(masked_mean(h2, lengths, x.shape[2]))
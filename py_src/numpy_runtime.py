@@ -0,0 +1,82 @@
+import numpy as np
+import resource
+from os import listdir, makedirs
+from os.path import join
+
+import argparse
+
+'''
+Inference runtime of the frame-wise converters (dnn_generator, dnn_encoder+dnn_decoder, the dnn V/UV classifier)
+that only needs NumPy: no torch, torchvision, visdom, matplotlib or scipy is imported, so a converter process starts
+in milliseconds with a small resident set. The weights file is written by export_numpy.py from the checkpoints.
+Run as a script it converts a folder of .mcc files into raw float32 files of the same layout.
+'''
+
+
+# A stack of fully connected layers loaded from the .npz of export_numpy.py: W<k> (in, out), b<k> (out,) and the
+# activation of every layer, with the slope<k> of the PReLU (and leaky ReLU) ones. BatchNorm is already folded in.
+class converter(object):
+
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as f:
+            self.activations = [str(a) for a in f['activations']]
+            self.weights = [np.ascontiguousarray(f['W%d' % k], dtype=np.float32) for k in range(len(self.activations))]
+            self.biases = [np.asarray(f['b%d' % k], dtype=np.float32) for k in range(len(self.activations))]
+            self.slopes = [np.asarray(f['slope%d' % k], dtype=np.float32) if 'slope%d' % k in f else None for k in range(len(self.activations))]
+
+    # (frames, in) -> (frames, out), batch_frames frames at a time (0 for all at once) to bound the activations
+    def __call__(self, x, batch_frames=0):
+        x = np.asarray(x, dtype=np.float32)
+        if batch_frames <= 0 or len(x) <= batch_frames:
+            return self.forward(x)
+        return np.concatenate([self.forward(x[start:start + batch_frames]) for start in range(0, len(x), batch_frames)])
+
+    def forward(self, x):
+        for W, b, activation, slope in zip(self.weights, self.biases, self.activations, self.slopes):
+            x = x @ W
+            x += b
+            if activation == 'relu':
+                np.maximum(x, 0, out=x)
+            elif activation == 'prelu':
+                negative = np.minimum(x, 0)
+                negative *= slope
+                np.maximum(x, 0, out=x)
+                x += negative
+            elif activation == 'sigmoid':
+                # exp of -|x| only, so large logits of either sign do not overflow
+                e = np.exp(-np.abs(x))
+                x = np.where(x >= 0, 1, e) / (1 + e)
+        return x
+
+
+# VmHWM of Linux, as ru_maxrss keeps the peak of the parent when a process is started with fork and exec
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            return [int(line.split()[1]) for line in f if line.startswith('VmHWM')][0] / 1024
+    except (OSError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="NumPy-only conversion of .mcc files with the weights of export_numpy.py")
+    parser.add_argument("-wf", "--weights_file", type=str, required=True, help=".npz weights written by export_numpy.py")
+    parser.add_argument("-tf", "--test_folder", type=str, default="", help="Input .mcc files (empty only loads the weights)")
+    parser.add_argument("-sf", "--save_folder", type=str, default="../results/mask/mcc/", help="Folder of the converted raw float32 files")
+    parser.add_argument("-bf", "--batch_frames", type=int, default=0, help="Frames per matrix product (0 converts whole files)")
+    parser.add_argument("-dm", "--dim", type=int, default=40, help="Coefficients per input frame")
+    parser.add_argument("-st", "--stats", action="store_true", help="Print the peak resident set of the process?")
+
+    args = parser.parse_args()
+
+    net = converter(args.weights_file)
+
+    if args.test_folder:
+        makedirs(args.save_folder, exist_ok=True)
+        for name in sorted(listdir(args.test_folder)):
+            d = np.fromfile(join(args.test_folder, name), dtype=np.float32).reshape(-1, args.dim)
+            net(d, args.batch_frames).astype(np.float32).tofile(join(args.save_folder, name))
+
+    if args.stats:
+        print("peak RSS {:.1f} MB".format(peak_rss_mb()))
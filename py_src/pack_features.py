@@ -0,0 +1,19 @@
+from dataloaders import pack_batches
+
+import argparse
+
+'''
+One-time conversion of a folder of .mat batches into a packed float32 store.
+Train on the packed folder afterwards by passing it as the main/validation folder together with --packed.
+'''
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Pack .mat batches into a memory-mapped feature store")
+    parser.add_argument("-i", "--input_folder", type=str, default="../dataset/features/US_102/batches/mcc/", help="Folder with the .mat batches")
+    parser.add_argument("-o", "--output_folder", type=str, default="../dataset/features/US_102/packed/mcc/", help="Folder to write features.bin and index.npz")
+
+    args = parser.parse_args()
+
+    pack_batches(args.input_folder, args.output_folder)
+    print("Packed {} into {}".format(args.input_folder, args.output_folder))
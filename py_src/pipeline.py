@@ -0,0 +1,143 @@
+'''
+Shared data pipeline of the training scripts: dataset selection, worker processes, prefetching and pinned memory.
+'''
+import os
+import random
+import multiprocessing
+
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+from dataloaders import parallel_dataloader, non_parallel_dataloader, packed_dataloader, packed_non_parallel_dataloader
+from dataloaders import mspec_net_speech_data, packed_mspec_net_speech_data
+from dataloaders import frame_pool_dataloader, mspec_frame_pool, frame_batch_sampler, pair_sampler
+from dataloaders import batch_cache, shared_batch_cache
+from dataloaders import utterance_lengths, length_bucket_sampler, pad_collate, padding_report
+
+
+def add_pipeline_args(parser, frame_batching=False, length_batching=False):
+    parser.add_argument("-pk", "--packed", action="store_true", help="Main and validation folders are packed with pack_features.py?")
+    parser.add_argument("-cm", "--cache_mb", type=float, default=0, help="Size in MB of the in-memory LRU cache of decoded batches (0 disables)")
+    parser.add_argument("-sd", "--seed", type=int, default=0, help="Seed of the source/target pairing and of the loader workers")
+    parser.add_argument("-nw", "--num_workers", type=int, default=-1, help="DataLoader worker processes (-1 picks from the CPU count, 0 loads in the main process)")
+    parser.add_argument("-pf", "--prefetch_factor", type=int, default=2, help="Batches prefetched by every worker")
+    parser.add_argument("-npw", "--no_persistent_workers", action="store_true", help="Restart the workers every epoch?")
+    if frame_batching:
+        parser.add_argument("-fb", "--frame_batch", type=int, default=0, help="Frames per shuffled training mini-batch pooled across files (0 keeps one .mat batch per step)")
+    if length_batching:
+        parser.add_argument("-bf", "--bucket_frames", type=int, default=0, help="Padded frames per training batch of utterances of similar length (0 keeps one .mat batch per step)")
+
+
+# Worker processes need fork: on Windows the datasets would be re-imported and pickled per worker,
+# so loading stays in the main process there
+def pipeline_workers(requested):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return 0
+    if requested >= 0:
+        return requested
+    return min(4, max((os.cpu_count() or 1) - 1, 0))
+
+
+# torch already seeds every worker differently; numpy and random follow its seed
+def seed_worker(worker_id):
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def make_dataloader(dataset, args, shuffle=True, sampler=None, batch_size=1, batch_sampler=None, collate_fn=None):
+    workers = pipeline_workers(args.num_workers)
+
+    if batch_sampler is not None:
+        kwargs = dict(dataset=dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    else:
+        kwargs = dict(dataset=dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler)
+    kwargs.update(num_workers=workers, pin_memory=torch.cuda.is_available())
+    if workers > 0:
+        kwargs.update(worker_init_fn=seed_worker, multiprocessing_context='fork', prefetch_factor=args.prefetch_factor,
+                      persistent_workers=not args.no_persistent_workers)
+
+    return DataLoader(**kwargs)
+
+
+# Cache of decoded batches; it lives in a manager process when workers are used so that they share it
+def make_cache(args):
+    if args.cache_mb <= 0:
+        return None
+
+    max_bytes = int(args.cache_mb * 2**20)
+    if pipeline_workers(args.num_workers) > 0:
+        return shared_batch_cache(max_bytes)
+    return batch_cache(max_bytes)
+
+
+def print_padding(sampler):
+    r = padding_report(sampler.lengths, sampler.batches())
+    print("Length buckets: {} utterances in {} batches, {} real frames; {} frames computed ({:.1f}% padding) against {} "
+          "in zero-padded 1000 frame pieces ({:.1f}% padding): {:.1f}% fewer frames and convolution FLOPs".format(
+          r['utterances'], r['batches'], r['real'], r['bucketed'], 100*(1 - r['real']/r['bucketed']), r['pieces'],
+          100*(1 - r['real']/r['pieces']), 100*r['saved']))
+
+
+# Training and validation loaders of the single-folder scripts
+def make_loaders(args, mainfolder, validation):
+    np.random.seed(args.seed)
+    cache = make_cache(args)
+
+    if args.nonparallel and args.packed:
+        custom_dataloader = packed_non_parallel_dataloader
+    elif args.nonparallel:
+        custom_dataloader = non_parallel_dataloader
+    elif args.packed:
+        custom_dataloader = packed_dataloader
+    else:
+        custom_dataloader = parallel_dataloader
+
+    if getattr(args, 'frame_batch', 0) > 0:
+        traindata = frame_pool_dataloader(folder_path=mainfolder, packed=args.packed, nonparallel=args.nonparallel)
+        train_sampler = frame_batch_sampler(len(traindata), args.frame_batch, seed=args.seed, n_targets=len(traindata) if args.nonparallel else 0)
+        train_dataloader = make_dataloader(traindata, args, sampler=train_sampler, batch_size=None)
+    elif getattr(args, 'bucket_frames', 0) > 0:
+        if args.nonparallel:
+            raise ValueError("Length buckets need parallel data: source and target of an utterance are padded together")
+        traindata = custom_dataloader(folder_path=mainfolder, cache=cache)
+        train_sampler = length_bucket_sampler(utterance_lengths(traindata), args.bucket_frames, seed=args.seed)
+        train_dataloader = make_dataloader(traindata, args, batch_sampler=train_sampler, collate_fn=pad_collate)
+        print_padding(train_sampler)
+    else:
+        traindata = custom_dataloader(folder_path=mainfolder, cache=cache)
+        train_sampler = pair_sampler(len(traindata), len(traindata), seed=args.seed) if args.nonparallel else None
+        train_dataloader = make_dataloader(traindata, args, sampler=train_sampler)
+
+    # Validation keeps the file order, so per-utterance results line up between epochs
+    valdata = custom_dataloader(folder_path=validation, cache=cache)
+    val_sampler = pair_sampler(len(valdata), len(valdata), seed=args.seed, shuffle=False) if args.nonparallel else None
+    val_dataloader = make_dataloader(valdata, args, shuffle=False, sampler=val_sampler)
+
+    return train_dataloader, val_dataloader, cache
+
+
+# Training and validation loaders of MSpeC-Net (NAM-Whisper and Whisper-Speech folders)
+def make_mspec_loaders(args, mainfolder1, mainfolder2, validation):
+    np.random.seed(args.seed)
+    cache = make_cache(args)
+
+    if args.packed:
+        custom_dataloader = packed_mspec_net_speech_data
+    else:
+        custom_dataloader = mspec_net_speech_data
+
+    if getattr(args, 'frame_batch', 0) > 0:
+        traindata = mspec_frame_pool(folder1=mainfolder1, folder2=mainfolder2, packed=args.packed)
+        train_sampler = frame_batch_sampler(len(traindata), args.frame_batch, seed=args.seed, n_targets=len(traindata.pool2))
+        train_dataloader = make_dataloader(traindata, args, sampler=train_sampler, batch_size=None)
+    else:
+        traindata = custom_dataloader(folder1=mainfolder1, folder2=mainfolder2, cache=cache)
+        train_dataloader = make_dataloader(traindata, args, sampler=traindata.pairs(seed=args.seed))
+
+    valdata = custom_dataloader(folder1=validation, folder2=validation, cache=cache)
+    val_dataloader = make_dataloader(valdata, args, sampler=valdata.pairs(seed=args.seed, shuffle=False))
+
+    return train_dataloader, val_dataloader, cache
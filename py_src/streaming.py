@@ -0,0 +1,91 @@
+import numpy as np
+import time
+
+'''
+Streaming conversion for the live use case: blocks of MCC frames are pushed as they arrive, micro-batched and
+converted within a latency budget, and the converted blocks are emitted in arrival order. The converters are
+frame-wise (dnn_generator, or the enc_whp -> dec_sph path of Mspec-Net), so a micro-batch gives the same frames as
+converting the whole file. Any convert(frames) -> frames callable on (frames, 40) float32 arrays works: the
+NumPy runtime of export_numpy.py, or torch_convert() of a network. This module itself does not import torch.
+'''
+
+
+# Numpy frames in and out of a torch network (a generator, or nn.Sequential(encoder, decoder)) on the CPU. It runs
+# an eval copy, so the caller's network keeps its device and mode (e.g. when it is still being trained).
+def torch_convert(net):
+    import copy
+    import torch
+    net = copy.deepcopy(net).cpu().eval()
+
+    def convert(x):
+        with torch.inference_mode():
+            return net(torch.from_numpy(x)).numpy()
+    return convert
+
+
+# Pending blocks are converted together once waiting any longer would make the oldest one miss the budget (from its
+# push to its emission), predicted with a cost model overhead + per_frame*frames of one call, or once max_frames
+# frames are pending. push() and poll() return the converted blocks that are ready; the caller polls while no
+# block arrives, and deadline() tells until when it may sleep. clock is in seconds (time.perf_counter by default).
+class stream_converter(object):
+
+    def __init__(self, convert, budget_ms, max_frames=1000, clock=time.perf_counter, dim=40):
+        self.convert = convert
+        self.budget = budget_ms/1000
+        self.max_frames = max_frames
+        self.clock = clock
+        self.pending = []
+        self.frames = 0
+        self.calibrate(dim)
+
+    # Fits the cost model on calls of 1 and max_frames frames
+    def calibrate(self, dim, repeats=5):
+        times = []
+        for n in [1, self.max_frames]:
+            x = np.zeros((n, dim), dtype=np.float32)
+            self.convert(x)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                self.convert(x)
+            times.append((time.perf_counter() - start)/repeats)
+
+        self.overhead = times[0]
+        self.per_frame = max(times[1] - times[0], 0)/max(self.max_frames - 1, 1)
+
+    def cost(self, frames):
+        return self.overhead + self.per_frame*frames
+
+    # Latest clock time at which the pending frames can be converted within the budget of the oldest block
+    def deadline(self):
+        if not self.pending:
+            return None
+        return self.pending[0][0] + self.budget - self.cost(self.frames)
+
+    def push(self, block):
+        self.pending.append((self.clock(), np.asarray(block, dtype=np.float32)))
+        self.frames += len(block)
+        return self.poll()
+
+    def poll(self):
+        if self.pending and (self.frames >= self.max_frames or self.clock() >= self.deadline()):
+            return self.run()
+        return []
+
+    # Converts whatever is pending, e.g. at the end of the stream
+    def flush(self):
+        if self.pending:
+            return self.run()
+        return []
+
+    def run(self):
+        blocks = [block for _, block in self.pending]
+        self.pending, self.frames = [], 0
+
+        start = time.perf_counter()
+        out = self.convert(np.concatenate(blocks))
+        # The overhead follows the measured calls, so the deadlines adapt to the load of the machine: it rises at once
+        # after a slower call and decays slowly, so the deadlines err on the early side
+        residual = time.perf_counter() - start - self.cost(len(out))
+        self.overhead = max(self.overhead + (residual if residual > 0 else 0.05*residual), 0)
+
+        return np.split(out, np.cumsum([len(block) for block in blocks])[:-1])
@@ -0,0 +1,86 @@
+import sys
+import json
+import tempfile
+import subprocess
+import os
+from os import makedirs
+from os.path import join, dirname, abspath
+
+import numpy as np
+
+import torch
+from scipy.io import savemat
+
+'''
+Resume check of trainer.checkpointer for every training sampler of pipeline.py: a run of 3 epochs and a run of
+2 epochs resumed (-rs) for the third must end with the same weights, and the resumed run keeps the validation
+history of the first 2 epochs. Runs the training scripts on a few synthetic .mat batches in a temporary folder.
+Run with pytest, or as a script.
+'''
+
+
+# Parallel .mat batches of the given lengths, with 'Feat' and 'Clean_cent' like the feature extraction writes them
+def make_batches(folder, lengths, seed=0):
+    makedirs(folder)
+    rng = np.random.RandomState(seed)
+    for n, frames in enumerate(lengths):
+        feat = rng.randn(frames, 40).astype(np.float32)
+        savemat(join(folder, "{}.mat".format(n)), mdict={'Feat': feat, 'Clean_cent': feat + 0.1*rng.randn(frames, 40).astype(np.float32)})
+
+
+# The scripts leave the initial weights unseeded, so both runs seed torch before running them
+def train(script, flags, data, checkpoint, epochs, resume=False):
+    arguments = [script, '-tr', '-e', str(epochs), '-ci', '1', '-mf', data, '-vf', data, '-cf', checkpoint, '-nw', '0'] + flags
+    if resume:
+        arguments.append('-rs')
+    command = [sys.executable, '-c', "import sys, runpy, torch; torch.manual_seed(0); sys.argv = {!r}; runpy.run_path({!r}, run_name='__main__')".format(arguments, script)]
+    subprocess.run(command, check=True, capture_output=True, cwd=dirname(abspath(__file__)), env=dict(os.environ, MPLBACKEND='Agg'))
+
+
+def check_resume(script, flags, lengths=(600, 600, 600, 600)):
+    with tempfile.TemporaryDirectory() as folder:
+        data = join(folder, 'data')
+        make_batches(data, lengths)
+
+        train(script, flags, data, join(folder, 'straight'), 3)
+        train(script, flags, data, join(folder, 'resumed'), 2)
+        train(script, flags, data, join(folder, 'resumed'), 3, resume=True)
+
+        # Every network of the trainer, discriminators included
+        straight = torch.load(join(folder, 'straight', 'state_Ep_3.pth'), weights_only=True)['nets']
+        resumed = torch.load(join(folder, 'resumed', 'state_Ep_3.pth'), weights_only=True)['nets']
+        for net in straight:
+            for name in straight[net]:
+                assert torch.equal(straight[net][name], resumed[net][name]), "{} {}: {}.{} differs after resuming".format(script, flags, net, name)
+
+        with open(join(folder, 'straight', 'history.json')) as f:
+            expected = json.load(f)
+        with open(join(folder, 'resumed', 'history.json')) as f:
+            assert json.load(f) == expected
+
+
+def test_parallel():
+    check_resume('MMSE_GAN.py', [])
+
+
+def test_pair_sampler():
+    check_resume('MMSE_GAN.py', ['-np', '1'])
+
+
+def test_frame_batch_sampler():
+    check_resume('MMSE_GAN.py', ['-fb', '700'])
+
+
+def test_non_parallel_frame_batch_sampler():
+    check_resume('MMSE_GAN.py', ['-fb', '700', '-np', '1'])
+
+
+def test_length_bucket_sampler():
+    check_resume('CNN_GAN.py', ['-pd', '-bf', '1200'], lengths=(300, 420, 510, 640, 380, 560))
+
+
+if __name__ == '__main__':
+
+    for test in [test_parallel, test_pair_sampler, test_frame_batch_sampler, test_non_parallel_frame_batch_sampler, test_length_bucket_sampler]:
+        test()
+        print(test.__name__ + " passed")
@@ -0,0 +1,639 @@
+'''
+Shared training engine of the scripts in py_src.
+
+A script only supplies two step functions:
+    train_step(*batch)          -> OrderedDict of named losses of the step (averaged and logged by metric_logger)
+    val_step(*fields, lengths)  -> OrderedDict of named metrics of every utterance of a group (see evaluation.py)
+Everything around them (train/eval switching, epochs, checkpoints, validation history, plots) lives here.
+Extra behaviour is plugged in through hooks, see standard_hooks().
+'''
+import os
+import re
+import csv
+import copy
+import json
+import time
+import queue
+import pickle
+import threading
+import contextlib
+from collections import OrderedDict
+from os import makedirs, listdir
+from os.path import join, exists
+
+import numpy as np
+
+import torch
+import matplotlib.pyplot as plt
+from scipy.io import savemat
+
+from evaluation import evaluate
+
+
+class trainer(object):
+
+    def __init__(self, nets, train_step, val_step, hooks=(), eval_group=1, eval_stack=False):
+        self.nets = nets                                # OrderedDict of every network of the model
+        self.train_step = train_step
+        self.val_step = val_step
+        self.hooks = list(hooks)
+
+        # Validation utterances per forward pass, concatenated along the frames or stacked (image networks)
+        self.eval_group = eval_group
+        self.eval_stack = eval_stack
+        self.utterances = None                          # Per-utterance metrics of the last validation
+
+        # Factories of context managers entered around every train/val step (mixed precision, profiler ranges, ...)
+        self.contexts = []
+
+        self.timer = phase_timer()                      # Replaced by the phase_timer hook of -pt (off by default)
+
+        self.epoch = 0
+        self.step = 0
+        self.start_epoch = 0                            # First epoch index of fit(), moved forward when resuming
+        self.train_loader = None                        # Loader of the running fit()
+
+    def call(self, event, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(self, *args)
+
+    def step_context(self):
+        stack = contextlib.ExitStack()
+        for context in self.contexts:
+            stack.enter_context(context())
+        return stack
+
+    def train_epoch(self, data_loader):
+        for net in self.nets.values():
+            net.train()
+
+        n_steps = len(data_loader)
+        for en, batch in enumerate(self.timer.iterate('data', data_loader)):
+            with self.step_context():
+                losses = self.train_step(*batch)
+            self.step += 1
+            with self.timer('metrics'):
+                self.call('end_step', en, n_steps, losses)
+
+    def validate(self, data_loader):
+        for net in self.nets.values():
+            net.eval()
+
+        # The loader draws from the global generator; validation leaves it alone, so the training randomness does not
+        # depend on the validation interval and a resumed run continues like an uninterrupted one
+        with torch.random.fork_rng(devices=[]):
+            self.utterances, metrics = evaluate(data_loader, self.val_step, self.eval_group, self.eval_stack, self.step_context)
+        return metrics
+
+    def fit(self, train_loader, val_loader, epochs, validation_interval=1, start_epoch=0):
+        self.start_epoch = start_epoch
+        self.train_loader = train_loader
+        self.call('begin_training')
+
+        for ep in range(self.start_epoch, epochs):
+            self.epoch = ep+1
+            self.call('begin_epoch')
+            self.train_epoch(train_loader)
+            self.call('end_epoch')
+
+            if (ep+1)%validation_interval==0:
+                metrics = self.validate(val_loader)
+                self.call('end_validation', metrics)
+
+        self.call('end_training')
+
+
+# Base class of the hooks; every event is a no-op unless overridden
+class hook(object):
+
+    def begin_training(self, trainer):
+        pass
+
+    def begin_epoch(self, trainer):
+        pass
+
+    def end_step(self, trainer, step, n_steps, losses):
+        pass
+
+    def end_epoch(self, trainer):
+        pass
+
+    def end_validation(self, trainer, metrics):
+        pass
+
+    def end_training(self, trainer):
+        pass
+
+
+# Appends metric records to <folder>/metrics.jsonl, one JSON object per record, or to metrics.csv with one
+# time,epoch,step,phase,name,value row per metric, so that training and validation records share the columns
+class metrics_file(object):
+
+    def __init__(self, folder, fmt='jsonl'):
+        makedirs(folder, exist_ok=True)
+        self.fmt = fmt
+        path = join(folder, 'metrics.' + fmt)
+        new = not exists(path)
+        self.file = open(path, 'a', newline='')
+        if fmt == 'csv':
+            self.csv = csv.writer(self.file)
+            if new:
+                self.csv.writerow(['time', 'epoch', 'step', 'phase', 'name', 'value'])
+
+    def write(self, phase, epoch, step, metrics):
+        now = round(time.time(), 3)
+        if self.fmt == 'csv':
+            for name, value in metrics.items():
+                self.csv.writerow([now, epoch, step, phase, name, value])
+        else:
+            record = OrderedDict([('time', now), ('epoch', epoch), ('step', step), ('phase', phase)])
+            record.update(metrics)
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Averages the step losses over windows of interval steps. The losses stay on the device, so the training loop never
+# waits for the GPU, the terminal or a server: they are only read back when a window or an epoch ends, then printed as
+# "[Epoch: 1] [Iter: 49/400] [D loss: 0.69] [G loss: 1.2]" and appended to the metrics file. The validation metrics
+# are appended after every validation. With viz, the window means are also plotted on Visdom.
+class metric_logger(hook):
+
+    def __init__(self, folder, interval, fmt='jsonl', viz=None):
+        self.folder = folder
+        self.interval = interval
+        self.fmt = fmt
+        self.viz = viz
+        self.file = None
+        self.values = OrderedDict()                     # Detached losses of the steps of the current window
+        self.count = 0
+        self.last = (0, 0)                              # (step, steps) of the epoch at the last end_step
+        self.windows = {}
+
+    def begin_training(self, trainer):
+        self.file = metrics_file(self.folder, self.fmt)
+
+    def end_step(self, trainer, step, n_steps, losses):
+        for name, value in losses.items():
+            self.values.setdefault(name, []).append(value.detach() if torch.is_tensor(value) else value)
+        self.count += 1
+        self.last = (step, n_steps)
+
+        if self.count == self.interval:
+            self.flush(trainer)
+
+    def flush(self, trainer):
+        if self.count == 0:
+            return
+        means = OrderedDict((name, float(torch.stack(values).float().mean()) if torch.is_tensor(values[0]) else float(np.mean(values)))
+                            for name, values in self.values.items())
+        self.values.clear()
+        self.count = 0
+
+        line = "[Epoch: %d] [Iter: %d/%d]" % ((trainer.epoch,) + self.last)
+        for name, value in means.items():
+            line += " [%s: %f]" % (name, value)
+        print(line)
+
+        self.file.write('train', trainer.epoch, trainer.step, means)
+        if self.viz is not None:
+            self.plot(trainer.step, means)
+
+    def plot(self, step, means):
+        for name, value in means.items():
+            if name not in self.windows:
+                self.windows[name] = self.viz.line(Y=np.array([value]), X=np.array([step]), opts=dict(title=name))
+            else:
+                self.viz.line(Y=np.array([value]), X=np.array([step]), win=self.windows[name], update='append')
+
+    def end_epoch(self, trainer):
+        self.flush(trainer)
+
+    def end_validation(self, trainer, metrics):
+        self.file.write('val', trainer.epoch, trainer.step, OrderedDict((key, float(value)) for key, value in metrics.items()))
+
+    def end_training(self, trainer):
+        self.file.close()
+
+
+# Visdom is optional: the scripts only connect to a server with -vz
+def connect_visdom(enabled):
+    if not enabled:
+        return None
+    import visdom
+    return visdom.Visdom()
+
+
+# Copy of a (nested) state_dict with every tensor copied to CPU memory, so training can go on while it is written.
+# Tensors already copied into memo (same storage, shape and stride) are shared instead of copied again.
+def snapshot(state, memo=None):
+    memo = {} if memo is None else memo
+    if torch.is_tensor(state):
+        key = (state.device, state.data_ptr(), state.dtype, state.shape, state.stride())
+        if key not in memo:
+            memo[key] = state.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value, memo)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, memo) for value in state)
+    return state
+
+
+# Writes checkpoints on a background thread, in submission order. Every file is written to <path>.tmp and renamed
+# into place, so a preempted job never leaves a truncated checkpoint behind.
+class checkpoint_writer(object):
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            path, state = self.queue.get()
+            try:
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, path, state):
+        self.check()
+        self.queue.put((path, state))
+
+    # Blocks until everything submitted is on disk
+    def wait(self):
+        self.queue.join()
+        self.check()
+
+
+# Epoch of the latest state_Ep_<epoch>.pth in folder, 0 if there is none
+def latest_epoch(folder):
+    if not exists(folder):
+        return 0
+    epochs = [int(m.group(1)) for m in map(re.compile(r'state_Ep_(\d+)\.pth$').match, listdir(folder)) if m]
+    return max(epochs, default=0)
+
+
+# Loads the weights of a <prefix>_Ep_<epoch>.pth checkpoint into net (or into a copy of it with clone=True) and returns it.
+# Checkpoints written before the state_dict format hold the whole pickled module; its weights are used.
+def load_weights(net, path, clone=False):
+    try:
+        state = torch.load(path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError:
+        state = torch.load(path, map_location='cpu', weights_only=False).state_dict()
+
+    if clone:
+        net = copy.deepcopy(net)
+    net.load_state_dict(state)
+    return net
+
+
+# Every interval epochs, saves the state_dict of every network of saves as <prefix>_Ep_<epoch>.pth, followed by
+# state_Ep_<epoch>.pth holding all networks of the trainer and the optimizers, which is what resume starts from.
+# The states are snapshotted in memory at the end of the epoch and written by a checkpoint_writer.
+class checkpointer(hook):
+
+    def __init__(self, folder, saves, interval, optimizers=None, resume=False):
+        self.folder = folder
+        self.saves = saves                              # OrderedDict of file prefix -> network
+        self.interval = interval
+        self.optimizers = optimizers or OrderedDict()   # OrderedDict of name -> optimizer
+        self.resume = resume
+        self.writer = checkpoint_writer()
+
+    def begin_training(self, trainer):
+        epoch = latest_epoch(self.folder) if self.resume else 0
+        if epoch == 0:
+            return
+
+        state = torch.load(join(self.folder, "state_Ep_{}.pth".format(epoch)), map_location='cpu', weights_only=True)
+        for name, net in trainer.nets.items():
+            net.load_state_dict(state['nets'][name])
+        for name, optimizer in self.optimizers.items():
+            optimizer.load_state_dict(state['optimizers'][name])
+
+        torch.set_rng_state(state['rng'])
+        if torch.cuda.is_available() and state['cuda_rng']:
+            torch.cuda.set_rng_state_all(state['cuda_rng'])
+
+        trainer.start_epoch = max(trainer.start_epoch, epoch)
+        trainer.step = state['step']
+        print("Resuming after epoch {}".format(epoch))
+
+    def end_epoch(self, trainer):
+        if trainer.epoch%self.interval==0:
+            memo = {}
+            for prefix, net in self.saves.items():
+                self.writer.write(join(self.folder, "{}_Ep_{}.pth".format(prefix, trainer.epoch)), snapshot(net.state_dict(), memo))
+
+            # The random generators are kept so that a resumed run shuffles and drops out like an uninterrupted one; the
+            # samplers of pipeline.py draw from (seed, epoch) instead (see sampler_epochs). Persistent loader workers
+            # draw their seeds once, on the first epoch of a run, so a resumed run matches only without them (-npw)
+            state = dict(epoch=trainer.epoch, step=trainer.step, rng=torch.get_rng_state(),
+                         cuda_rng=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                         nets=OrderedDict((name, net.state_dict()) for name, net in trainer.nets.items()),
+                         optimizers=OrderedDict((name, optimizer.state_dict()) for name, optimizer in self.optimizers.items()))
+            self.writer.write(join(self.folder, "state_Ep_{}.pth".format(trainer.epoch)), snapshot(state, memo))
+
+    def end_training(self, trainer):
+        self.writer.wait()
+
+
+# Sets the epoch of the training sampler (pair_sampler, frame_batch_sampler, length_bucket_sampler) before every
+# epoch, so that a resumed run draws the batches of an uninterrupted one
+class sampler_epochs(hook):
+
+    def begin_epoch(self, trainer):
+        for sampler in [trainer.train_loader.sampler, trainer.train_loader.batch_sampler]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(trainer.epoch-1)
+
+
+# Keeps the validation metrics of every epoch, plots them on Visdom (-vz) and writes <name>.mat/<name>.png at the end.
+# plots is a list of (metric, plot title, file name) in the order of the figures. The values are also kept in
+# <folder>/history.json, from which a resumed run restores the epochs before it.
+class history(hook):
+
+    def __init__(self, folder, plots, viz=None):
+        self.folder = folder
+        self.plots = plots
+        self.viz = viz
+        self.epochs = []
+        self.values = OrderedDict((key, []) for key, _, _ in plots)
+        self.windows = {}
+
+    def begin_training(self, trainer):
+        path = join(self.folder, 'history.json')
+        if trainer.start_epoch == 0 or not exists(path):
+            return
+
+        with open(path) as f:
+            saved = json.load(f)
+        # Epochs after the resumed checkpoint are trained again
+        for n, epoch in enumerate(saved['epochs']):
+            if epoch <= trainer.start_epoch:
+                self.append(epoch, OrderedDict((key, saved['values'][key][n]) for key in self.values))
+
+    def end_validation(self, trainer, metrics):
+        print(" ".join("{}: {}".format(key, value) for key, value in metrics.items()))
+
+        self.append(trainer.epoch, OrderedDict((key, float(metrics[key])) for key in self.values))
+        path = join(self.folder, 'history.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(epochs=self.epochs, values=self.values), f)
+        os.replace(path + '.tmp', path)
+
+    def append(self, epoch, values):
+        self.epochs.append(epoch)
+
+        x = np.array([epoch-1])
+        for key, title, _ in self.plots:
+            self.values[key].append(values[key])
+
+            if self.viz is None:
+                continue
+            if key not in self.windows:
+                self.windows[key] = self.viz.line(Y=np.array([values[key]]), X=x, opts=dict(title=title))
+            else:
+                self.viz.line(Y=np.array([values[key]]), X=x, win=self.windows[key], update='append')
+
+    def end_training(self, trainer):
+        for n, (key, _, name) in enumerate(self.plots):
+            savemat(join(self.folder, name+'.mat'),  mdict={'foo': self.values[key]})
+
+            plt.figure(n+1)
+            plt.plot(self.values[key])
+            plt.savefig(join(self.folder, name+'.png'))
+
+
+# Prints the hit/miss counters of the batch cache after every epoch
+class cache_report(hook):
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def end_epoch(self, trainer):
+        print("Batch cache: " + str(self.cache.stats()))
+
+
+# Opt-in mixed precision (-ac bf16): every train/val step, and the inference of do_testing(), runs under
+# torch.autocast in bfloat16. bfloat16 keeps the exponent range of float32, so gradients need no loss scaling.
+class precision(hook):
+
+    def __init__(self, mode, device):
+        self.dtype = torch.bfloat16 if mode == 'bf16' else None
+        self.device_type = torch.device(device).type
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.dtype is not None)
+
+    def begin_training(self, trainer):
+        if self.dtype is not None:
+            trainer.contexts.append(self.autocast)
+
+
+# Opt-in graph compilation (-co): networks are compiled in place with nn.Module.compile, which keeps the module
+# objects the step functions refer to. Graphs are specialised to static shapes (training batches are 1000 frames,
+# do_testing() cuts files into equal, zero-padded chunks) unless dynamic is None, which lets torch mark the frames
+# dynamic once they change (variable length training with the pooled discriminators). The compiled kernels are kept
+# in cache_dir across runs: inductor's on-disk caches live there, and a portable artifact bundle is saved on exit
+# and preloaded on start.
+class compiler(hook):
+
+    def __init__(self, enabled, cache_dir, frames=1000, dynamic=False):
+        self.enabled = enabled
+        self.cache_dir = cache_dir
+        self.frames = frames
+        self.dynamic = dynamic
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+
+        makedirs(self.cache_dir, exist_ok=True)
+        # Set unconditionally: importing torchvision already points inductor at a per-user folder in /tmp
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = join(self.cache_dir, 'inductor')
+
+        artifacts = join(self.cache_dir, 'artifacts.bin')
+        if exists(artifacts) and hasattr(torch.compiler, 'load_cache_artifacts'):
+            with open(artifacts, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+
+    def save(self):
+        if not self.enabled or not hasattr(torch.compiler, 'save_cache_artifacts'):
+            return
+        saved = torch.compiler.save_cache_artifacts()
+        if saved is None:
+            return
+
+        # Written next to the final name and renamed, so a concurrent job never reads half a bundle
+        artifacts = join(self.cache_dir, 'artifacts.bin')
+        with open(artifacts + '.tmp', 'wb') as f:
+            f.write(saved[0])
+        os.replace(artifacts + '.tmp', artifacts)
+
+    def compile(self, net, dynamic=False):
+        if self.enabled:
+            self.load()
+            net.compile(dynamic=dynamic)
+        return net
+
+    # Chunk length of do_testing(): whole files have arbitrary lengths, so compiled runs use the training length
+    def chunk_frames(self, requested):
+        if self.enabled and requested <= 0:
+            return self.frames
+        return requested
+
+    # Zero-pads the last, shorter chunk of a file to the chunk length; crop the output with [:len(chunk)]
+    def pad(self, chunk, frames):
+        if self.enabled and 0 < len(chunk) < frames:
+            return np.concatenate([chunk, np.zeros((frames - len(chunk), chunk.shape[1]), dtype=chunk.dtype)])
+        return chunk
+
+    def begin_training(self, trainer):
+        for net in trainer.nets.values():
+            self.compile(net, self.dynamic)
+
+    def end_training(self, trainer):
+        self.save()
+
+
+# Wall time of the phases of the training steps (-pt). The trainer times the wait for every batch ('data') and the
+# hooks run after every step ('metrics'); step functions mark their own phases with "with timer('G forward'):".
+# Phases are also torch.profiler ranges, so they show up by name in -pr traces. On CUDA every phase boundary
+# synchronizes the device, so kernels are charged to the phase that launched them. A table is printed after every
+# epoch. When off, timer(name) returns a shared no-op context.
+class phase_timer(hook):
+
+    def __init__(self, enabled=False, device='cpu'):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.times = OrderedDict()
+        self.steps = 0
+        self.start = 0.0
+
+    def __call__(self, name):
+        if not self.enabled:
+            return no_phase
+        return self.phase(name)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with torch.profiler.record_function(name):
+            self.sync()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.sync()
+                self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    # Items of iterable, timing the wait for every one of them as phase name
+    def iterate(self, name, iterable):
+        if not self.enabled:
+            return iterable
+        return self.timed(name, iter(iterable))
+
+    def timed(self, name, iterator):
+        while True:
+            with self(name):
+                item = next(iterator, no_phase)
+            if item is no_phase:
+                return
+            yield item
+
+    def begin_training(self, trainer):
+        trainer.timer = self
+
+    def begin_epoch(self, trainer):
+        self.times.clear()
+        self.steps = 0
+        self.start = time.perf_counter()
+
+    def end_step(self, trainer, step, n_steps, losses):
+        self.steps += 1
+
+    def end_epoch(self, trainer):
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.start
+        rows = list(self.times.items()) + [('other', total - sum(self.times.values())), ('epoch', total)]
+
+        print("{:<12} {:>10} {:>10} {:>7}".format("phase", "total s", "ms/step", "%"))
+        for name, seconds in rows:
+            print("{:<12} {:>10.2f} {:>10.2f} {:>7.1f}".format(name, seconds, 1e3 * seconds / max(self.steps, 1), 100 * seconds / total))
+
+no_phase = contextlib.nullcontext()
+
+
+# Records a torch.profiler trace of the steps [wait+warmup, wait+warmup+active) into folder
+class profiler_hook(hook):
+
+    def __init__(self, folder, active, wait=1, warmup=1):
+        self.folder = folder
+        self.schedule = torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1)
+        self.profiler = None
+
+    def begin_training(self, trainer):
+        self.profiler = torch.profiler.profile(schedule=self.schedule, on_trace_ready=torch.profiler.tensorboard_trace_handler(self.folder),
+                                               record_shapes=True, profile_memory=True)
+        self.profiler.start()
+
+    def end_step(self, trainer, step, n_steps, losses):
+        self.profiler.step()
+
+    def end_training(self, trainer):
+        self.profiler.stop()
+
+
+def add_trainer_args(parser):
+    parser.add_argument("-ac", "--autocast", type=str, default='fp32', choices=['fp32', 'bf16'], help="Precision of training and testing (bf16 runs under torch.autocast)")
+    parser.add_argument("-co", "--compile", action="store_true", help="Compile the networks with torch.compile for training and testing?")
+    parser.add_argument("-cc", "--compile_cache", type=str, default="../results/compile_cache/", help="Folder keeping the compiled kernels between runs")
+    parser.add_argument("-eg", "--eval_group", type=int, default=-1, help="Validation utterances evaluated per forward pass (-1 picks 8 on CUDA, 1 on CPU)")
+    parser.add_argument("-li", "--log_interval", type=int, default=50, help="Training steps averaged per printed and logged line of losses")
+    parser.add_argument("-lf", "--log_format", type=str, default='jsonl', choices=['jsonl', 'csv'], help="Format of the metrics file appended in the checkpoint folder")
+    parser.add_argument("-vz", "--visdom", action="store_true", help="Plot the losses and validation metrics on a Visdom server?")
+    parser.add_argument("-rs", "--resume", action="store_true", help="Resume training from the latest state_Ep_<epoch>.pth of the checkpoint folder?")
+    parser.add_argument("-pr", "--profile_steps", type=int, default=0, help="Record a torch.profiler trace of this many training steps into the checkpoint folder (0 disables)")
+    parser.add_argument("-pw", "--profile_wait", type=int, default=1, help="Training steps skipped before the profiler warms up and records")
+    parser.add_argument("-pt", "--phase_times", action="store_true", help="Time the phases of the training steps and print a table after every epoch (names the phases in -pr traces)?")
+
+
+# Hooks every training script uses: logged losses, phase times, precision, compilation, batch cache counters, checkpoints,
+# sampler epochs and validation history
+def standard_hooks(args, checkpoint, saves, plots, cache=None, amp=None, jit=None, optimizers=None, timer=None):
+    viz = connect_visdom(args.visdom)
+    hooks = [metric_logger(checkpoint, args.log_interval, args.log_format, viz)]
+    # After the logger, so the table of an epoch prints below the last losses of that epoch
+    if timer is not None:
+        hooks.append(timer)
+    if amp is not None:
+        hooks.append(amp)
+    if jit is not None:
+        hooks.append(jit)
+    if cache is not None:
+        hooks.append(cache_report(cache))
+    hooks.append(checkpointer(checkpoint, saves, args.checkpoint_interval, optimizers, args.resume))
+    hooks.append(sampler_epochs())
+    hooks.append(history(checkpoint, plots, viz))
+
+    if args.profile_steps > 0:
+        hooks.append(profiler_hook(join(checkpoint, 'profile'), args.profile_steps, args.profile_wait))
+    return hooks
@@ -1,4 +1,7 @@
 import numpy as np
+from os import listdir
+from os.path import join, getsize
+from collections import OrderedDict
 from scipy.io import loadmat
 
 def logSpecDbDist(x,y):
@@ -14,13 +17,59 @@ def logSpecDbDist(x,y):
     dist = np.sqrt(sumSqDiff*2)*(10/np.log(10))
     return dist
 
+# Vectorized logSpecDbDist over the last axis of (frames, dims) or (utterances, frames, dims) inputs.
+# reduction: 'none' gives one distance per frame, 'utterance' the mean over the frames of each
+# utterance and 'mean' the corpus-level mean over all frames. Accepts NumPy arrays or torch tensors.
+def batch_mcd(x, y, reduction='mean'):
+    assert x.shape == y.shape
+
+    if hasattr(x, 'detach'):
+        diff = x.detach().double() - y.detach().double()
+        dist = (diff*diff).sum(-1).mul(2).sqrt()*(10/np.log(10))
+    else:
+        diff = np.asarray(x, dtype=np.float64) - np.asarray(y, dtype=np.float64)
+        dist = np.sqrt(np.einsum('...k,...k->...', diff, diff)*2)*(10/np.log(10))
+
+    if reduction == 'none':
+        return dist
+    if reduction == 'utterance':
+        return dist.mean(-1)
+    if reduction == 'mean':
+        return dist.mean()
+    raise ValueError("Unknown reduction: {}".format(reduction))
+
+# .mcc files store the 40 coefficients of each frame contiguously, so a plain C-order reshape gives the
+# (frames, 40) matrix directly; the former order='F' reshape + transpose was the same view, only spelled indirectly
 def read_mcc(path):
     d = np.fromfile(path,dtype=np.float32)
-    d = np.reshape(d, (40, d.size//40), order='F')
-    d = np.transpose(d)
+    d = np.reshape(d, (d.size//40, 40))
 
     return d
 
+# Memory-mapped version of read_mcc: a lazy (frames, dim) view, optionally limited to frames [start, stop).
+# Nothing is read from disk until the view is used.
+def read_mcc_mmap(path, start=0, stop=None, dim=40):
+    frames = getsize(path)//(4*dim)
+    if frames == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    d = np.memmap(path, dtype=np.float32, mode='c', shape=(frames, dim))
+    return d[start:stop]
+
+# Maps every .mcc file of a test folder at once (file name -> lazy view)
+def read_mcc_folder(folder, dim=40):
+    return OrderedDict((f, read_mcc_mmap(join(folder, f), dim=dim)) for f in sorted(listdir(folder)))
+
+# Splits a (frames, dim) matrix into consecutive blocks of chunk_frames frames (whole matrix if chunk_frames <= 0).
+# An empty file gives one empty block, so its converted file is written as (0, dim) too.
+def mcc_chunks(d, chunk_frames):
+    if chunk_frames <= 0 or len(d) == 0:
+        yield d
+        return
+
+    for start in range(0, len(d), chunk_frames):
+        yield d[start:start + chunk_frames]
+
 def read_mat(path):
     d = loadmat(path)
     return d
\ No newline at end of file